@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Bytes saved by HTML minification, against the CPU time it costs.
+
+Usage:
+    python benchmarks/minify_html.py [FILE ...]
+
+With no files, a synthetic page is used: an indented template of the kind
+Jinja emits, with code blocks. Pass rendered artifacts to measure real pages.
+Sizes are reported raw and gzipped, since S3 stores text gzipped.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from io import open
+from jinja2 import Template
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bluebucket.util import gzip  # noqa: E402
+from webquills.scribe.minify import minify, minify_stream  # noqa: E402
+
+synthetic = Template("""<!doctype html>
+<html>
+  <head>
+    <title>{{ title }}</title>
+    <!-- site chrome -->
+  </head>
+  <body>
+    <nav>
+      <ul>
+      {% for n in range(20) %}
+        <li>
+          <a href="/section-{{ n }}/">Section {{ n }}</a>
+        </li>
+      {% endfor %}
+      </ul>
+    </nav>
+    <main>
+    {% for n in range(40) %}
+      <article>
+        <h2>  Heading {{ n }}  </h2>
+        <p>
+          Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do
+          eiusmod tempor incididunt ut labore et dolore magna aliqua.
+        </p>
+        {% if n % 5 == 0 %}
+        <pre><code>def f(x):
+    return  x * {{ n }}
+</code></pre>
+        {% endif %}
+      </article>
+    {% endfor %}
+    </main>
+  </body>
+</html>
+""")
+
+
+def measure(name, html, number=50):
+    minified = minify(html)
+    assert ''.join(minify_stream(iter(html[i:i + 4096] for i in
+                                      range(0, len(html), 4096)))) == minified
+    seconds = min(timeit.repeat(lambda: minify(html), number=number,
+                                repeat=3)) / number
+    raw = len(html.encode('utf-8'))
+    small = len(minified.encode('utf-8'))
+    zipped = len(gzip(html.encode('utf-8')))
+    small_zipped = len(gzip(minified.encode('utf-8')))
+    print("%s\n"
+          "  raw:     %8d -> %8d bytes (%.1f%% saved)\n"
+          "  gzipped: %8d -> %8d bytes (%.1f%% saved)\n"
+          "  cost:    %8.2f ms per page (%.1f MB/s)" %
+          (name, raw, small, 100.0 * (raw - small) / raw,
+           zipped, small_zipped, 100.0 * (zipped - small_zipped) / zipped,
+           seconds * 1000, raw / seconds / 1e6))
+
+
+def main(filenames):
+    if not filenames:
+        measure("synthetic page", synthetic.render(title="Benchmark"))
+    for filename in filenames:
+        with open(filename, encoding='utf-8') as f:
+            measure(filename, f.read())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -15,5 +15,6 @@
 #   limitations under the License.
 #
 from __future__ import absolute_import, print_function, unicode_literals
+from .base import is_missing  # noqa
 from .s3 import *  # noqa
 
@@ -15,14 +15,27 @@
 #   limitations under the License.
 #
 from __future__ import absolute_import, print_function, unicode_literals
+from botocore.exceptions import ClientError
+import errno
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
+import zlib
 from bluebucket.util import SmartJSONEncoder
 
 
 logger = logging.getLogger(__name__)
 
 
+def is_missing(error):
+    "True if error means the requested object does not exist."
+    if isinstance(error, ClientError):
+        return 'NoSuchKey' in str(error) or '404' in str(error)
+    # localarchivist
+    return isinstance(error, (IOError, OSError)) and \
+        error.errno == errno.ENOENT
+
+
 #######################################################################
 # Model an object stored in the archive
 #######################################################################
@@ -30,13 +43,16 @@ class Resource(object):
     def __init__(self, **kwargs):
         self.acl = None
         self.bucket = None
+        self.cachecontrol = None
         self.content = None
         self.contenttype = None
         self.contentencoding = None
         self.deleted = False
         self.encoding = 'utf-8'
+        self.expires = None
         self.key = None
         self.last_modified = None
+        self.loaded_headers = {}  # caching headers as stored, when loaded
         self.metadata = kwargs.pop("metadata", {})
 
         for key in kwargs:
@@ -89,16 +105,71 @@ class Archivist(object):
     def get(self, filename):
         raise NotImplementedError
 
+    def head(self, filename):
+        """
+        Return a resource with the stored object's metadata and content
+        type, but without fetching its content.
+        """
+        raise NotImplementedError
+
+    def get_range(self, filename, start=0, end=None):
+        """
+        Return a resource whose content holds bytes start..end (inclusive) of
+        the stored object, exactly as stored (that is, still compressed if the
+        object has a content encoding). The resource's total_length attribute
+        gives the size of the whole stored object.
+        """
+        raise NotImplementedError
+
+    def get_head_bytes(self, filename, nbytes):
+        """
+        Return a tuple (content, complete) where content is the decoded
+        beginning of the object, read by fetching only its first nbytes
+        stored bytes, and complete is True if the whole object was read.
+        Gzip-encoded objects are partially decompressed, so the content may
+        be longer than nbytes.
+        """
+        reso = self.get_range(filename, 0, nbytes - 1)
+        complete = reso.total_length is None or\
+            len(reso.content) >= reso.total_length
+        content = reso.content
+        if reso.contentencoding == 'gzip':
+            # wbits offset of 16 tells zlib to expect a gzip header
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            content = decoder.decompress(content)
+            if complete:
+                content += decoder.flush()
+        return (content, complete)
+
     def save(self, resource):
         raise NotImplementedError
 
+    def save_stream(self, resource, chunks):
+        """
+        Save resource with its content given as an iterable of bytestrings
+        rather than in resource.content, so that the whole of a large object
+        need not be held in memory. This default implementation joins the
+        chunks and calls save; subclasses write them as they come.
+        """
+        resource.content = b''.join(chunks)
+        return self.save(resource)
+
     def publish(self, resource):
         "Same as save, but ensures the resource is publicly readable."
         raise NotImplementedError
 
-    def persist(self, resourcelist):
-        for resource in resourcelist:
-            self.save(resource)
+    def persist(self, resourcelist, max_workers=None):
+        """
+        Save every resource in the list. With max_workers > 1, saves run
+        concurrently on that many threads.
+        """
+        if not max_workers or max_workers <= 1:
+            for resource in resourcelist:
+                self.save(resource)
+            return
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # list() so that the first failure, if any, is raised here
+            list(executor.map(self.save, resourcelist))
 
     def delete(self, filename):
         raise NotImplementedError
@@ -106,10 +177,25 @@ class Archivist(object):
     def new_resource(self, key, **kwargs):
         raise NotImplementedError
 
+    def record_event(self, event):
+        "Note a change to the archive, made elsewhere, from its S3event."
+        pass
+
     @property
     def jinja(self):
         raise NotImplementedError
 
+    def list_keys(self, prefix=None):
+        "Return a list of keys under prefix (default, the archetype prefix)."
+        raise NotImplementedError
+
+    def list_etags(self, prefix):
+        """
+        Return a dict of key -> ETag (without quotes) for every object stored
+        under prefix, listed from storage rather than any inventory.
+        """
+        raise NotImplementedError
+
     def all_archetypes(self):
         "A generator function that will yield every archetype resource."
         raise NotImplementedError
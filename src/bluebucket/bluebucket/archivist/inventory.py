@@ -0,0 +1,148 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+A compact snapshot of the keys stored in a bucket.
+
+Paging through `list_objects` costs one request per 1000 keys. The inventory
+keeps the same information (key, size, etag, last_modified, resourcetype) in a
+single object, so listing the whole archive costs one GET. Only archetypes
+are kept: the archive's own state under `_A/_` is always listed from S3.
+
+Many processes update the bucket, so each save or delete an archivist makes
+is also recorded as an empty marker object under `_A/_inventory/`. Before
+serving a listing, the archivist lists these markers (one request) and
+applies those it has not seen, then folds them into the snapshot once there
+are many. The snapshot names the markers folded into it, so a process that
+finds the snapshot changed under it reloads it without applying them twice,
+and a fold writes only over the snapshot it read. Lambda handlers also feed it the S3 events they receive. Objects
+written by other tools are only seen when the snapshot is rebuilt from a
+full listing, which happens when it is older than `inventory_max_age`.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from dateutil.tz import tzutc
+import datetime
+import json
+from bluebucket.util import SmartJSONEncoder, parse_datetime
+
+# Entries are stored as rows rather than dicts to keep the snapshot compact.
+FIELDS = ('key', 'size', 'etag', 'last_modified', 'resourcetype')
+
+
+class Inventory(object):
+    def __init__(self, entries=None, reconciled=None, folded=None):
+        self.entries = entries or {}  # key -> row, see FIELDS
+        self.reconciled = reconciled  # datetime of last full listing
+        self.folded = set(folded or ())  # delta markers already applied
+        self.dirty = False
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key, size=None, etag=None, last_modified=None,
+            resourcetype=None):
+        "Record (or replace) the entry for a key."
+        if isinstance(last_modified, (datetime.datetime, datetime.date)):
+            last_modified = SmartJSONEncoder().default(last_modified)
+        if etag:
+            etag = etag.strip('"')
+        old = self.entries.get(key)
+        if resourcetype is None and old is not None:
+            # Listings and events do not carry metadata, keep what we knew.
+            resourcetype = old[4]
+        self.entries[key] = [key, size, etag, last_modified, resourcetype]
+        self.dirty = True
+
+    def remove(self, key):
+        "Forget a key. Unknown keys are ignored."
+        if self.entries.pop(key, None) is not None:
+            self.dirty = True
+
+    def get(self, key):
+        "Return the entry for key as a dict, or None if not present."
+        row = self.entries.get(key)
+        if row is None:
+            return None
+        return dict(zip(FIELDS, row))
+
+    def keys(self, prefix=''):
+        "Return a sorted list of keys starting with prefix."
+        return sorted(k for k in self.entries if k.startswith(prefix or ''))
+
+    def apply_event(self, event):
+        "Update the inventory from an S3event."
+        if event.is_save_event:
+            self.add(event.key, size=event.size, etag=event.etag,
+                     last_modified=event.time)
+        else:
+            self.remove(event.key)
+
+    def is_stale(self, max_age, now=None):
+        "True if the last full listing is older than max_age seconds."
+        if self.reconciled is None:
+            return True
+        now = now or datetime.datetime.now(tzutc())
+        age = now - self.reconciled
+        return age.total_seconds() > max_age
+
+    @classmethod
+    def from_listing(cls, contents, now=None):
+        """
+        Build a fresh inventory from the `Contents` entries of one or more
+        `list_objects` responses.
+        """
+        inv = cls(reconciled=now or datetime.datetime.now(tzutc()))
+        for item in contents:
+            inv.add(item['Key'], size=item.get('Size'), etag=item.get('ETag'),
+                    last_modified=item.get('LastModified'))
+        inv.dirty = True
+        return inv
+
+    def merge(self, other):
+        "Carry resourcetypes known to other into entries of this inventory."
+        for key, row in self.entries.items():
+            old = other.entries.get(key)
+            if row[4] is None and old is not None:
+                row[4] = old[4]
+
+    @property
+    def data(self):
+        return {
+            "fields": list(FIELDS),
+            "reconciled": self.reconciled,
+            "entries": [self.entries[k] for k in sorted(self.entries)],
+            "folded": sorted(self.folded),
+        }
+
+    @classmethod
+    def from_data(cls, data):
+        reconciled = data.get('reconciled')
+        if reconciled:
+            reconciled = parse_datetime(reconciled)
+        fields = data.get('fields', FIELDS)
+        entries = {}
+        for row in data.get('entries', []):
+            entry = dict(zip(fields, row))
+            entries[entry['key']] = [entry.get(f) for f in FIELDS]
+        return cls(entries=entries, reconciled=reconciled,
+                   folded=data.get('folded'))
+
+    def as_json(self):
+        return json.dumps(self.data, cls=SmartJSONEncoder,
+                          separators=(',', ':'))
@@ -15,11 +15,17 @@
 #   limitations under the License.
 #
 from __future__ import absolute_import, print_function, unicode_literals
+from datetime import datetime
+from dateutil.tz import tzutc
 import errno
+import hashlib
+import itertools
 import json
 import logging
 from bluebucket.archivist.base import Archivist
-from bluebucket.archivist.s3 import S3resource
+from bluebucket.archivist.s3 import S3event, S3resource
+from bluebucket.caching import apply_policy
+from bluebucket.util import SmartJSONEncoder
 from bluebucket.pathstrategy import DefaultPathStrategy
 from io import open
 import os
@@ -27,6 +33,8 @@ import os.path as path
 
 
 logger = logging.getLogger(__name__)
+# Sequencers only need to increase within a process, like S3's do per key.
+_sequence = itertools.count(1)
 
 
 #######################################################################
@@ -48,6 +56,7 @@ class localarchivist(Archivist):
 
     def __init__(self, bucket, **kwargs):
         self.bucket = bucket
+        self.listeners = []  # callables receiving an S3event per change
         self.meta_prefix = '.meta/'
         self.siteconfig = None
         self.pathstrategy = None
@@ -81,7 +90,7 @@ class localarchivist(Archivist):
             if e.errno != errno.EEXIST:
                 raise
         with open(metafile, 'wb') as f:
-            json.dump(resource.as_s3object(), f)
+            json.dump(resource.as_s3object(), f, cls=SmartJSONEncoder)
         with open(contentfile, 'wb') as f:
             f.write(resource.content)
 
@@ -111,13 +120,42 @@ class localarchivist(Archivist):
             pass
 
     def get(self, filename):
-        reso = localresource.from_s3object(
-            self._read_resource(Bucket=self.bucket, Key=filename)
-        )
+        obj = self._read_resource(Bucket=self.bucket, Key=filename)
+        # The copy of the body in the meta file has been through JSON, which
+        # turns non-ascii content into text. The content file has the bytes.
+        with open(path.join(self.bucket, filename), 'rb') as f:
+            obj['Body'] = f.read()
+        reso = localresource.from_s3object(obj)
         reso.key = filename
         reso.bucket = self.bucket
         return reso
 
+    def head(self, filename):
+        obj = self._read_resource(Bucket=self.bucket, Key=filename)
+        headers = {"cachecontrol": obj.get('CacheControl'),
+                   "expires": obj.get('Expires')}
+        return localresource(key=filename, bucket=self.bucket,
+                             contenttype=obj.get('ContentType'),
+                             metadata=obj.get('Metadata', {}),
+                             loaded_headers=dict(headers), **headers)
+
+    def get_range(self, filename, start=0, end=None):
+        # Local content is never compressed, so read straight from the file.
+        obj = self._read_resource(Bucket=self.bucket, Key=filename)
+        contentfile = path.join(self.bucket, filename)
+        with open(contentfile, 'rb') as f:
+            f.seek(start)
+            if end is None:
+                content = f.read()
+            else:
+                content = f.read(end - start + 1)
+        reso = localresource(key=filename, bucket=self.bucket,
+                             contenttype=obj.get('ContentType'),
+                             metadata=obj.get('Metadata', {}),
+                             content=content)
+        reso.total_length = path.getsize(contentfile)
+        return reso
+
     def save(self, resource):
         # To be saved a resource must have: key, contenttype, content
         # Strictly speaking, content is not required, but creating an empty
@@ -126,10 +164,7 @@ class localarchivist(Archivist):
             raise TypeError("Cannot save resource without key")
 
         if resource.deleted:
-            return self._delete_resource(
-                Bucket=self.bucket,  # NOTE archivist's bucket, NOT resource's!
-                Key=resource.key,
-            )
+            return self.delete(resource.key)
 
         if resource.contenttype is None:
             raise TypeError("Cannot save resource without contenttype")
@@ -140,23 +175,55 @@ class localarchivist(Archivist):
             raise ValueError("""Resources of type artifact must contain an
                              archetype_guid""")
 
-        return self._write_resource(resource)
-        # TODO On successful put, send SNS message to onSaveArtifact
-        # Since artifacts do not have a fixed path prefix or suffix, we cannot
-        # ask S3 to send notifications automatically, so we send them manually
-        # here.
+        apply_policy(self.siteconfig, resource)
+        rval = self._write_resource(resource)
+        self._notify('ObjectCreated:Put', resource.key,
+                     size=len(resource.content))
+        return rval
+
+    def save_stream(self, resource, chunks):
+        "Save resource, writing content from an iterable of bytestrings."
+        if resource.key is None:
+            raise TypeError("Cannot save resource without key")
+        if resource.contenttype is None:
+            raise TypeError("Cannot save resource without contenttype")
+        if resource.resourcetype == 'artifact' and not resource.archetype_guid:
+            raise ValueError("""Resources of type artifact must contain an
+                             archetype_guid""")
+
+        apply_policy(self.siteconfig, resource)
+        # The meta file gets an empty body; get() reads the content file.
+        resource.content = b''
+        self._write_resource(resource)
+        contentfile = path.join(self.bucket, resource.key)
+        size = 0
+        with open(contentfile, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        self._notify('ObjectCreated:Put', resource.key, size=size)
 
     def publish(self, resource):
         "Same as save, but ensures the resource is publicly readable."
         resource.acl = 'public-read'
         self.save(resource)
 
-    def persist(self, resourcelist):
-        for resource in resourcelist:
-            self.save(resource)
-
     def delete(self, filename):
-        return self._delete_resource(Bucket=self.bucket, Key=filename)
+        rval = self._delete_resource(Bucket=self.bucket, Key=filename)
+        self._notify('ObjectRemoved:Delete', filename)
+        return rval
+
+    def _notify(self, name, key, size=None):
+        # Stand-in for S3 notifications: tell listeners about the change with
+        # an S3-shaped event.
+        if not self.listeners:
+            return
+        event = S3event(bucket=self.bucket, key=key, name=name, size=size,
+                        region='local', source='aws:s3',
+                        sequencer='%016X' % next(_sequence),
+                        time=SmartJSONEncoder().default(datetime.now(tzutc())))
+        for listener in self.listeners:
+            listener(event)
 
     def new_resource(self, key, **kwargs):
         return localresource(bucket=self.bucket, key=key, **kwargs)
@@ -172,14 +239,45 @@ class localarchivist(Archivist):
         )
         return self._jinja
 
+    def list_keys(self, prefix=None):
+        "Return a list of keys under prefix (default, the archetype prefix)."
+        if prefix is None:
+            prefix = self.pathstrategy.archetype_prefix
+        # Walk the metadata tree, because every stored key has a meta file.
+        metaroot = path.join(self.bucket, self.meta_prefix)
+        keys = []
+        for (dirpath, dirnames, filenames) in os.walk(metaroot):
+            for filename in filenames:
+                key = path.relpath(path.join(dirpath, filename), metaroot)
+                key = key.replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def list_etags(self, prefix):
+        """
+        Return a dict of key -> ETag (the md5 of the file, as S3 computes it
+        for simple uploads) for every file under prefix, including files put
+        in the bucket by hand (e.g. templates).
+        """
+        top = path.join(self.bucket, path.dirname(prefix))
+        metaroot = path.join(self.bucket, self.meta_prefix.rstrip('/'))
+        etags = {}
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            dirnames[:] = [d for d in dirnames
+                           if path.join(dirpath, d) != metaroot]
+            for filename in filenames:
+                fullname = path.join(dirpath, filename)
+                key = path.relpath(fullname, self.bucket).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    with open(fullname, 'rb') as f:
+                        etags[key] = hashlib.md5(f.read()).hexdigest()
+        return etags
+
     def all_archetypes(self):
         "A generator function that will yield every archetype resource."
-        # S3 will return up to 1000 items in a list_objects call. If there are
-        # more, IsTruncated will be True and NextMarker is the offset to use to
-        # get the next 1000.
-        for (dirpath, dirnames, filenames) in os.walk(self.bucket):
-            for filename in filenames:
-                yield self.get(path.join(dirpath, filename))
+        for key in self.list_keys(self.pathstrategy.archetype_prefix):
+            yield self.get(key)
 
     def init_bucket(self):
         try:
@@ -16,18 +16,41 @@
 #
 from __future__ import absolute_import, print_function, unicode_literals
 import boto3
-from dateutil.parser import parse as parse_date
+from botocore.exceptions import ClientError
+from datetime import datetime
+from dateutil.tz import tzutc
 from io import open
+import itertools
 import json
 import logging
+import os
 import pkg_resources
 import re
-from bluebucket.archivist.base import Archivist, Resource
+import threading
+import uuid
+from bluebucket.archivist.base import Archivist, Resource, is_missing
+from bluebucket.archivist.inventory import Inventory
+from bluebucket.caching import apply_policy
 from bluebucket.pathstrategy import DefaultPathStrategy
-from bluebucket.util import gunzip, gzip
+from bluebucket.util import gunzip, gzip, gzip_stream, parse_datetime
+from bluebucket.util import rechunk
+
+try:
+    from urllib.parse import quote_plus, unquote_plus
+except ImportError:  # Python 2, where these only handle bytestrings
+    import urllib
+
+    def quote_plus(s, safe=''):
+        return urllib.quote_plus(s.encode('utf-8'),
+                                 safe.encode('utf-8')).decode('utf-8')
+
+    def unquote_plus(s):
+        return urllib.unquote_plus(s.encode('utf-8')).decode('utf-8')
 
 
 logger = logging.getLogger(__name__)
+# S3 requires every part of a multipart upload but the last to be 5MB or more
+part_size = 5 * 1024 * 1024
 
 
 #######################################################################
@@ -44,6 +67,10 @@ class S3resource(Resource):
         b = cls(**kwargs)
         b.last_modified = obj.get('LastModified')  # boto3 gives a datetime
         b.contenttype = obj.get('ContentType')
+        b.cachecontrol = obj.get('CacheControl')
+        b.expires = obj.get('Expires')
+        b.loaded_headers = {"cachecontrol": b.cachecontrol,
+                            "expires": b.expires}
         # NOTE reflects compressed size if compressed
         b.content_length = obj.get('ContentLength')
         b.metadata = obj.get('Metadata', {})
@@ -74,6 +101,10 @@ class S3resource(Resource):
             s3obj['Body'] = self.content
         if self.acl:
             s3obj['ACL'] = self.acl
+        if self.cachecontrol:
+            s3obj['CacheControl'] = self.cachecontrol
+        if self.expires:
+            s3obj['Expires'] = self.expires
 
         return s3obj
 
@@ -93,11 +124,17 @@ class S3archivist(Archivist):
         self.bucket = bucket
         self.cloudformation = None  # rarely used, only init_bucket
         self.iam = None  # rarely used
+        self.inventory_key = None
+        self.inventory_delta_prefix = None
         self.pathstrategy = None
         self.s3 = None
         self.siteconfig = None
         self._jinja = None  # See jinja property below
         self._account = None  # See account property
+        self._inventory = None  # See inventory property
+        self._inventory_lock = threading.RLock()
+        self._inventory_etag = None  # of the snapshot loaded
+        self._applied_deltas = set()
         for key in kwargs:
             if key == 'jinja':
                 setattr(self, '_jinja', kwargs[key])
@@ -113,6 +150,13 @@ class S3archivist(Archivist):
         if self.pathstrategy is None:
             self.pathstrategy = DefaultPathStrategy()
 
+        if self.inventory_key is None:
+            self.inventory_key = self.pathstrategy.archetype_prefix +\
+                '_inventory.json'
+        if self.inventory_delta_prefix is None:
+            self.inventory_delta_prefix = self.pathstrategy.archetype_prefix +\
+                '_inventory/'
+
         if self.siteconfig is None:
             cfg_path = self.pathstrategy.archetype_prefix + 'site.json'
             self.siteconfig = self.get(cfg_path).data
@@ -124,6 +168,34 @@ class S3archivist(Archivist):
         reso.bucket = self.bucket
         return reso
 
+    def head(self, filename):
+        resp = self.s3.head_object(Bucket=self.bucket, Key=filename)
+        headers = {"cachecontrol": resp.get('CacheControl'),
+                   "expires": resp.get('Expires')}
+        return S3resource(key=filename, bucket=self.bucket,
+                          contenttype=resp.get('ContentType'),
+                          contentencoding=resp.get('ContentEncoding'),
+                          metadata=resp.get('Metadata', {}),
+                          last_modified=resp.get('LastModified'),
+                          loaded_headers=dict(headers), **headers)
+
+    def get_range(self, filename, start=0, end=None):
+        byterange = 'bytes=%d-' % start
+        if end is not None:
+            byterange += '%d' % end
+        resp = self.s3.get_object(Bucket=self.bucket, Key=filename,
+                                  Range=byterange)
+        reso = S3resource(key=filename, bucket=self.bucket,
+                          contenttype=resp.get('ContentType'),
+                          contentencoding=resp.get('ContentEncoding'),
+                          metadata=resp.get('Metadata', {}),
+                          last_modified=resp.get('LastModified'),
+                          content=resp['Body'].read())
+        # e.g. "bytes 0-4095/146515"
+        m = re.match(r'bytes \d+-\d+/(\d+)', resp.get('ContentRange', ''))
+        reso.total_length = int(m.group(1)) if m else None
+        return reso
+
     def save(self, resource):
         # To be saved a resource must have: key, contenttype, content
         # Strictly speaking, content is not required, but creating an empty
@@ -132,10 +204,7 @@ class S3archivist(Archivist):
             raise TypeError("Cannot save resource without key")
 
         if resource.deleted:
-            return self.s3.delete_object(
-                Bucket=self.bucket,  # NOTE archivist's bucket, NOT resource's!
-                Key=resource.key,
-            )
+            return self.delete(resource.key)
 
         if resource.contenttype is None:
             raise TypeError("Cannot save resource without contenttype")
@@ -146,24 +215,87 @@ class S3archivist(Archivist):
             raise ValueError("""Resources of type artifact must contain an
                              archetype_guid""")
 
+        apply_policy(self.siteconfig, resource)
         s3obj = resource.as_s3object(self.bucket)
-        return self.s3.put_object(**s3obj)
+        response = self.s3.put_object(**s3obj)
+        self._record_change(resource.key, size=len(s3obj['Body']),
+                            etag=response.get('ETag'),
+                            resourcetype=resource.resourcetype)
+        return response
         # TODO On successful put, send SNS message to onSaveArtifact
         # Since artifacts do not have a fixed path prefix or suffix, we cannot
         # ask S3 to send notifications automatically, so we send them manually
         # here.
 
+    def save_stream(self, resource, chunks):
+        """
+        Save resource with content from an iterable of bytestrings, compressing
+        as it goes if the resource is compressible. Content that fits in one
+        part is sent with a single PUT; larger content as a multipart upload,
+        so that only one part is held in memory at a time.
+        """
+        if resource.key is None:
+            raise TypeError("Cannot save resource without key")
+        if resource.contenttype is None:
+            raise TypeError("Cannot save resource without contenttype")
+        if resource.resourcetype == 'artifact' and not resource.archetype_guid:
+            raise ValueError("""Resources of type artifact must contain an
+                             archetype_guid""")
+
+        apply_policy(self.siteconfig, resource)
+        resource.content = b''
+        s3obj = resource.as_s3object(self.bucket)
+        del s3obj['Body']
+        if resource.is_compressible():
+            chunks = gzip_stream(chunks)
+        parts = rechunk(chunks, part_size)
+        first = next(parts, b'')
+        second = next(parts, None)
+        if second is None:
+            response = self.s3.put_object(Body=first, **s3obj)
+            size = len(first)
+        else:
+            (response, size) = self._multipart_upload(
+                s3obj, itertools.chain([first, second], parts))
+        self._record_change(resource.key, size=size,
+                            etag=response.get('ETag'),
+                            resourcetype=resource.resourcetype)
+        return response
+
+    def _multipart_upload(self, s3obj, parts):
+        upload = self.s3.create_multipart_upload(**s3obj)
+        uploaded = []
+        size = 0
+        try:
+            for (number, body) in enumerate(parts, 1):
+                resp = self.s3.upload_part(Bucket=s3obj['Bucket'],
+                                           Key=s3obj['Key'],
+                                           UploadId=upload['UploadId'],
+                                           PartNumber=number, Body=body)
+                uploaded.append({"ETag": resp['ETag'], "PartNumber": number})
+                size += len(body)
+            response = self.s3.complete_multipart_upload(
+                Bucket=s3obj['Bucket'], Key=s3obj['Key'],
+                UploadId=upload['UploadId'],
+                MultipartUpload={"Parts": uploaded})
+        except Exception:
+            # Parts of an abandoned upload are stored (and billed) until
+            # the upload is aborted.
+            self.s3.abort_multipart_upload(Bucket=s3obj['Bucket'],
+                                           Key=s3obj['Key'],
+                                           UploadId=upload['UploadId'])
+            raise
+        return (response, size)
+
     def publish(self, resource):
         "Same as save, but ensures the resource is publicly readable."
         resource.acl = 'public-read'
         self.save(resource)
 
-    def persist(self, resourcelist):
-        for resource in resourcelist:
-            self.save(resource)
-
     def delete(self, filename):
-        return self.s3.delete_object(Bucket=self.bucket, Key=filename)
+        response = self.s3.delete_object(Bucket=self.bucket, Key=filename)
+        self._record_change(filename, deleted=True)
+        return response
 
     def new_resource(self, key, **kwargs):
         return S3resource(bucket=self.bucket, key=key, **kwargs)
@@ -184,35 +316,289 @@ class S3archivist(Archivist):
     def jinja(self):
         if self._jinja:
             return self._jinja
-        from jinja2 import Environment
+        from jinja2 import ChoiceLoader, Environment
         from jinja2_s3loader import S3loader
+        from bluebucket.templates import load_bundle
         template_dir = self.siteconfig.get('template_dir', '_templates')
-        self._jinja = Environment(loader=S3loader(self.bucket,
-                                                  template_dir,
-                                                  s3=self.s3))
+        loader = S3loader(self.bucket, template_dir, s3=self.s3)
+        # Serve precompiled templates from the bundle, if there is one.
+        if self.siteconfig.get('use_template_bundle'):
+            bundle = load_bundle(self)
+            if bundle is not None:
+                loader = ChoiceLoader([bundle, loader])
+        self._jinja = Environment(loader=loader)
         return self._jinja
 
-    def all_archetypes(self):
-        "A generator function that will yield every archetype resource."
+    def _list_objects(self, prefix):
+        "A generator yielding the Contents entries of every key under prefix."
         # S3 will return up to 1000 items in a list_objects call. If there are
-        # more, IsTruncated will be True and NextMarker is the offset to use to
-        # get the next 1000.
+        # more, IsTruncated will be True and we ask for the next page starting
+        # after the last key we saw (NextMarker is only sent with Delimiter).
         incomplete = True
         marker = None
         while incomplete:
-            args = dict(Bucket=self.bucket,
-                        Prefix=self.pathstrategy.archetype_prefix)
+            args = dict(Bucket=self.bucket, Prefix=prefix)
             if marker:
                 args['Marker'] = marker
             listing = self.s3.list_objects(**args)
-            for item in listing['Contents']:
-                resource = self.get(item['Key'])
-                yield resource
+            contents = listing.get('Contents', [])
+            for item in contents:
+                yield item
             if listing['IsTruncated']:
-                marker = listing['NextMarker']
+                marker = listing.get('NextMarker') or contents[-1]['Key']
             else:
                 incomplete = False
 
+    def list_keys(self, prefix=None):
+        """
+        Return a list of keys under prefix (default, the archetype prefix).
+
+        When the siteconfig sets `use_inventory`, listings of archetypes are
+        served from the inventory instead of paging through list_objects.
+        The archive's own state under `_A/_` is not in the inventory, so it
+        is always listed, and is left out of inventory listings of `_A/`.
+        """
+        if prefix is None:
+            prefix = self.pathstrategy.archetype_prefix
+        if self.uses_inventory(prefix):
+            with self._inventory_lock:
+                self.refresh_inventory()
+                keys = self.inventory.keys(prefix)
+        else:
+            keys = [item['Key'] for item in self._list_objects(prefix)]
+        return [k for k in keys if k != self.inventory_key]
+
+    def list_etags(self, prefix):
+        "Return a dict of key -> ETag (without quotes) for keys under prefix."
+        return dict((item['Key'], item['ETag'].strip('"'))
+                    for item in self._list_objects(prefix))
+
+    def tracks(self, key):
+        "True if key belongs in the inventory."
+        prefix = self.pathstrategy.archetype_prefix
+        return key.startswith(prefix) and not key.startswith(prefix + '_')
+
+    def uses_inventory(self, prefix):
+        "True if listings of prefix are served from the inventory."
+        return bool((self.siteconfig or {}).get('use_inventory')) and \
+            self.tracks(prefix)
+
+    @property
+    def inventory(self):
+        """
+        The Inventory of the archive, loaded on first access. If no snapshot
+        exists, or it has not been reconciled against a full listing within
+        `inventory_max_age` seconds (siteconfig, default one day), it is
+        rebuilt and saved.
+        """
+        with self._inventory_lock:
+            if self._inventory is not None:
+                return self._inventory
+            max_age = self.siteconfig.get('inventory_max_age', 86400)
+            (snapshot, etag) = self._load_snapshot()
+            if snapshot is None or snapshot.is_stale(max_age):
+                self._inventory = self.reconcile_inventory(snapshot)
+            else:
+                self._use_snapshot(snapshot, etag)
+                self.refresh_inventory()
+            return self._inventory
+
+    def _load_snapshot(self):
+        "Read the saved inventory. Returns (Inventory, ETag), or (None, None)."
+        try:
+            response = self.s3.get_object(Bucket=self.bucket,
+                                          Key=self.inventory_key)
+        except ClientError as e:
+            if not is_missing(e):
+                raise
+            return (None, None)
+        snapshot = S3resource.from_s3object(response)
+        return (Inventory.from_data(snapshot.data), response.get('ETag'))
+
+    def _use_snapshot(self, snapshot, etag):
+        self._inventory = snapshot
+        self._inventory_etag = etag
+        self._applied_deltas = set(snapshot.folded)
+
+    def _put_snapshot(self, inventory, etag=None, conditional=True):
+        """
+        Write inventory as the snapshot. If conditional, only if the saved
+        snapshot still has the given ETag (or, without one, does not exist).
+        Returns the new ETag, or None if the condition failed.
+        """
+        snapshot = self.new_resource(self.inventory_key,
+                                     content=inventory.as_json()
+                                     .encode('utf-8'),
+                                     contenttype='application/json',
+                                     resourcetype='config')
+        apply_policy(self.siteconfig, snapshot)
+        s3obj = snapshot.as_s3object(self.bucket)
+        if conditional and etag:
+            s3obj['IfMatch'] = etag
+        elif conditional:
+            s3obj['IfNoneMatch'] = '*'
+        try:
+            response = self.s3.put_object(**s3obj)
+        except ClientError as e:
+            code = e.response.get('Error', {}).get('Code')
+            if code in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return None
+            raise
+        inventory.dirty = False
+        return response.get('ETag')
+
+    def reconcile_inventory(self, previous=None):
+        "Rebuild the inventory from a full listing of the archive and save it."
+        logger.info("Reconciling inventory for bucket: %s" % self.bucket)
+        with self._inventory_lock:
+            prefix = self.pathstrategy.archetype_prefix
+            # Changes recorded before the listing began are in the listing.
+            recorded = list(self._list_objects(self.inventory_delta_prefix))
+            inventory = Inventory.from_listing(
+                item for item in self._list_objects(prefix)
+                if self.tracks(item['Key'])
+            )
+            inventory.folded = set(item['Key'] for item in recorded)
+            if previous is not None:
+                inventory.merge(previous)
+            # A full listing is newer than any snapshot, so overwrite.
+            etag = self._put_snapshot(inventory, conditional=False)
+            self._use_snapshot(inventory, etag)
+            self._delete_deltas(inventory.folded)
+            self.refresh_inventory()
+            return inventory
+
+    def save_inventory(self):
+        """
+        Persist the inventory snapshot, if it has changed since loaded and
+        the saved snapshot has not been replaced since. Returns False if it
+        had been.
+        """
+        if self._inventory is None or not self._inventory.dirty:
+            return True
+        etag = self._put_snapshot(self._inventory, self._inventory_etag)
+        if etag is None:
+            return False
+        self._inventory_etag = etag
+        return True
+
+    def _record_change(self, key, deleted=False, **entry):
+        """
+        Note a save or delete of key. The inventory in memory is updated, and
+        so that other processes see the change, it is recorded as an empty
+        marker object, `<delta prefix><time>.<id>.<put|del>/<key>`.
+        """
+        if not self.uses_inventory(key):
+            return
+        stamp = datetime.now(tzutc()).strftime('%Y%m%d%H%M%S%f')
+        marker = '%s%s.%s.%s/%s' % (self.inventory_delta_prefix, stamp,
+                                    uuid.uuid4().hex[:8],
+                                    'del' if deleted else 'put', key)
+        self.s3.put_object(Bucket=self.bucket, Key=marker, Body=b'',
+                           ContentType='application/octet-stream')
+        with self._inventory_lock:
+            if self._inventory is None:
+                return  # the marker is applied when the inventory is loaded
+            self._applied_deltas.add(marker)
+            if deleted:
+                self._inventory.remove(key)
+            else:
+                self._inventory.add(key, last_modified=datetime.now(tzutc()),
+                                    **entry)
+
+    def refresh_inventory(self):
+        """
+        Apply the changes other processes have recorded since the inventory
+        was loaded, reloading the snapshot first if another process has
+        replaced it. Once more than `inventory_max_deltas` (siteconfig,
+        default 1000) are recorded, they are folded into the snapshot.
+        """
+        with self._inventory_lock:
+            if self._inventory is None:
+                return
+            # One listing finds both the markers and the snapshot's ETag.
+            prefix = os.path.commonprefix([self.inventory_key,
+                                           self.inventory_delta_prefix])
+            etag = None
+            markers = []
+            for item in self._list_objects(prefix):
+                if item['Key'] == self.inventory_key:
+                    etag = item.get('ETag')
+                elif item['Key'].startswith(self.inventory_delta_prefix):
+                    markers.append(item['Key'])
+            markers.sort()
+            if etag != self._inventory_etag:
+                (snapshot, etag) = self._load_snapshot()
+                if snapshot is not None:
+                    self._use_snapshot(snapshot, etag)
+                self._inventory_etag = etag
+            self._apply_deltas(self._inventory, markers, self._applied_deltas)
+            max_deltas = self.siteconfig.get('inventory_max_deltas', 1000)
+            if markers and len(markers) > max_deltas:
+                self._fold_deltas(markers)
+
+    def _apply_deltas(self, inventory, markers, applied):
+        "Apply to inventory the markers not in applied, adding them to it."
+        prefix = self.inventory_delta_prefix
+        for marker in markers:
+            if marker in applied:
+                continue
+            (change, key) = marker[len(prefix):].split('/', 1)
+            if change.endswith('.del'):
+                inventory.remove(key)
+            elif key not in inventory:
+                inventory.add(key)
+            applied.add(marker)
+
+    def _fold_deltas(self, markers, attempts=5):
+        """
+        Fold the (sorted) markers into the saved snapshot, then delete them.
+        Other processes fold too, so the snapshot is read again and the
+        markers applied to it, and it is written only if no one has replaced
+        it since it was read.
+        """
+        for attempt in range(attempts):
+            (snapshot, etag) = self._load_snapshot()
+            if snapshot is None:
+                snapshot = self._inventory
+            self._apply_deltas(snapshot, markers, snapshot.folded)
+            snapshot.merge(self._inventory)
+            # Markers are deleted once folded, so only those newer than this
+            # listing may still exist.
+            snapshot.folded = set(markers).union(
+                m for m in snapshot.folded if m > markers[-1])
+            etag = self._put_snapshot(snapshot, etag)
+            if etag is not None:
+                self._use_snapshot(snapshot, etag)
+                self._delete_deltas(markers)
+                return True
+        logger.warning("Inventory for bucket %s changed during each of %d "
+                       "attempts to fold changes" % (self.bucket, attempts))
+        return False
+
+    def _delete_deltas(self, markers):
+        markers = list(markers)
+        for start in range(0, len(markers), 1000):  # the most per request
+            batch = markers[start:start + 1000]
+            self.s3.delete_objects(Bucket=self.bucket, Delete={
+                "Objects": [{"Key": k} for k in batch], "Quiet": True})
+
+    def record_event(self, event):
+        """
+        Apply an S3event for this bucket to the inventory, if loaded, so a
+        process sees changes as soon as it is notified of them.
+        """
+        if self._inventory is None or event.bucket != self.bucket or \
+                not self.tracks(event.key):
+            return
+        with self._inventory_lock:
+            self._inventory.apply_event(event)
+
+    def all_archetypes(self):
+        "A generator function that will yield every archetype resource."
+        for key in self.list_keys(self.pathstrategy.archetype_prefix):
+            yield self.get(key)
+
     def init_bucket(self):
         "Initialize a bucket and create a cloudformation stack for it."
         # To be absolutely certain that cloudformation will not delete customer
@@ -338,6 +724,10 @@ class S3archivist(Archivist):
         # created by cloudformation.
         logger.info("Waiting for cloudformation stack: %s" % stack_name)
         waiter.wait(StackName=stack_name)
+        # The stack also schedules webquills.flush_pending_catalogs for this
+        # bucket, which renders catalogs held back by catalog_render_window.
+        logger.info("Pending catalogs flushed each minute by: %s" %
+                    (stack_name + "-indexer-flush-catalogs"))
 
         # Configure Event Sources to send to SNS Topics for this bucket.
         # For this, I need the ARNs for the topics in question. Sigh. Since topic
@@ -431,90 +821,123 @@ class S3archivist(Archivist):
 # S3 Events
 #######################################################################
 class S3event(object):
+    """
+    A compact view of an S3 event record. The fields handlers use are
+    extracted once at construction, and the event time is parsed only when
+    first asked for. Object keys arrive URL-encoded in S3 events; the key
+    attribute holds the decoded key. The original record is kept in `event`,
+    and as_json() writes any changed fields back into it.
+    """
+    __slots__ = ('event', 'bucket', 'etag', 'key', 'region', 'sequencer',
+                 'size', 'source', 'is_save_event', '_name', '_time',
+                 '_datetime', '_rawkey')
+
     def __init__(self, event=None, **kwargs):
         self.event = event or {"s3": {"object": {}, "bucket": {}}, }
+        s3 = self.event.get('s3', {})
+        obj = s3.get('object', {})
+        self.bucket = s3.get('bucket', {}).get('name')
+        self.etag = obj.get('eTag')
+        self._rawkey = obj.get('key')
+        self.key = None if self._rawkey is None else unquote_plus(self._rawkey)
+        self.region = self.event.get('awsRegion')
+        self.sequencer = obj.get('sequencer')
+        self.size = obj.get('size')
+        self.source = self.event.get('eventSource')
+        self.name = self.event.get('eventName')
+        self.time = self.event.get('eventTime')
         for key in kwargs:
             setattr(self, key, kwargs[key])
 
-    @property
-    def bucket(self):
-        return self.event['s3']['bucket']['name']
-
-    @bucket.setter
-    def bucket(self, newval):
-        self.event['s3']['bucket']['name'] = newval
-
-    @property
-    def datetime(self):
-        "The event time as a datetime object, rather than a string."
-        return parse_date(self.time)
-
-    @property
-    def etag(self):
-        return self.event['s3']['object']['eTag']
-
-    @etag.setter
-    def etag(self, newval):
-        self.event['s3']['object']['eTag'] = newval
-
-    @property
-    def is_save_event(self):
-        return 'ObjectCreated' in self.name
-
-    @property
-    def key(self):
-        return self.event['s3']['object']['key']
-
-    @key.setter
-    def key(self, newval):
-        self.event['s3']['object']['key'] = newval
+    def __repr__(self):
+        return "<S3event %s s3://%s/%s>" % (self.name, self.bucket, self.key)
 
     @property
     def name(self):
-        return self.event['eventName']
+        return self._name
 
     @name.setter
     def name(self, newval):
-        self.event['eventName'] = newval
-
-    @property
-    def region(self):
-        return self.event['awsRegion']
-
-    @region.setter
-    def region(self, newval):
-        self.event['awsRegion'] = newval
-
-    @property
-    def sequencer(self):
-        return self.event['s3']['object']['sequencer']
-
-    @sequencer.setter
-    def sequencer(self, newval):
-        self.event['s3']['object']['sequencer'] = newval
-
-    @property
-    def source(self):
-        return self.event['eventSource']
-
-    @source.setter
-    def source(self, newval):
-        self.event['eventSource'] = newval
+        self._name = newval
+        self.is_save_event = newval is not None and 'ObjectCreated' in newval
 
     @property
     def time(self):
-        return self.event['eventTime']
+        return self._time
 
     @time.setter
     def time(self, newval):
-        self.event['eventTime'] = newval
+        self._time = newval
+        self._datetime = None
+
+    @property
+    def datetime(self):
+        "The event time as a datetime object, rather than a string."
+        if self._datetime is None and self._time is not None:
+            self._datetime = parse_datetime(self._time)
+        return self._datetime
 
     def as_json(self):
         "Returns a serialized JSON string of the S3 event"
-        return json.dumps(self.event)
-
-
-def parse_aws_event(message, **kwargs):
+        event = self.event
+        s3 = event.setdefault('s3', {})
+        obj = s3.setdefault('object', {})
+        if self.key is not None:
+            if self._rawkey is None or self.key != unquote_plus(self._rawkey):
+                self._rawkey = quote_plus(self.key, safe='/')
+            obj['key'] = self._rawkey
+        fields = [
+            (s3.setdefault('bucket', {}), 'name', self.bucket),
+            (obj, 'eTag', self.etag),
+            (obj, 'sequencer', self.sequencer),
+            (obj, 'size', self.size),
+            (event, 'awsRegion', self.region),
+            (event, 'eventName', self.name),
+            (event, 'eventSource', self.source),
+            (event, 'eventTime', self.time),
+        ]
+        for (container, field, value) in fields:
+            if value is not None:
+                container[field] = value
+        return json.dumps(event)
+
+
+def _sequence(event):
+    "The event's sequencer as an integer, or None if it has none."
+    try:
+        return int(event.sequencer, 16)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def coalesce_events(events):
+    """
+    Reduce a list of S3events to the newest event for each bucket and key.
+
+    S3 sequencer values tell which of two events for the same key happened
+    later; when they are missing, the event that came later in the list wins.
+    Because only the newest event survives, a save followed by a delete
+    becomes just the delete. Surviving events keep their relative order.
+    """
+    newest = {}
+    for position, event in enumerate(events):
+        ident = (event.bucket, event.key)
+        held = newest.get(ident)
+        if held is not None:
+            seq, held_seq = _sequence(event), _sequence(held[1])
+            if seq is not None and held_seq is not None and seq < held_seq:
+                continue
+        newest[ident] = (position, event)
+    return [pair[1] for pair in sorted(newest.values(), key=lambda p: p[0])]
+
+
+def parse_aws_event(message, coalesce=False, **kwargs):
+    """
+    Return a list of S3events found in a Lambda message, which may contain S3
+    events directly or wrapped in SNS notifications. If coalesce is true,
+    repeated events for the same key are reduced to the newest one (see
+    coalesce_events).
+    """
     eventlist = message['Records']
     events = []
     for event in eventlist:
@@ -536,4 +959,6 @@ def parse_aws_event(message, **kwargs):
                         json.dumps(message, sort_keys=True))
             return []
 
+    if coalesce:
+        events = coalesce_events(events)
     return events
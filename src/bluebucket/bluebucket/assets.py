@@ -0,0 +1,87 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Assets stored under fingerprinted keys.
+
+An asset whose key changes whenever its content does can be cached forever
+(see `bluebucket.caching`). With the siteconfig setting `fingerprint_assets`,
+`save_asset` stores e.g. `css/site.css` as `css/site.0123456789ab.css`, the
+hash being of its content, and records the mapping in the asset manifest,
+`_A/_assets.json`. Templates look the current key up with `asset_url`.
+
+Earlier versions are not deleted, since cached pages may still refer to them.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from bluebucket.archivist import is_missing
+import hashlib
+import posixpath as path
+
+manifest_name = '_assets.json'
+
+
+def manifest_key(archivist):
+    return archivist.pathstrategy.path_for(resourcetype='config',
+                                           key=manifest_name)
+
+
+def fingerprinted_key(key, content):
+    "The key of content stored as key, with a hash of the content added."
+    (root, ext) = path.splitext(key)
+    return '%s.%s%s' % (root, hashlib.md5(content).hexdigest()[:12], ext)
+
+
+def load_manifest(archivist):
+    "Return the asset manifest, a dict of asset key -> fingerprinted key."
+    try:
+        return archivist.get(manifest_key(archivist)).data.get('assets', {})
+    except Exception as e:
+        if not is_missing(e):
+            raise
+        return {}
+
+
+def save_manifest(archivist, manifest):
+    resource = archivist.new_resource(manifest_key(archivist),
+                                      contenttype='application/json',
+                                      resourcetype='config')
+    resource.data = {"assets": manifest}
+    archivist.save(resource)
+
+
+def save_asset(archivist, resource):
+    """
+    Publish an asset resource, under a fingerprinted key if the site sets
+    `fingerprint_assets`. Returns the key it was stored under.
+    """
+    if not archivist.siteconfig.get('fingerprint_assets'):
+        archivist.publish(resource)
+        return resource.key
+    key = resource.key
+    resource.key = fingerprinted_key(key, resource.content)
+    resource.metadata['asset_key'] = key
+    archivist.publish(resource)
+    manifest = load_manifest(archivist)
+    if manifest.get(key) != resource.key:
+        manifest[key] = resource.key
+        save_manifest(archivist, manifest)
+    return resource.key
+
+
+def asset_url(manifest, key):
+    "The site-relative URL of an asset, fingerprinted if in the manifest."
+    key = key.lstrip('/')
+    return '/' + manifest.get(key, key)
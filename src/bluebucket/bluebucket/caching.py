@@ -0,0 +1,82 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+HTTP caching headers for stored objects, by siteconfig policy.
+
+Without a Cache-Control header, CDNs and browsers revalidate every object on
+every view. The siteconfig setting `cache_control` is a list of rules, tried
+in order when an object is saved. The first rule whose conditions all match
+gives the object's headers:
+
+    "cache_control": [
+      {"resourcetype": "asset", "fingerprinted": true,
+       "cache_control": "public, max-age=31536000, immutable"},
+      {"contenttype": "text/html", "cache_control": "public, max-age=300"},
+      {"resourcetype": "config", "cache_control": "no-cache"}
+    ]
+
+Conditions are `resourcetype`, `contenttype` (a prefix of the content type)
+and `fingerprinted` (whether the object is an asset stored under a content
+hash key, see `bluebucket.assets`, and so can never change). `cache_control`
+becomes the Cache-Control header; use its max-age for lifetimes, since an
+Expires header is a fixed date that would go stale on the stored object.
+
+The policy decides the header of every object saved, including one that was
+read with its old headers and saved again, unless the caller set a header on
+the resource explicitly. An Expires header read with a resource is dropped.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+
+def matches(rule, resource):
+    "True if the policy rule applies to resource."
+    if 'resourcetype' in rule and \
+            rule['resourcetype'] != resource.resourcetype:
+        return False
+    if 'contenttype' in rule and \
+            not (resource.contenttype or '').startswith(rule['contenttype']):
+        return False
+    if 'fingerprinted' in rule and \
+            rule['fingerprinted'] != bool(resource.metadata.get('asset_key')):
+        return False
+    return True
+
+
+def rule_for(siteconfig, resource):
+    "The first cache_control rule in siteconfig for resource, or None."
+    for rule in (siteconfig or {}).get('cache_control') or []:
+        if matches(rule, resource):
+            return rule
+    return None
+
+
+def is_explicit(resource, header):
+    "True if the caller set the header attribute since resource was loaded."
+    value = getattr(resource, header)
+    return value is not None and \
+        value != resource.loaded_headers.get(header)
+
+
+def apply_policy(siteconfig, resource):
+    "Set the caching headers of resource from the siteconfig policy."
+    if not (siteconfig or {}).get('cache_control'):
+        return
+    if not is_explicit(resource, 'expires'):
+        resource.expires = None
+    if not is_explicit(resource, 'cachecontrol'):
+        rule = rule_for(siteconfig, resource)
+        resource.cachecontrol = rule and rule.get('cache_control')
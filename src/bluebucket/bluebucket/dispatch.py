@@ -0,0 +1,107 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Process the records of an event batch concurrently.
+
+Lambda handlers spend most of their time waiting on S3 and DynamoDB, so the
+records in a batch are handed to a small thread pool. Records for the same
+bucket and key are run in order by a single worker, so two versions of one
+document never race. A failing record does not stop the others; failures are
+collected and raised together once every record has been tried.
+
+`handle_message` does the same for a Lambda message of S3 notifications,
+giving each record's handler the archivist for its bucket.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+logger = logging.getLogger(__name__)
+default_max_workers = 8
+
+
+class EventProcessingError(Exception):
+    "Raised when one or more records of a batch could not be processed."
+    def __init__(self, failures):
+        self.failures = failures  # list of (event, exception)
+        summary = "; ".join("%s: %s" % (event.key, err)
+                            for (event, err) in failures)
+        super(EventProcessingError, self).__init__(
+            "%d event(s) failed: %s" % (len(failures), summary))
+
+
+def _run_serially(handler, events):
+    failures = []
+    for event in events:
+        try:
+            handler(event)
+        except Exception as e:
+            logger.exception("Failed processing %s" % event.key)
+            failures.append((event, e))
+    return failures
+
+
+def process_events(events, handler, max_workers=None):
+    """
+    Call handler(event) for each event, using up to max_workers threads.
+    Events sharing a bucket and key run serially, in their original order.
+    Raises EventProcessingError after all events are tried if any failed.
+    """
+    groups = OrderedDict()
+    for event in events:
+        groups.setdefault((event.bucket, event.key), []).append(event)
+
+    workers = min(max_workers or default_max_workers, len(groups))
+    if workers <= 1:
+        failures = _run_serially(handler, events)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(lambda group: _run_serially(handler, group),
+                               groups.values())
+            failures = [failure for result in results for failure in result]
+
+    if failures:
+        raise EventProcessingError(failures)
+
+
+def handle_message(message, handler, archivists=None, max_workers=None):
+    """
+    Call handler(archivist, event) for each S3 event in a Lambda message,
+    concurrently, as process_events does. archivists is a dict of bucket ->
+    archivist, to which one S3archivist per new bucket is added; pass one in
+    to use the archivists afterward. Returns the events.
+    """
+    from bluebucket.archivist import S3archivist, parse_aws_event
+    events = parse_aws_event(message, coalesce=True)
+    if not events:
+        logger.warn("No events found in message!\n%s" % message)
+    if archivists is None:
+        archivists = {}
+    # boto3 clients are thread safe, but creating them is not, so archivists
+    # are created up front and shared by the workers.
+    for bucket in set(event.bucket for event in events):
+        if bucket not in archivists:
+            archivists[bucket] = S3archivist(bucket)
+
+    def handle(event):
+        archivist = archivists[event.bucket]
+        archivist.record_event(event)
+        handler(archivist, event)
+
+    process_events(events, handle, max_workers=max_workers)
+    return events
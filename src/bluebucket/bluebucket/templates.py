@@ -0,0 +1,212 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Precompiled template bundles.
+
+Loading a template from S3 costs a GET, and Jinja must then compile it. A
+template bundle is a zip of every site template compiled to a Python module
+(as Jinja's `compile_templates` does), stored in the archive at
+`_A/_template_bundle.zip`. Its manifest records the ETag of each template
+source it was compiled from, the Jinja version, and the Python version.
+
+Sites opt in with the siteconfig setting `use_template_bundle`, and build the
+bundle with `quill compile-templates` whenever templates change. When
+loading, the bundle's manifest is checked against one listing of the
+template directory. Templates whose source has changed since the bundle was
+built are not served from it, so they fall through to the S3 loader.
+
+`templates_used` reports the version of a template and every template it
+extends, includes or imports, so that renderers can tell whether their output
+could have changed.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from bluebucket.archivist import is_missing
+from io import BytesIO
+from jinja2 import Environment, ModuleLoader, TemplateNotFound
+from jinja2 import meta
+import jinja2
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import zipfile
+
+logger = logging.getLogger(__name__)
+bundle_format = 1
+manifest_name = 'manifest.json'
+_references = {}  # (name, version) -> names referenced, or None
+_references_lock = threading.Lock()
+
+
+def bundle_key(archivist):
+    return archivist.pathstrategy.path_for(resourcetype='config',
+                                           key='_template_bundle.zip')
+
+
+def template_prefix(archivist):
+    template_dir = archivist.siteconfig.get('template_dir', '_templates')
+    return template_dir.rstrip('/') + '/'
+
+
+def template_versions(archivist):
+    "Return a dict of template name -> ETag of its source in the archive."
+    prefix = template_prefix(archivist)
+    return dict((key[len(prefix):], etag)
+                for (key, etag) in archivist.list_etags(prefix).items()
+                if not key.endswith('/'))
+
+
+def runtime():
+    "What compiled templates depend on, besides their source."
+    return {"format": bundle_format, "jinja": jinja2.__version__,
+            "python": "%d.%d" % sys.version_info[:2]}
+
+
+def build_bundle(archivist, extensions=()):
+    """
+    Compile every template in the archivist's template directory and save
+    the bundle in the archive. Returns the manifest. extensions are the Jinja
+    extensions the templates are rendered with.
+    """
+    env = Environment(extensions=extensions)
+    prefix = template_prefix(archivist)
+    versions = template_versions(archivist)
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for name in sorted(versions):
+            source = archivist.get(prefix + name).text
+            code = env.compile(source, name, prefix + name, raw=True,
+                               defer_init=True)
+            bundle.writestr(ModuleLoader.get_module_filename(name),
+                            code.encode('utf-8'))
+        manifest = dict(runtime(), templates=versions)
+        bundle.writestr(manifest_name,
+                        json.dumps(manifest, sort_keys=True).encode('utf-8'))
+    resource = archivist.new_resource(bundle_key(archivist),
+                                      content=buf.getvalue(),
+                                      contenttype='application/zip',
+                                      resourcetype='config')
+    archivist.save(resource)
+    logger.info("Compiled %d templates into %s" %
+                (len(versions), resource.key))
+    return manifest
+
+
+class BundleLoader(ModuleLoader):
+    "A ModuleLoader that does not serve the templates named in `stale`."
+    def __init__(self, path, stale=()):
+        super(BundleLoader, self).__init__(path)
+        self.stale = set(stale)
+
+    def load(self, environment, name, globals=None):
+        if name in self.stale:
+            raise TemplateNotFound(name)
+        return super(BundleLoader, self).load(environment, name, globals)
+
+
+def load_bundle(archivist, directory=None):
+    """
+    Fetch the archive's template bundle and return a BundleLoader for it, or
+    None if there is no usable bundle. The bundle is written to `directory`
+    (default, a new temporary directory) so it can be imported from.
+    """
+    try:
+        content = archivist.get(bundle_key(archivist)).content
+    except Exception as e:
+        if not is_missing(e):
+            raise
+        return None
+    try:
+        manifest = json.loads(
+            zipfile.ZipFile(BytesIO(content)).read(manifest_name)
+            .decode('utf-8'))
+    except (zipfile.BadZipfile, KeyError, ValueError):
+        logger.warn("Ignoring unreadable template bundle")
+        return None
+    built_for = dict((k, manifest.get(k)) for k in runtime())
+    if built_for != runtime():
+        logger.warn("Ignoring template bundle built for %s" % built_for)
+        return None
+
+    current = template_versions(archivist)
+    stale = [name for (name, version) in manifest['templates'].items()
+             if current.get(name) != version]
+    if stale:
+        logger.info("Templates changed since the bundle was built: %s" %
+                    ", ".join(sorted(stale)))
+    directory = directory or tempfile.mkdtemp(prefix='templates')
+    filename = os.path.join(directory, 'bundle.zip')
+    with open(filename, 'wb') as f:
+        f.write(content)
+    return BundleLoader(filename, stale=stale)
+
+
+#######################################################################
+# Template dependencies
+#######################################################################
+def template_source(archivist, name):
+    "Return the source of a template, from a loader that can provide it."
+    loader = archivist.jinja.loader
+    for loader in getattr(loader, 'loaders', [loader]):
+        if not loader.has_source_access:
+            continue  # e.g. the bundle
+        try:
+            return loader.get_source(archivist.jinja, name)[0]
+        except TemplateNotFound:
+            continue
+    raise TemplateNotFound(name)
+
+
+def referenced_templates(archivist, name, version):
+    """
+    Return the names of the templates that template name (at version)
+    extends, includes or imports, or None if any of them is chosen at
+    runtime. Remembered per version, so each version is parsed once.
+    """
+    with _references_lock:
+        if (name, version) in _references:
+            return _references[(name, version)]
+    ast = archivist.jinja.parse(template_source(archivist, name))
+    names = list(meta.find_referenced_templates(ast))
+    refs = None if None in names else sorted(set(names))
+    with _references_lock:
+        _references[(name, version)] = refs
+    return refs
+
+
+def templates_used(archivist, name, versions=None):
+    """
+    Return a dict of name -> version for template name and every template it
+    uses, directly or not. If any is chosen at runtime, returns the versions
+    of all templates, since any of them could be used.
+    """
+    if versions is None:
+        versions = template_versions(archivist)
+    used = {}
+    pending = [name]
+    while pending:
+        name = pending.pop()
+        if name in used or name not in versions:
+            continue
+        used[name] = versions[name]
+        refs = referenced_templates(archivist, name, versions[name])
+        if refs is None:
+            return dict(versions)
+        pending.extend(refs)
+    return used
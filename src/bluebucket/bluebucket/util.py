@@ -15,12 +15,18 @@
 #   limitations under the License.
 #
 from __future__ import absolute_import, print_function, unicode_literals
+from collections import OrderedDict
+from dateutil.parser import parse as parse_date
+from dateutil.tz import tzoffset, tzutc
 import datetime
 from gzip import GzipFile
 from io import BytesIO
 import json
 import posixpath as path
+import re
 import slugify as sluglib
+import threading
+import zlib
 
 
 class SmartJSONEncoder(json.JSONEncoder):
@@ -46,6 +52,77 @@ class SmartJSONEncoder(json.JSONEncoder):
             return super(SmartJSONEncoder, self).default(o)
 
 
+# Well formed ISO-8601 / RFC 3339 dates and date-times, which are nearly all
+# of the dates we see, are parsed with a regex. Anything else goes to dateutil.
+_iso_datetime = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)'
+    r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:[.,](\d+))?)?'
+    r'\s*(Z|[+-]\d\d(?::?\d\d)?)?)?$', re.IGNORECASE)
+_utc = tzutc()
+_datetime_cache = OrderedDict()
+_datetime_cache_size = 1024
+_datetime_cache_lock = threading.Lock()
+
+
+def _parse_iso(text):
+    m = _iso_datetime.match(text)
+    if m is None:
+        return None
+    (year, month, day, hour, minute, second, fraction, zone) = m.groups()
+    fraction = (fraction or '')[:6]
+    micro = int(fraction + '0' * (6 - len(fraction)))
+    tzinfo = None
+    if zone:
+        if zone in 'Zz':
+            tzinfo = _utc
+        else:
+            sign = -1 if zone[0] == '-' else 1
+            zone = zone[1:].replace(':', '')
+            offset = sign * (int(zone[:2]) * 3600 + int(zone[2:] or 0) * 60)
+            tzinfo = _utc if offset == 0 else tzoffset(None, offset)
+    try:
+        return datetime.datetime(int(year), int(month), int(day),
+                                 int(hour or 0), int(minute or 0),
+                                 int(second or 0), micro, tzinfo)
+    except ValueError:
+        return None  # e.g. month 13, let dateutil decide what was meant
+
+
+def parse_datetime(text):
+    """
+    Parse a date or date-time string to a datetime. ISO-8601 input takes a
+    fast path; anything else is parsed by dateutil. Results are cached, as
+    the same timestamps tend to be parsed over and over. Naive input gives a
+    naive datetime. Raises ValueError if the text cannot be parsed.
+    """
+    with _datetime_cache_lock:
+        dt = _datetime_cache.get(text)
+    if dt is not None:
+        return dt
+    dt = _parse_iso(text.strip())
+    if dt is None:
+        dt = parse_date(text)
+    # datetimes are immutable, so the cached object can be shared
+    with _datetime_cache_lock:
+        _datetime_cache[text] = dt
+        if len(_datetime_cache) > _datetime_cache_size:
+            _datetime_cache.popitem(last=False)
+    return dt
+
+
+def normalize_datetime(text, timezone):
+    """
+    Parse a date or date-time string and return it as an aware datetime in
+    timezone. Naive input is taken to be local to timezone.
+    """
+    dt = parse_datetime(text)
+    if dt.tzinfo:
+        return dt.astimezone(timezone)
+    if hasattr(timezone, 'localize'):  # pytz
+        return timezone.localize(dt)
+    return dt.replace(tzinfo=timezone)
+
+
 def change_ext(key, ext):
     if not ext.startswith('.'):
         ext = '.' + ext
@@ -60,6 +137,33 @@ def gzip(content, filename=None, compresslevel=9, mtime=None):
     return gzbuffer.getvalue()
 
 
+def gzip_stream(chunks, compresslevel=9):
+    "Yield the gzip compressed form of an iterable of bytes, incrementally."
+    # wbits offset of 16 tells zlib to write a gzip header and trailer
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def rechunk(chunks, size):
+    "Join an iterable of small bytestrings into chunks of at least size bytes."
+    buf = []
+    buffered = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield b''.join(buf)
+            buf = []
+            buffered = 0
+    if buf:
+        yield b''.join(buf)
+
+
 def gunzip(gzcontent):
     gzbuffer = BytesIO(gzcontent)
     return GzipFile(None, 'rb', fileobj=gzbuffer).read()
@@ -0,0 +1,30 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2015 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+import pytest
+
+
+@pytest.fixture
+def tmpdir_path(tmpdir):
+    "An empty temporary directory, as a path string."
+    return str(tmpdir)
+
+
+@pytest.fixture
+def testbucket(tmpdir_path):
+    "An empty local bucket, for a localarchivist."
+    return tmpdir_path
@@ -0,0 +1,123 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+from datetime import datetime
+from dateutil.tz import tzutc
+from bluebucket import assets, caching
+from bluebucket.archivist.base import Resource
+from bluebucket.archivist.local import localarchivist
+import pytest
+
+immutable = 'public, max-age=31536000, immutable'
+policy = [{"resourcetype": "asset", "fingerprinted": True,
+           "cache_control": immutable},
+          {"resourcetype": "asset", "cache_control": "max-age=3600"},
+          {"contenttype": "text/html", "cache_control": "max-age=300"}]
+
+
+@pytest.fixture
+def archivist(tmpdir_path):
+    bucket = tmpdir_path
+    return localarchivist(bucket, siteconfig={"fingerprint_assets": True,
+                                              "cache_control": policy})
+
+
+def css(archivist, text, key='css/site.css'):
+    return archivist.new_resource(key, content=text, contenttype='text/css',
+                                  resourcetype='asset')
+
+
+# Given a cache_control policy
+# When it is applied to resources
+# Then each gets the headers of the first rule that matches it
+def test_apply_policy():
+    page = Resource(contenttype='text/html; charset=utf-8',
+                    resourcetype='artifact')
+    caching.apply_policy({"cache_control": policy}, page)
+    assert page.cachecontrol == 'max-age=300'
+    assert page.expires is None
+
+    asset = Resource(contenttype='image/png', resourcetype='asset')
+    caching.apply_policy({"cache_control": policy}, asset)
+    assert asset.cachecontrol == 'max-age=3600'
+
+    custom = Resource(contenttype='text/html', cachecontrol='no-store')
+    caching.apply_policy({"cache_control": policy}, custom)
+    assert custom.cachecontrol == 'no-store'
+
+    config = Resource(contenttype='application/json', resourcetype='config')
+    caching.apply_policy({"cache_control": policy}, config)
+    assert config.cachecontrol is None
+
+
+# Given a page stored under an older policy, with a stale Expires date
+# When it is read and saved again, and again with a header set explicitly
+# Then the current policy replaces the stored headers, but not the new one
+def test_policy_applies_on_resave(archivist):
+    archivist.siteconfig['cache_control'] = [
+        {"contenttype": "text/html", "cache_control": "max-age=60"}]
+    page = archivist.new_resource('page.html', content=b'<p>',
+                                  contenttype='text/html; charset=utf-8',
+                                  resourcetype='artifact', archetype_guid='x')
+    page.expires = datetime(2016, 7, 4, tzinfo=tzutc())
+    archivist.save(page)
+    assert archivist.head('page.html').cachecontrol == 'max-age=60'
+    assert archivist.head('page.html').expires
+
+    archivist.siteconfig['cache_control'] = policy
+    archivist.save(archivist.get('page.html'))
+    stored = archivist.head('page.html')
+    assert stored.cachecontrol == 'max-age=300'
+    assert stored.expires is None
+
+    page = archivist.get('page.html')
+    page.cachecontrol = 'no-store'
+    archivist.save(page)
+    assert archivist.head('page.html').cachecontrol == 'no-store'
+
+
+# Given a site that fingerprints assets
+# When an asset is saved, unchanged, and changed
+# Then it is stored under a key with its content hash, the manifest maps
+# the asset key to the latest one, and it is cached as immutable
+def test_save_asset_fingerprinted(archivist):
+    first = assets.save_asset(archivist, css(archivist, b'body {}'))
+    assert first.startswith('css/site.') and first.endswith('.css')
+    assert first != 'css/site.css'
+    assert assets.save_asset(archivist, css(archivist, b'body {}')) == first
+
+    second = assets.save_asset(archivist, css(archivist, b'p {}'))
+    assert second != first
+    assert archivist.get(first).content == b'body {}'  # still served
+    assert assets.load_manifest(archivist) == {'css/site.css': second}
+    assert assets.asset_url(assets.load_manifest(archivist),
+                            '/css/site.css') == '/' + second
+    assert assets.asset_url({}, 'js/app.js') == '/js/app.js'
+
+    stored = archivist.head(second)
+    assert stored.cachecontrol == immutable
+    assert stored.metadata['asset_key'] == 'css/site.css'
+
+
+# Given a site that does not fingerprint assets
+# When an asset is saved
+# Then it is stored under its own key, with the plain asset policy
+def test_save_asset_plain(archivist):
+    archivist.siteconfig['fingerprint_assets'] = False
+    assert assets.save_asset(archivist, css(archivist, b'x')) == 'css/site.css'
+    assert assets.load_manifest(archivist) == {}
+    assert archivist.head('css/site.css').cachecontrol == 'max-age=3600'
@@ -0,0 +1,187 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+from io import open
+import os
+import os.path as path
+from bluebucket.archivist.local import localarchivist
+from webquills import batch
+from webquills.indexer import depends
+import pytest
+
+template = """Title: Post %(n)d
+Itemtype: Item/Page/Article
+Guid: 00000000-0000-0000-0000-%(n)012d
+Updated: 2016-07-04T12:00:00Z
+Category: test
+
+Body of post %(n)d.
+"""
+
+
+@pytest.fixture
+def tree(tmpdir_path):
+    root = tmpdir_path
+    sources = path.join(root, 'sources')
+    for n in range(5):
+        folder = path.join(sources, 'year%d' % (n % 2))
+        if not path.exists(folder):
+            os.makedirs(folder)
+        with open(path.join(folder, '%d.md' % n), 'w', encoding='utf-8') as f:
+            f.write(template % {"n": n})
+    with open(path.join(sources, 'broken.md'), 'w', encoding='utf-8') as f:
+        f.write('Title: No dates\n\nBody.\n')
+    return root
+
+
+def check(archivist, report):
+    assert report.succeeded == 5
+    assert len(report.failures) == 1
+    assert report.failures[0][0].endswith('broken.md')
+    keys = archivist.list_keys('_A/Item/Page/Article/')
+    assert len(keys) == 5
+    archetype = archivist.get(keys[0]).data
+    assert archetype['Item']['title'] == 'Post 0'
+
+
+# Given a directory tree of markdown files, one of them broken
+# When convert() is called in process
+# Then the good ones are saved as archetypes and the broken one is reported
+def test_convert_directory(tree):
+    archivist = localarchivist(path.join(tree, 'bucket'), siteconfig={})
+    report = batch.convert(archivist, path.join(tree, 'sources'),
+                           max_workers=1, batch_size=2)
+    check(archivist, report)
+    assert report.rate > 0
+
+
+# Given a directory tree of markdown files
+# When convert() is called with a process pool
+# Then the results are the same
+def test_convert_process_pool(tree):
+    archivist = localarchivist(path.join(tree, 'bucket'), siteconfig={})
+    report = batch.convert(archivist, path.join(tree, 'sources'),
+                           max_workers=2, batch_size=2)
+    check(archivist, report)
+
+
+@pytest.fixture
+def site(tree):
+    root = path.join(tree, 'bucket')
+    os.makedirs(path.join(root, '_templates'))
+    with open(path.join(root, '_templates', 'page.html'), 'w',
+              encoding='utf-8') as f:
+        f.write('<h1>{{ Item.title }}</h1>')
+    archivist = localarchivist(root,
+                               siteconfig={"default_template": "page.html"})
+    batch.convert(archivist, path.join(tree, 'sources'), max_workers=1)
+    return archivist
+
+
+def html_keys(archivist):
+    return [k for k in archivist.list_keys('') if k.endswith('.html') and
+            not k.startswith(('_templates/', '_A/'))]
+
+
+# Given a bucket of archetypes
+# When rebuild() is called with a process pool
+# Then every archetype is rendered to HTML
+def test_rebuild_all(site):
+    report = batch.rebuild(site, max_workers=2, batch_size=2)
+    assert report.succeeded == 5
+    assert report.failures == []
+    keys = html_keys(site)
+    assert len(keys) == 5
+    assert site.get(keys[0]).text.startswith('<h1>Post ')
+
+
+# Given a bucket of archetypes
+# When rebuild() is called with filters that match only some items
+# Then only those are rendered
+def test_rebuild_filters(site):
+    filters = batch.Filters(itemtype='Item/Page/Article', category='test',
+                            since='2016-07-04T12:00:00Z')
+    report = batch.rebuild(site, filters=filters, max_workers=1)
+    assert report.succeeded == 5
+
+    filters = batch.Filters(category='other')
+    report = batch.rebuild(site, filters=filters, max_workers=1)
+    assert report.succeeded == 0
+    assert report.skipped == 5
+
+    filters = batch.Filters(since='2016-07-05')
+    report = batch.rebuild(site, filters=filters, max_workers=1)
+    assert report.succeeded == 0
+    assert report.skipped == 5
+
+
+# Given filters with a since date
+# When items with aware, naive and no updated times are matched
+# Then times are compared in UTC, naive ones taken in the site timezone, and
+# undated items match
+def test_filters_since():
+    import pytz
+    eastern = pytz.timezone('US/Eastern')
+    filters = batch.Filters(since='2016-07-04T12:00:00Z')
+    assert filters.match({"updated": "2016-07-04T08:00:00-04:00"})
+    assert not filters.match({"updated": "2016-07-04T07:59:00-04:00"})
+    assert filters.match({"updated": "2016-07-04T08:00:00"}, eastern)
+    assert not filters.match({"updated": "2016-07-04T08:00:00"})
+    assert filters.match({"title": "undated"})
+    naive = batch.Filters(since='2016-07-04T08:00:00')
+    assert naive.match({"updated": "2016-07-04T12:00:00Z"}, eastern)
+    with pytest.raises(ValueError):
+        batch.Filters(since='not a date')
+
+
+# Given a rebuild with filters that match only some items
+# When it is checkpointed
+# Then only the keys rendered are recorded
+def test_rebuild_checkpoint_filtered(site, tree):
+    checkpoint = path.join(tree, 'checkpoint')
+    report = batch.rebuild(site, filters=batch.Filters(category='other'),
+                           max_workers=1, checkpoint=checkpoint)
+    assert report.skipped == 5
+    assert batch.read_checkpoint(checkpoint) == set()
+
+
+# Given a checkpoint file from an interrupted rebuild
+# When rebuild() is called again with it
+# Then the items recorded there are skipped
+def test_rebuild_checkpoint(site, tree):
+    checkpoint = path.join(tree, 'checkpoint')
+    keys = site.list_keys('_A/Item/Page/Article/')
+    with open(checkpoint, 'w', encoding='utf-8') as f:
+        f.write('%s\n%s\n' % (keys[0], keys[1]))
+    report = batch.rebuild(site, max_workers=1, checkpoint=checkpoint)
+    assert report.succeeded == 3
+    assert report.skipped == 2
+    assert batch.read_checkpoint(checkpoint) == set(keys)
+
+
+# Given pages whose template use has been recorded
+# When rebuild() is called with a template only some of them use
+# Then only those pages are rendered
+def test_rebuild_template(site):
+    batch.rebuild(site, max_workers=1)
+    keys = site.list_keys('_A/Item/Page/Article/')
+    depends.forget_templates(site, keys[0])
+
+    filters = batch.Filters(templates=['page.html'])
+    report = batch.rebuild(site, filters=filters, max_workers=1)
+    assert report.succeeded == 4
+    assert batch.Filters(templates=['other.html']).keys(site) == []
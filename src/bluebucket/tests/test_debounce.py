@@ -0,0 +1,110 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+import datetime
+from dateutil.tz import tzutc
+from bluebucket.archivist.local import localarchivist
+from webquills.indexer import debounce
+
+catalog_key = '_A/Item/Page/Catalog/news.json'
+now = datetime.datetime(2016, 7, 4, 12, 0, tzinfo=tzutc())
+
+
+def make_archivist(testbucket, window):
+    archivist = localarchivist(testbucket,
+                               siteconfig={"catalog_render_window": window})
+    catalog = archivist.new_resource(catalog_key, data={"Item": {}},
+                                     contenttype='application/json',
+                                     resourcetype='archetype')
+    archivist.save(catalog)
+    return archivist
+
+
+# Given a site without a render window
+# When catalogs are scheduled
+# Then they are rendered immediately
+def test_schedule_without_window(testbucket):
+    archivist = make_archivist(testbucket, 0)
+    render = mock.Mock()
+    rendered = debounce.schedule_catalogs(archivist, [catalog_key], render)
+    assert rendered == [catalog_key]
+    assert render.call_count == 1
+
+
+# Given a site with a 60 second render window
+# When a catalog is invalidated repeatedly
+# Then it is rendered once, after the window closes
+def test_pending_catalog_rendered_once(testbucket):
+    archivist = make_archivist(testbucket, 60)
+    render = mock.Mock()
+    later = now + datetime.timedelta(seconds=30)
+    assert debounce.schedule_catalogs(archivist, [catalog_key], render,
+                                      now=now) == []
+    # invalidating again does not push the due time back
+    assert debounce.mark_pending(archivist, [catalog_key], now=later) == []
+    assert debounce.flush_due(archivist, render, now=later) == []
+    closed = now + datetime.timedelta(seconds=61)
+    assert debounce.flush_due(archivist, render, now=closed) == [catalog_key]
+    assert debounce.flush_due(archivist, render, now=closed) == []
+    assert render.call_count == 1
+
+
+# Given two pending catalogs, the first of which fails to render
+# When the due catalogs are flushed
+# Then the second is still rendered and the first is marked pending again
+def test_flush_due_continues_past_failure(testbucket):
+    archivist = make_archivist(testbucket, 60)
+    other_key = '_A/Item/Page/Catalog/other.json'
+    archivist.save(archivist.new_resource(other_key, data={"Item": {}},
+                                          contenttype='application/json',
+                                          resourcetype='archetype'))
+    debounce.mark_pending(archivist, [catalog_key, other_key], now=now)
+    render = mock.Mock(side_effect=[ValueError("broken"), None])
+    failures = []
+    closed = now + datetime.timedelta(seconds=61)
+
+    rendered = debounce.flush_due(archivist, render, now=closed,
+                                  failures=failures)
+
+    assert render.call_count == 2
+    assert len(rendered) == 1
+    assert [key for (key, e) in failures] == \
+        [k for k in (catalog_key, other_key) if k not in rendered]
+    assert debounce.flush_due(archivist, mock.Mock(), now=closed) == []
+    retried = closed + datetime.timedelta(seconds=61)
+    assert debounce.flush_due(archivist, mock.Mock(), now=retried) == \
+        [failures[0][0]]
+
+
+# Given a debouncer
+# When the same catalog is added several times
+# Then flush renders it once
+def test_debouncer_coalesces(testbucket):
+    archivist = make_archivist(testbucket, 0)
+    render = mock.Mock()
+    debouncer = debounce.CatalogDebouncer(render, window=3600)
+    debouncer.add(archivist, [catalog_key])
+    debouncer.add(archivist, [catalog_key])
+    assert debouncer.flush() == [catalog_key]
+    assert debouncer.flush() == []
+    assert render.call_count == 1
+    assert debouncer.failures == []
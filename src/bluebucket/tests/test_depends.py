@@ -0,0 +1,158 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+from bluebucket.archivist.local import localarchivist
+from webquills.indexer import depends
+
+blog = 'test-bucket|Item/Page/Article'
+query = {
+    "TableName": depends.item_table,
+    "KeyConditionExpression":
+        "bucket_itemclass = :itemclass AND begins_with(updated_guid, :year)",
+    "ExpressionAttributeValues": {
+        ":itemclass": {"S": blog},
+        ":year": {"S": "2016"},
+    },
+}
+
+
+def record(updated, itemclass=blog, key='_A/Item/Page/Article/a.json'):
+    return {"bucket_itemclass": itemclass, "updated_guid": updated,
+            "s3key": key}
+
+
+def test_query_dependency():
+    (dependency, detail) = depends.query_dependency(query)
+    assert dependency == blog
+    assert detail == {"conditions": [["updated_guid", "begins_with",
+                                      ["2016"]]],
+                      "filtered": False}
+    assert depends.query_dependency({"TableName": "other"}) == (None, None)
+
+
+def test_query_dependency_unpinned():
+    q = {"IndexName": "category",
+         "KeyConditionExpression": "#c = :c",
+         "ExpressionAttributeNames": {"#c": "category_updated_guid"},
+         "ExpressionAttributeValues": {":c": {"S": "news"}}}
+    (dependency, detail) = depends.query_dependency(q)
+    assert dependency == depends.ANY
+    assert detail["conditions"] == [["category_updated_guid", "=", ["news"]]]
+
+
+def test_could_match():
+    (_, detail) = depends.query_dependency(query)
+    assert depends.could_match(detail, record('2016-07-04|guid'))
+    assert not depends.could_match(detail, record('2015-07-04|guid'))
+    between = {"conditions": [["rank", "between", [1.0, 5.0]]]}
+    assert depends.could_match(between, {"rank": "3"})
+    assert not depends.could_match(between, {"rank": "7"})
+
+
+# Given a catalog that recorded its query
+# When an item in the partition is saved
+# Then only catalogs whose conditions match the old or new record render
+def test_invalidate_catalogs(testbucket):
+    archivist = localarchivist(testbucket, siteconfig={})
+    catalog_key = '_A/Item/Page/Catalog/2016.json'
+    depends.record_catalog(archivist, catalog_key, query)
+    catalog = archivist.new_resource(catalog_key, data={"Item": {}},
+                                     contenttype='application/json',
+                                     resourcetype='archetype')
+    archivist.save(catalog)
+    render = mock.Mock()
+
+    # an item outside the catalog's range does not affect it
+    rendered = depends.invalidate_catalogs(
+        archivist, [record('2015-01-01|guid'), None], render)
+    assert rendered == []
+    # an item moved out of the range still affects it (old record matches)
+    rendered = depends.invalidate_catalogs(
+        archivist, [record('2015-01-01|guid'), record('2016-01-01|guid')],
+        render)
+    assert rendered == [catalog_key]
+    assert render.call_count == 1
+    # items in other partitions never do
+    other = record('2016-01-01|guid', itemclass='test-bucket|Item/Page/Other')
+    assert depends.affected_catalogs(archivist, [other]) == []
+
+
+# Given a recorded catalog that has since been removed
+# When an item in its partition changes
+# Then the catalog is forgotten instead of rendered
+def test_invalidate_forgets_missing_catalog(testbucket):
+    archivist = localarchivist(testbucket, siteconfig={})
+    catalog_key = '_A/Item/Page/Catalog/gone.json'
+    depends.record_catalog(archivist, catalog_key, query)
+    render = mock.Mock()
+    records = [record('2016-01-01|guid')]
+    assert depends.invalidate_catalogs(archivist, records, render) == []
+    assert not render.called
+    assert depends.affected_catalogs(archivist, records) == []
+
+
+# Given pages that use templates
+# When the templates each page uses are recorded, and then change
+# Then template_dependents reports the pages using each template
+def test_record_templates(testbucket):
+    archivist = localarchivist(testbucket, siteconfig={})
+    post = '_A/Item/Page/Article/a.json'
+    home = '_A/Item/Page/Catalog/home.json'
+    depends.record_templates(archivist, post, ['article.html', 'base.html'])
+    depends.record_templates(archivist, home, ['catalog.html', 'base.html'])
+    assert depends.template_dependents(archivist, 'base.html') == [post, home]
+    assert depends.template_dependents(archivist, 'article.html') == [post]
+
+    depends.record_templates(archivist, post, ['page.html', 'base.html'])
+    assert depends.template_dependents(archivist, 'article.html') == []
+    assert depends.template_dependents(archivist, 'page.html') == [post]
+
+    depends.forget_templates(archivist, home)
+    assert depends.template_dependents(archivist, 'base.html') == [post]
+
+
+# Given templates already recorded for a page
+# When the same templates are recorded again
+# Then nothing is written
+def test_record_templates_unchanged(testbucket):
+    archivist = localarchivist(testbucket, siteconfig={})
+    post = '_A/Item/Page/Article/a.json'
+    depends.record_templates(archivist, post, ['base.html'])
+    with mock.patch.object(archivist, 'save') as save:
+        depends.record_templates(archivist, post, ['base.html'])
+    assert not save.called
+
+
+# Given two processes recording dependents of the same dependency
+# When each adds its own dependent
+# Then neither record is lost, and removing a missing record is harmless
+def test_dependency_index_concurrent_adds(testbucket):
+    one = depends.DependencyIndex(
+        localarchivist(testbucket, siteconfig={}), 'test')
+    two = depends.DependencyIndex(
+        localarchivist(testbucket, siteconfig={}), 'test')
+    one.add(blog, 'a', {"n": 1})
+    two.add(blog, 'b')
+    assert one.dependents(blog) == {'a': {"n": 1}, 'b': {}}
+    one.remove(blog, 'a')
+    two.remove(blog, 'a')
+    assert two.names(blog) == ['b']
@@ -0,0 +1,111 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+import threading
+import time
+from bluebucket.archivist import S3event
+from bluebucket.dispatch import process_events, EventProcessingError
+from bluebucket.dispatch import handle_message
+import pytest
+import stubs
+
+
+def make_event(key):
+    return S3event(stubs.generate_event(key=key)['Records'][0])
+
+
+# Given a batch of events for different keys
+# When process_events() is called
+# Then every event is handled, using more than one thread
+def test_process_events_concurrently():
+    events = [make_event('%d.md' % i) for i in range(6)]
+    seen = []
+    threads = set()
+    lock = threading.Lock()
+
+    def handler(event):
+        time.sleep(0.01)
+        with lock:
+            seen.append(event.key)
+            threads.add(threading.current_thread().ident)
+
+    process_events(events, handler, max_workers=3)
+    assert sorted(seen) == sorted(e.key for e in events)
+    assert len(threads) > 1
+
+
+# Given a batch with several events for the same key
+# When process_events() is called
+# Then the events for that key are handled in order
+def test_process_events_same_key_in_order():
+    events = [make_event('a.md') for i in range(5)]
+    for i, event in enumerate(events):
+        event.sequencer = '%02d' % i
+    seen = []
+
+    def handler(event):
+        time.sleep(0.001)
+        if event.key == 'a.md':
+            seen.append(event.sequencer)
+
+    process_events(events + [make_event('b.md')], handler, max_workers=4)
+    assert seen == ['00', '01', '02', '03', '04']
+
+
+# Given a batch where one document fails
+# When process_events() is called
+# Then the other documents are still handled
+# And the failure is reported afterward
+def test_process_events_collects_failures():
+    events = [make_event('good1.md'), make_event('bad.md'),
+              make_event('good2.md')]
+    seen = []
+
+    def handler(event):
+        if event.key == 'bad.md':
+            raise ValueError("bad document")
+        seen.append(event.key)
+
+    with pytest.raises(EventProcessingError) as einfo:
+        process_events(events, handler)
+    assert sorted(seen) == ['good1.md', 'good2.md']
+    assert len(einfo.value.failures) == 1
+    assert einfo.value.failures[0][0].key == 'bad.md'
+
+
+# Given a Lambda message of S3 events, and an archivist for their bucket
+# When handle_message() is called
+# Then each event is handled with the archivist for its bucket
+def test_handle_message():
+    message = {"Records": stubs.generate_event(key='a.md')['Records'] +
+               stubs.generate_event(key='b.md')['Records']}
+    archivist = mock.Mock()
+    archivists = {"bluebucket.mindvessel.net": archivist}
+    seen = []
+
+    def handler(arch, event):
+        seen.append((arch, event.key))
+
+    events = handle_message(message, handler, archivists=archivists)
+    assert sorted(seen) == [(archivist, 'a.md'), (archivist, 'b.md')]
+    assert len(events) == 2
+    assert archivist.record_event.call_count == 2
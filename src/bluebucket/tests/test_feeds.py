@@ -0,0 +1,204 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+from bluebucket.archivist.local import localarchivist
+from webquills.indexer import feeds
+from xml.etree import ElementTree
+import pytest
+
+atom_ns = '{http://www.w3.org/2005/Atom}'
+sitemap_ns = '{%s}' % feeds.sitemap_ns
+siteconfig = {"title": "Test Site", "base_url": "http://example.com/",
+              "feed_size": 2,
+              "attribution": [{"role": "author", "name": "Site Author"}]}
+
+
+@pytest.fixture
+def archivist(tmpdir_path):
+    bucket = tmpdir_path
+    return localarchivist(bucket, siteconfig=dict(siteconfig))
+
+
+def save_item(archivist, n, updated='2016-07-0%dT12:00:00+00:00',
+              itemtype='Item/Page/Article'):
+    key = '_A/%s/%d.json' % (itemtype, n)
+    item = {"guid": "00000000-0000-4000-8000-%012d" % n,
+            "title": "Post <%d>" % n,
+            "itemtype": itemtype, "category": {"name": "test"},
+            "slug": "post-%d" % n, "contenttype": "text/html; charset=utf-8",
+            "updated": updated % n if '%' in updated else updated}
+    resource = archivist.new_resource(key, contenttype='application/json',
+                                      resourcetype='archetype')
+    resource.data = {"Item": item}
+    archivist.save(resource)
+    return archivist.get(key)
+
+
+def feed_ids(archivist):
+    feed = ElementTree.fromstring(archivist.get('feed.xml').content)
+    return [e.find(atom_ns + 'id').text
+            for e in feed.findall(atom_ns + 'entry')]
+
+
+def feed_entries(archivist):
+    feed = ElementTree.fromstring(archivist.get('feed.xml').content)
+    return [(e.find(atom_ns + 'title').text,
+             e.find(atom_ns + 'link').get('href'))
+            for e in feed.findall(atom_ns + 'entry')]
+
+
+def sitemap_urls(archivist):
+    index = ElementTree.fromstring(archivist.get('sitemap.xml').content)
+    urls = []
+    for loc in index.iter(sitemap_ns + 'loc'):
+        key = loc.text[len('http://example.com/'):]
+        shard = ElementTree.fromstring(archivist.get(key).content)
+        urls.extend(u.text for u in shard.iter(sitemap_ns + 'loc'))
+    return sorted(urls)
+
+
+# Given items saved one by one
+# When the feed is updated for each
+# Then the feed holds the newest feed_size items, escaped and linked
+def test_feed_keeps_newest(archivist):
+    for n in (1, 3, 2):
+        feeds.on_save(archivist, save_item(archivist, n))
+
+    assert feed_entries(archivist) == [
+        ('Post <3>', 'http://example.com/test/post-3.html'),
+        ('Post <2>', 'http://example.com/test/post-2.html')]
+    text = archivist.get('feed.xml').content.decode('utf-8')
+    assert '<title>Post &lt;3&gt;</title>' in text
+    assert '<name>Site Author</name>' in text
+    # quill new writes bare UUIDs; Atom ids must be URIs
+    assert feed_ids(archivist) == ['urn:uuid:00000000-0000-4000-8000-%012d' %
+                                   n for n in (3, 2)]
+
+
+# Given guids that are already URIs, and bare ones
+# When they are made Atom ids
+# Then only the bare ones become urn:uuid URIs
+def test_entry_id():
+    assert feeds.entry_id('urn:uuid:1234') == 'urn:uuid:1234'
+    assert feeds.entry_id('tag:example.com,2016:1') == 'tag:example.com,2016:1'
+    assert feeds.entry_id('02eb3153-6d45-4c96-8bcb-f7da85e69624') == \
+        'urn:uuid:02eb3153-6d45-4c96-8bcb-f7da85e69624'
+
+
+# Given two processes, each of which has loaded the feed state
+# When each saves a different item
+# Then neither item is lost from the feed or the sitemap
+def test_concurrent_updates(archivist):
+    other = localarchivist(archivist.bucket, siteconfig=dict(siteconfig))
+    first = save_item(archivist, 1)
+    second = save_item(other, 2)
+    real_list = feeds._list
+    calls = []
+
+    def interleaved(archivist, prefix):
+        # the second process saves once the first has listed its state
+        names = real_list(archivist, prefix)
+        if not calls:
+            calls.append(prefix)
+            feeds.on_save(other, second)
+        return names
+    with mock.patch.object(feeds, '_list', interleaved):
+        feeds.on_save(archivist, first)
+
+    titles = [t for (t, link) in feed_entries(archivist)]
+    assert titles == ['Post <2>', 'Post <1>']
+    assert len(sitemap_urls(archivist)) == 2
+
+
+# Given a full feed with a spare entry in its state
+# When an item in the feed is removed
+# Then the spare entry takes its place
+def test_feed_refills_on_remove(archivist):
+    for n in (1, 2, 3):
+        feeds.on_save(archivist, save_item(archivist, n))
+
+    feeds.on_remove(archivist, '_A/Item/Page/Article/3.json')
+
+    titles = [t for (t, link) in feed_entries(archivist)]
+    assert titles == ['Post <2>', 'Post <1>']
+
+
+# Given a feed
+# When a catalog, or an item older than the whole state, is saved
+# Then the feed is not written
+def test_feed_unchanged(archivist):
+    for n in (5, 6, 7, 8):
+        feeds.on_save(archivist, save_item(archivist, n))
+
+    old = save_item(archivist, 1)
+    catalog = save_item(archivist, 9, itemtype='Item/Page/Catalog')
+
+    assert not feeds.update_feed(archivist, old.key, old.data['Item'])
+    assert not feeds.update_feed(archivist, catalog.key,
+                                 catalog.data['Item'])
+
+
+# Given items saved and removed
+# When the sitemap is updated
+# Then the sitemap index points at shards listing the current items
+def test_sitemap_save_and_remove(archivist):
+    for n in (1, 2, 3):
+        feeds.on_save(archivist, save_item(archivist, n))
+    feeds.on_save(archivist, save_item(archivist, 9,
+                                       itemtype='Item/Page/Catalog'))
+    feeds.on_remove(archivist, '_A/Item/Page/Article/2.json')
+
+    assert sitemap_urls(archivist) == [
+        'http://example.com/test/post-%d.html' % n for n in (1, 3, 9)]
+
+
+# Given shards of at most 2 URLs
+# When a shard overflows, and then one more item is saved
+# Then the shard is split, and later only the affected shard is written
+def test_sitemap_shards(archivist):
+    with mock.patch.object(feeds, 'max_urls', 2):
+        for n in (1, 2, 3):
+            feeds.on_save(archivist, save_item(archivist, n))
+        shards = feeds.shard_prefixes(archivist)
+        assert '' not in shards
+        assert all(len(p) == 1 for p in shards)
+        assert not archivist.list_keys('sitemaps/sitemap-all')
+
+        item = save_item(archivist, 4)
+        written = feeds.update_sitemap(archivist, item.key, item.data['Item'])
+
+    assert written == [feeds._hash(item.key)[0]]
+    assert len(sitemap_urls(archivist)) == 4
+
+
+# Given a site whose feed state was lost
+# When rebuild is called
+# Then the feed and sitemaps are regenerated from the archive
+def test_rebuild(archivist):
+    for n in (1, 2, 3):
+        save_item(archivist, n)
+
+    feeds.rebuild(archivist)
+
+    titles = [t for (t, link) in feed_entries(archivist)]
+    assert titles == ['Post <3>', 'Post <2>']
+    assert len(sitemap_urls(archivist)) == 3
@@ -0,0 +1,123 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+from io import open
+import os
+import os.path as path
+from jinja2 import DictLoader, Environment
+from bluebucket.archivist.local import localarchivist
+from webquills.scribe import page_to_html
+from webquills.scribe.fragments import FragmentCacheExtension
+
+templates = {
+    'page.html': '{% cache "header", section %}<h1>{{ _site.title }} '
+                 '{{ count() }}</h1>{% endcache %}{{ body }}',
+}
+
+
+def environment(source=templates):
+    return Environment(loader=DictLoader(source),
+                       extensions=[FragmentCacheExtension])
+
+
+def counter():
+    calls = []
+
+    def count():
+        calls.append(1)
+        return len(calls)
+    return count
+
+
+# Given a template with a cached fragment
+# When it is rendered again with the same site and arguments
+# Then the fragment is reused, while the rest of the page is rendered
+def test_fragment_reused():
+    env = environment()
+    count = counter()
+    context = {"_site": {"title": "Site"}, "_template_version": "v1",
+               "section": "news", "count": count}
+    template = env.get_template('page.html')
+    assert template.render(context, body='one') == '<h1>Site 1</h1>one'
+    assert template.render(context, body='two') == '<h1>Site 1</h1>two'
+    assert env.fragment_cache.hits == 1
+
+
+# Given a cached fragment
+# When the siteconfig, an argument or the template version changes
+# Then the fragment is rendered again
+def test_fragment_key():
+    env = environment()
+    count = counter()
+    template = env.get_template('page.html')
+    context = {"_site": {"title": "Site"}, "_template_version": "v1",
+               "section": "news", "count": count}
+    template.render(context)
+    changes = [{"_site": {"title": "New"}}, {"section": "sports"},
+               {"_template_version": "v2"}]
+    for (n, change) in enumerate(changes, 2):
+        assert '%d</h1>' % n in template.render(dict(context, **change))
+
+
+# Given a cached fragment
+# When the fragment's source is edited
+# Then it is rendered again
+def test_fragment_source_edit():
+    count = counter()
+    context = {"_site": {}, "_template_version": "v1", "count": count}
+    original = environment()
+    original.get_template('page.html').render(context)
+    env = environment({'page.html':
+                       templates['page.html'].replace('h1', 'h2')})
+    env.fragment_cache = original.fragment_cache  # shared, as in a store
+    assert env.get_template('page.html').render(context) == '<h2> 2</h2>'
+    assert env.fragment_cache.hits == 0
+
+
+# Given no template version
+# When a template with a cached fragment is rendered
+# Then the fragment is rendered every time
+def test_fragment_without_version():
+    env = environment()
+    count = counter()
+    template = env.get_template('page.html')
+    template.render(_site={}, count=count)
+    assert template.render(_site={}, count=count) == '<h1> 2</h1>'
+
+
+# Given a site whose template caches its header
+# When pages are rendered by page_to_html
+# Then the header is rendered once and the pages are fingerprinted
+def test_page_to_html_fragments(tmpdir_path):
+    os.makedirs(path.join(tmpdir_path, '_templates'))
+    with open(path.join(tmpdir_path, '_templates', 'page.html'), 'w',
+              encoding='utf-8') as f:
+        f.write('{% cache "header" %}<h1>{{ _site.title }}</h1>{% endcache %}'
+                '{{ Item.title }}')
+    archivist = localarchivist(tmpdir_path, siteconfig={
+        "title": "Site", "default_template": "page.html"})
+    for n in range(2):
+        resource = archivist.new_resource(
+            '_A/%d.json' % n, contenttype='application/json',
+            resourcetype='archetype',
+            data={"Item": {"itemtype": "Item/Page/Article", "guid": "g%d" % n,
+                           "title": "Page %d" % n, "slug": "page-%d" % n,
+                           "category": {"name": "test"}}})
+        [page] = page_to_html.on_save(archivist, resource)
+        assert page.text == '<h1>Site</h1>Page %d' % n
+        assert page.metadata['fingerprint']
+    assert archivist.jinja.fragment_cache.hits == 1
@@ -0,0 +1,122 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+from markdown.extensions import codehilite
+from webquills.scribe import highlight
+from webquills.scribe.cache import DirectoryStore
+import webquills.scribe.markdown as mark
+import pytest
+
+snippet = """```python
+def answer():
+    return 42
+```
+"""
+indented = """Some code:
+
+    :::python
+    print("indented")
+"""
+
+
+# Given a fenced and an indented code block
+# When they appear in several documents
+# Then each block is highlighted by pygments only once
+def test_blocks_highlighted_once():
+    highlight.highlight_cache.clear()
+    hilite = highlight.CachedCodeHilite._hilite
+    calls = []
+
+    def counted(self):
+        calls.append(self.src)
+        return hilite(self)
+    with mock.patch.object(highlight.CachedCodeHilite, '_hilite', counted):
+        first = mark.convert('# One\n\n' + snippet + '\n' + indented)[0]
+        second = mark.convert('# Two\n\n' + indented + '\n' + snippet)[0]
+    assert len(calls) == 2
+    assert 'answer' in first and 'answer' in second
+    assert '<span class="k">def</span>' in first
+
+
+# Given a persistent store
+# When a fresh cache is used with it
+# Then highlighted blocks are found in the store
+def test_highlight_store(tmpdir_path):
+    store = DirectoryStore(tmpdir_path)
+    highlight.highlight_cache.clear()
+    with highlight.using_store(store):
+        html = mark.convert(snippet)[0]
+    highlight.highlight_cache.clear()
+    with mock.patch.object(highlight.CachedCodeHilite, '_hilite') as pyg:
+        with highlight.using_store(store):
+            assert mark.convert(snippet)[0] == html
+    assert not pyg.called
+
+
+# Given fenced and indented blocks, with and without a known language
+# When converted with the cached extensions and with the stock ones
+# Then the output is the same
+def test_same_as_stock_extensions():
+    import markdown
+    docs = [snippet, indented, "```nosuchlang\nx = 1\n```\n",
+            "```\nplain <b>\n```\n", "Code:\n\n    #!python\n    f()\n"]
+    for doc in docs:
+        stock = markdown.Markdown(extensions=mark.extensions,
+                                  extension_configs=mark.extension_configs,
+                                  lazy_ol=False, output_format='html5')
+        assert mark.new_converter().convert(doc) == stock.convert(doc)
+
+
+def test_cached_extensions():
+    (exts, configs) = highlight.cached_extensions(
+        ['extra', 'markdown.extensions.codehilite', 'toc'],
+        {'markdown.extensions.codehilite': {'linenums': True},
+         'toc': {'permalink': True}})
+    assert exts[0] == 'extra' and exts[2] == 'toc'
+    assert isinstance(exts[1], highlight.CachedCodeHiliteExtension)
+    assert exts[1].getConfig('linenums') is True
+    assert isinstance(exts[3], highlight.CachedFencedCodeExtension)
+    assert configs == {'toc': {'permalink': True}}
+
+
+def test_lexers_reused():
+    one = highlight.cached_get_lexer_by_name('python')
+    assert highlight.cached_get_lexer_by_name('python') is one
+    with pytest.raises(ValueError):
+        highlight.cached_get_lexer_by_name('no-such-language')
+
+
+# Given the webquills converters, which highlight through the caches
+# When another Markdown converter in the process highlights code
+# Then it uses the extensions as shipped
+def test_other_converters_unaffected():
+    import markdown
+    from markdown.extensions import fenced_code
+    mark.convert(snippet)
+    assert codehilite.CodeHilite is not highlight.CachedCodeHilite
+    assert fenced_code.CodeHilite is not highlight.CachedCodeHilite
+    assert codehilite.HiliteTreeprocessor.run is not \
+        highlight.CachedHiliteTreeprocessor.run
+    with mock.patch.object(highlight.CachedCodeHilite, '_hilite') as cached:
+        html = markdown.markdown(snippet, extensions=['extra', 'codehilite'])
+    assert not cached.called
+    assert '<span class="k">def</span>' in html
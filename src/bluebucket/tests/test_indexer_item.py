@@ -38,7 +38,8 @@ def test_indexer_on_save():
 
     from webquills.indexer.item import on_save
     on_save(db, archivist, resource)
-    db.Table().put_item.assert_called_with(Item=mock.ANY)
+    db.Table().put_item.assert_called_with(Item=mock.ANY,
+                                           ReturnValues='ALL_OLD')
 
 
 def test_indexer_on_remove():
@@ -53,4 +54,5 @@ def test_indexer_on_remove():
     }
     from webquills.indexer.item import on_remove
     on_remove(db, archivist, key)
-    db.Table().delete_item.assert_called_with(Key=expect_key)
+    db.Table().delete_item.assert_called_with(Key=expect_key,
+                                              ReturnValues='ALL_OLD')
@@ -0,0 +1,339 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+import datetime
+import io
+import json
+from botocore.exceptions import ClientError
+from dateutil.tz import tzutc
+from bluebucket.archivist import S3archivist, S3event
+from bluebucket.archivist.inventory import Inventory
+import stubs
+
+testbucket = 'test-bucket'
+listing = {
+    "IsTruncated": False,
+    "Contents": [
+        {"Key": "_A/Item/Page/Article/b.json", "Size": 10, "ETag": '"bb"',
+         "LastModified": stubs.testable_datetime},
+        {"Key": "_A/Item/Page/Article/a.json", "Size": 20, "ETag": '"aa"',
+         "LastModified": stubs.testable_datetime},
+        {"Key": "_A/site.json", "Size": 5, "ETag": '"cc"',
+         "LastModified": stubs.testable_datetime},
+    ]
+}
+
+
+def no_such_key(*args, **kwargs):
+    raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+
+
+###########################################################################
+# Inventory
+###########################################################################
+def test_inventory_add_remove_keys():
+    inv = Inventory()
+    inv.add('_A/b.json', size=1, etag='"x"')
+    inv.add('_A/a.json', size=2)
+    inv.add('other.html', size=3)
+    assert inv.keys('_A/') == ['_A/a.json', '_A/b.json']
+    assert inv.get('_A/b.json')['etag'] == 'x'
+    inv.remove('_A/a.json')
+    inv.remove('not-there')
+    assert '_A/a.json' not in inv
+    assert len(inv) == 2
+
+
+def test_inventory_round_trip():
+    inv = Inventory.from_listing(listing['Contents'])
+    inv.add('_A/Item/Page/Article/a.json', resourcetype='archetype')
+    again = Inventory.from_data(json.loads(inv.as_json()))
+    assert again.keys() == inv.keys()
+    assert again.get('_A/Item/Page/Article/a.json')['resourcetype'] ==\
+        'archetype'
+    # timestamps are serialized with millisecond precision
+    assert abs((again.reconciled - inv.reconciled).total_seconds()) < 0.001
+
+
+def test_inventory_keeps_resourcetype():
+    inv = Inventory()
+    inv.add('_A/a.json', resourcetype='archetype')
+    inv.add('_A/a.json', size=5)
+    assert inv.get('_A/a.json')['resourcetype'] == 'archetype'
+
+
+def test_inventory_is_stale():
+    now = datetime.datetime(2016, 7, 4, tzinfo=tzutc())
+    inv = Inventory(reconciled=now - datetime.timedelta(hours=2))
+    assert inv.is_stale(3600, now=now)
+    assert not inv.is_stale(86400, now=now)
+    assert Inventory().is_stale(86400)
+
+
+def test_inventory_apply_event():
+    inv = Inventory()
+    save = S3event(stubs.generate_event(key='_A/a.json')['Records'][0])
+    inv.apply_event(save)
+    assert inv.get('_A/a.json')['size'] == 1024
+    remove = S3event(stubs.generate_event(
+        key='_A/a.json', method='ObjectRemoved:Delete')['Records'][0])
+    inv.apply_event(remove)
+    assert '_A/a.json' not in inv
+
+
+###########################################################################
+# S3archivist and the inventory
+###########################################################################
+def listings(deltas=()):
+    "A list_objects stand-in: the archive listing, and delta markers."
+    def list_objects(Bucket, Prefix, **kwargs):
+        if Prefix.startswith('_A/_inventory'):
+            return {"IsTruncated": False,
+                    "Contents": [{"Key": '_A/_inventory/' + d}
+                                 for d in deltas]}
+        return listing
+    return list_objects
+
+
+def prefixes_listed(arch):
+    return [c[1]['Prefix'] for c in arch.s3.list_objects.call_args_list]
+
+
+def markers_written(arch):
+    return [c[1]['Key'] for c in arch.s3.put_object.call_args_list
+            if c[1]['Key'].startswith('_A/_inventory/')]
+
+
+# Given a siteconfig with use_inventory and no snapshot in the bucket
+# When list_keys() is called
+# Then the archivist lists the bucket once and saves a snapshot
+def test_list_keys_builds_inventory():
+    arch = S3archivist(testbucket, s3=mock.Mock(),
+                       siteconfig={"use_inventory": True})
+    arch.s3.get_object.side_effect = no_such_key
+    arch.s3.list_objects.side_effect = listings()
+    arch.s3.put_object.return_value = {"ETag": '"ee"'}
+    keys = arch.list_keys()
+    assert keys == ['_A/Item/Page/Article/a.json',
+                    '_A/Item/Page/Article/b.json',
+                    '_A/site.json']
+    arch.s3.put_object.assert_called_with(
+        Bucket=testbucket, Key=arch.inventory_key, Body=mock.ANY,
+        ContentType='application/json', ContentEncoding='gzip',
+        Metadata={"resourcetype": "config"})
+    # later listings only check for changes made elsewhere
+    arch.list_keys('_A/Item/')
+    assert prefixes_listed(arch).count('_A/') == 1
+    assert prefixes_listed(arch)[-1] == '_A/_inventory'
+
+
+# Given a fresh snapshot in the bucket
+# When list_keys() is called
+# Then the archivist reads the snapshot and does not list the archive
+def test_list_keys_uses_snapshot():
+    arch = S3archivist(testbucket, s3=mock.Mock(),
+                       siteconfig={"use_inventory": True})
+    snapshot = Inventory.from_listing(listing['Contents'])
+    arch.s3.get_object.return_value = {
+        "Body": snapshot.as_json().encode('utf-8'),
+        "ContentType": "application/json",
+    }
+    arch.s3.list_objects.side_effect = listings()
+    keys = arch.list_keys('_A/Item/')
+    assert len(keys) == 2
+    assert set(prefixes_listed(arch)) == set(['_A/_inventory'])
+
+
+# Given a snapshot, and changes another process recorded since
+# When list_keys() is called
+# Then the listing includes the changes
+def test_list_keys_applies_deltas():
+    arch = S3archivist(testbucket, s3=mock.Mock(),
+                       siteconfig={"use_inventory": True})
+    snapshot = Inventory.from_listing(listing['Contents'])
+    arch.s3.get_object.return_value = {
+        "Body": snapshot.as_json().encode('utf-8'),
+        "ContentType": "application/json",
+    }
+    arch.s3.list_objects.side_effect = listings([
+        '20160704120000000000.aaaa.put/_A/Item/Page/Article/c.json',
+        '20160704120001000000.bbbb.del/_A/Item/Page/Article/a.json'])
+    assert arch.list_keys('_A/Item/') == ['_A/Item/Page/Article/b.json',
+                                          '_A/Item/Page/Article/c.json']
+
+
+# Given a site that uses the inventory
+# When the archive's own state under _A/_ is listed
+# Then it is listed from S3, not the inventory
+def test_list_keys_state_not_from_inventory():
+    arch = S3archivist(testbucket, s3=mock.Mock(),
+                       siteconfig={"use_inventory": True})
+    arch.s3.list_objects.return_value = {
+        "IsTruncated": False, "Contents": [{"Key": "_A/_deps/x/y.json"}]}
+    assert arch.list_keys('_A/_deps/') == ['_A/_deps/x/y.json']
+    assert not arch.s3.get_object.called
+
+
+# Given a loaded inventory
+# When resources are saved and deleted
+# Then the inventory reflects the changes to archetypes, and markers record
+# them for other processes
+def test_save_and_delete_update_inventory():
+    arch = S3archivist(testbucket, s3=mock.Mock(),
+                       siteconfig={"use_inventory": True})
+    arch._inventory = Inventory.from_listing(listing['Contents'])
+    arch.s3.put_object.return_value = {"ETag": '"dd"'}
+    arch.s3.list_objects.side_effect = listings()
+    asset = arch.new_resource('_A/Item/Page/Article/c.json',
+                              content=b'{}',
+                              contenttype='application/json',
+                              resourcetype='archetype')
+    arch.save(asset)
+    arch.delete('_A/Item/Page/Article/a.json')
+    page = arch.new_resource('page.html', content=b'<p>',
+                             contenttype='text/html',
+                             resourcetype='artifact', archetype_guid='c')
+    arch.save(page)
+    state = arch.new_resource('_A/_deps/x.json', content=b'{}',
+                              contenttype='application/json',
+                              resourcetype='config')
+    arch.save(state)
+
+    assert arch.list_keys('_A/Item/') == ['_A/Item/Page/Article/b.json',
+                                          '_A/Item/Page/Article/c.json']
+    assert 'page.html' not in arch.inventory
+    assert '_A/_deps/x.json' not in arch.inventory
+    entry = arch.inventory.get('_A/Item/Page/Article/c.json')
+    assert entry['etag'] == 'dd'
+    assert entry['resourcetype'] == 'archetype'
+    markers = markers_written(arch)
+    assert len(markers) == 2
+    assert markers[0].endswith('.put/_A/Item/Page/Article/c.json')
+    assert markers[1].endswith('.del/_A/Item/Page/Article/a.json')
+
+
+# Given an inventory with more recorded changes than inventory_max_deltas
+# When list_keys() is called
+# Then the changes are folded into the snapshot and their markers deleted
+def test_refresh_compacts_deltas():
+    arch = S3archivist(testbucket, s3=mock.Mock(),
+                       siteconfig={"use_inventory": True,
+                                   "inventory_max_deltas": 1})
+    arch._inventory = Inventory.from_listing(listing['Contents'])
+    arch._inventory.dirty = False
+    arch.s3.get_object.side_effect = no_such_key
+    deltas = ['20160704120000000000.aaaa.put/_A/c.json',
+              '20160704120001000000.bbbb.put/_A/d.json']
+    arch.s3.list_objects.side_effect = listings(deltas)
+    assert '_A/d.json' in arch.list_keys('_A/')
+    arch.s3.put_object.assert_called_with(
+        Bucket=testbucket, Key=arch.inventory_key, Body=mock.ANY,
+        ContentType='application/json', ContentEncoding='gzip',
+        Metadata={"resourcetype": "config"}, IfNoneMatch='*')
+    deleted = arch.s3.delete_objects.call_args[1]['Delete']['Objects']
+    assert deleted == [{"Key": '_A/_inventory/' + d} for d in deltas]
+
+
+class SharedS3(object):
+    "Just enough of an S3 client, kept in a dict, for archivists to share."
+    def __init__(self):
+        self.meta = mock.Mock(region_name='us-east-1')
+        self.objects = {}
+        self.generation = 0
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None,
+                   **kwargs):
+        old = self.objects.get(Key)
+        if (IfMatch and (old is None or old['ETag'] != IfMatch)) or \
+                (IfNoneMatch and old is not None):
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}},
+                              "PutObject")
+        self.generation += 1
+        etag = '"%d"' % self.generation
+        self.objects[Key] = dict(kwargs, Body=Body, ETag=etag)
+        return {"ETag": etag}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            no_such_key()
+        obj = dict(self.objects[Key])
+        obj['Body'] = io.BytesIO(obj['Body'])
+        return obj
+
+    def list_objects(self, Bucket, Prefix, **kwargs):
+        return {"IsTruncated": False,
+                "Contents": [{"Key": k, "ETag": self.objects[k]['ETag']}
+                             for k in sorted(self.objects)
+                             if k.startswith(Prefix)]}
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete['Objects']:
+            self.objects.pop(item['Key'], None)
+
+
+# Given two processes sharing a bucket, each with the inventory loaded
+# When both save archetypes, and each folds the other's changes away
+# Then neither loses keys, and the snapshot holds them all
+def test_folding_keeps_other_processes_changes():
+    s3 = SharedS3()
+    config = {"use_inventory": True, "inventory_max_deltas": 1}
+    one = S3archivist(testbucket, s3=s3, siteconfig=config)
+    two = S3archivist(testbucket, s3=s3, siteconfig=config)
+
+    def save(arch, key):
+        arch.save(arch.new_resource(key, content=b'{}',
+                                    contenttype='application/json',
+                                    resourcetype='archetype'))
+
+    assert one.list_keys('_A/Item/') == []
+    assert two.list_keys('_A/Item/') == []
+    save(one, '_A/Item/a.json')
+    save(one, '_A/Item/b.json')
+    assert two.list_keys('_A/Item/') == ['_A/Item/a.json', '_A/Item/b.json']
+    save(two, '_A/Item/c.json')
+    save(two, '_A/Item/d.json')
+    assert one.list_keys('_A/Item/') == ['_A/Item/a.json', '_A/Item/b.json',
+                                         '_A/Item/c.json', '_A/Item/d.json']
+    assert two.list_keys('_A/Item/') == one.list_keys('_A/Item/')
+    three = S3archivist(testbucket, s3=s3, siteconfig=config)
+    assert three.list_keys('_A/Item/') == one.list_keys('_A/Item/')
+    # another process folds between this one reading and writing the
+    # snapshot, so the write fails and is retried against the new snapshot
+    put_object = s3.put_object
+
+    def interleaved_put(Key, **kwargs):
+        if Key == one.inventory_key and not interleaved:
+            interleaved.append(Key)
+            save(two, '_A/Item/f.json')
+            two.list_keys('_A/Item/')
+        return put_object(Key=Key, **kwargs)
+    interleaved = []
+    s3.put_object = interleaved_put
+    save(one, '_A/Item/e.json')
+    save(one, '_A/Item/g.json')
+    assert one.list_keys('_A/Item/') == two.list_keys('_A/Item/')
+    assert interleaved
+    assert one.list_keys('_A/Item/')[-3:] == ['_A/Item/e.json',
+                                              '_A/Item/f.json',
+                                              '_A/Item/g.json']
+    assert '_A/Item/f.json' in S3archivist(
+        testbucket, s3=s3, siteconfig=config).list_keys('_A/Item/')
@@ -189,6 +189,23 @@ def test_save_artifact_no_guid(testbucket):
     assert einfo
 
 
+# Given a bucket
+# When save_stream() is called with the content as chunks
+# Then get returns a resource with the chunks joined
+def test_save_stream(testbucket):
+    arch = localarchivist(testbucket, siteconfig={})
+    arch.listeners.append(mock.Mock())
+    asset = arch.new_resource('streamed.txt', contenttype=contenttype,
+                              resourcetype='asset')
+    arch.save_stream(asset, iter([b'con', b'tents']))
+
+    resource = arch.get('streamed.txt')
+    assert resource.content == b'contents'
+    assert resource.contenttype == contenttype
+    assert resource.resourcetype == 'asset'
+    assert arch.listeners[0].call_args[0][0].size == 8
+
+
 ###########################################################################
 # Archivist get
 ###########################################################################
@@ -201,6 +218,21 @@ def test_get_no_filename(testbucket):
         arch.get()
 
 
+# Given a saved resource
+# When get_head_bytes() is called
+# Then archivist returns the first bytes of the content file
+def test_get_head_bytes(testbucket):
+    arch = localarchivist(testbucket, siteconfig={})
+    asset = arch.new_resource('ranged.md',
+                              content=b'title: Ranged\n\nBody',
+                              contenttype='text/markdown',
+                              resourcetype='asset')
+    arch.save(asset)
+    assert arch.get_head_bytes('ranged.md', 5) == (b'title', False)
+    assert arch.get_head_bytes('ranged.md', 100) ==\
+        (b'title: Ranged\n\nBody', True)
+
+
 ###########################################################################
 # Archivist delete_object
 ###########################################################################
@@ -238,6 +270,22 @@ def test_all_archetypes(testbucket):
         assert isinstance(item, localresource)
 
 
+# Given an archivist with a saved archetype
+# When list_keys() is called
+# Then it returns the keys under the archetype prefix only
+def test_list_keys(testbucket):
+    arch = localarchivist(testbucket, siteconfig={})
+    asset = arch.new_resource('_A/Item/Page/Article/listed.json',
+                              content=b'{}',
+                              contenttype='application/json',
+                              resourcetype='archetype')
+    arch.save(asset)
+    keys = arch.list_keys()
+    assert '_A/Item/Page/Article/listed.json' in keys
+    assert 'filename.txt' not in keys
+    assert [r.key for r in arch.all_archetypes()] == keys
+
+
 ###########################################################################
 # Asset and S3 response to asset
 ###########################################################################
@@ -0,0 +1,105 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+from bluebucket.archivist.local import localarchivist
+from webquills.localbus import LocalEventBus
+from webquills.quill import publish
+
+article = """itemtype: Item/Page/Article
+guid: 02eb3153-6d45-4c96-8bcb-f7da85e69624
+updated: 2016-06-24T07:56:00-0400
+category: fake/content
+slug: test-article-one
+title: Test article one
+
+A test article, published through the local cascade.
+"""
+
+
+# Given a local archivist attached to a bus
+# When a markdown source is published
+# Then the cascade produces the archetype, the HTML and the index entry
+def test_local_cascade(testbucket):
+    db = mock.Mock()
+    archivist = localarchivist(testbucket, siteconfig={})
+    bus = LocalEventBus(db=db)
+    bus.attach(archivist)
+    publish(archivist, article)
+    failures = bus.drain(timeout=10)
+    bus.shutdown()
+
+    assert failures == []
+    guid = '02eb3153-6d45-4c96-8bcb-f7da85e69624'
+    archetype = archivist.get('_A/Item/Page/Article/%s.json' % guid)
+    assert archetype.data['Item']['title'] == 'Test article one'
+    html = archivist.get('fake/content/test-article-one.html')
+    assert 'published through the local cascade' in html.text
+    db.Table().put_item.assert_called_with(Item=mock.ANY,
+                                           ReturnValues='ALL_OLD')
+
+
+# Given a bus with a handler that fails
+# When an event is routed to it
+# Then drain() returns the failure and other handlers still run
+def test_failures_collected(testbucket):
+    calls = []
+
+    def broken(archivist, event):
+        raise ValueError("broken")
+
+    def working(archivist, event):
+        calls.append(event.key)
+
+    bus = LocalEventBus(routes=[('_A/', True, broken), ('_A/', True, working)])
+    archivist = localarchivist(testbucket, siteconfig={})
+    bus.attach(archivist)
+    resource = archivist.new_resource('_A/thing.json', content=b'{}',
+                                      contenttype='application/json')
+    archivist.save(resource)
+    archivist.delete('_A/thing.json')  # no route for removals
+    failures = bus.drain(timeout=10)
+    bus.shutdown()
+
+    assert calls == ['_A/thing.json']
+    assert len(failures) == 1
+    assert failures[0][0].key == '_A/thing.json'
+
+
+# Given a bus whose catalog debouncer fails to render a catalog
+# When the bus is drained
+# Then the failure is returned as a save of the catalog key
+def test_catalog_failures_collected(testbucket):
+    bus = LocalEventBus(routes=[])
+    archivist = localarchivist(testbucket, siteconfig={})
+    catalog_key = '_A/Item/Page/Catalog/news.json'
+    archivist.save(archivist.new_resource(catalog_key, data={"Item": {}},
+                                          contenttype='application/json',
+                                          resourcetype='archetype'))
+    bus.attach(archivist)
+    bus.catalogs.render = mock.Mock(side_effect=ValueError("broken"))
+    bus.catalogs.add(archivist, [catalog_key])
+    failures = bus.drain(timeout=10)
+    bus.shutdown()
+
+    assert len(failures) == 1
+    assert failures[0][0].key == catalog_key
+    assert failures[0][0].is_save_event
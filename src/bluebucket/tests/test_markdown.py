@@ -165,3 +165,109 @@ def test_transform_on_save():
     assert archetype.resourcetype == 'archetype'
     assert archetype.key.endswith('.json')
 
+
+# Given markdown documents with metadata blocks
+# When find_meta_end() is called
+# Then it returns the offset where the body begins
+def test_find_meta_end():
+    end = mark.find_meta_end(doc2)
+    assert doc2[end:].startswith('# The Test Article')
+    assert mark.find_meta_end(doc3) == len(doc3)
+    yaml_style = '---\ntitle: YAML\n...\nBody text\n'
+    assert yaml_style[mark.find_meta_end(yaml_style):] == 'Body text\n'
+    no_meta = 'Just a body.\n'
+    assert mark.find_meta_end(no_meta) == 0
+    # A partial block that has not ended yet cannot be measured
+    assert mark.find_meta_end(doc2[:40], complete=False) is None
+
+
+# Given a markdown source stored in the archive
+# When read_source_metadata() is called with a small chunk size
+# Then only the front matter is fetched, and the metadata matches to_archetype
+def test_read_source_metadata():
+    archivist = S3archivist(testbucket,
+                            s3=mock.Mock(),
+                            siteconfig=siteconfig)
+    body = doc1 + 'More text than we will ever read.\n' * 1000
+    stored = body.encode('utf-8')
+
+    def get_head_bytes(key, nbytes):
+        return (stored[:nbytes], nbytes >= len(stored))
+    archivist.get_head_bytes = mock.Mock(side_effect=get_head_bytes)
+
+    meta = mark.read_source_metadata(archivist, 'doc1.md', chunk_size=64)
+    assert meta == mark.to_archetype(archivist, doc1)['Item']
+    last_call = archivist.get_head_bytes.call_args_list[-1]
+    assert last_call[0][1] < len(stored)
+
+
+# Given markdown documents
+# When parse_metadata() is called
+# Then the metadata matches to_archetype, and no body is rendered
+def test_parse_metadata():
+    archivist = S3archivist(testbucket, s3=mock.Mock(), siteconfig=siteconfig)
+    for doc in (doc1, doc2, doc3, doc2.replace('\n', '\r\n')):
+        archetype = mark.to_archetype(archivist, doc)
+        del archetype['Item_Page_Article']
+        assert mark.parse_metadata(archivist, doc) == archetype
+    continued = 'Title: Multi\nTags: one\n    two\nUpdated: 2016-01-01\n\n'
+    assert mark.read_meta(continued)['tags'] == ['one', 'two']
+
+
+# Given a siteconfig with a render profile for catalogs
+# When documents are converted
+# Then catalogs use the profile, and a meta key can choose one explicitly
+def test_render_profiles():
+    config = dict(siteconfig, render_profiles={
+        "plain": {"extensions": ["markdown.extensions.extra"]},
+    }, render_profile_by_itemtype={"Item/Page/Catalog": "plain"})
+    archivist = S3archivist(testbucket, s3=mock.Mock(), siteconfig=config)
+
+    def profile_of(meta):
+        return mark.select_profile(archivist, mark.read_meta(meta)).name
+    assert profile_of('Itemtype: item/page/catalog/index\n') == 'plain'
+    assert profile_of('Itemtype: Item/Page/Catalogue\n') == 'default'
+    assert profile_of('Itemtype: Item/Page/Article\n'
+                      'Render-Profile: plain\n') == 'plain'
+    assert profile_of('Render-Profile: missing\n') == 'default'
+    # profiles are built once
+    plain = mark.select_profile(archivist, {"render-profile": ["plain"]})
+    assert mark.select_profile(archivist, {"render-profile": ["plain"]}) is\
+        plain
+
+    catalog = mark.to_archetype(archivist, doc3 + '\n# Latest posts\n')
+    assert '<h1>Latest posts</h1>' in catalog['Item_Page_Article']['body']
+    article = mark.to_archetype(archivist, doc2)
+    assert 'headerlink' in article['Item_Page_Article']['body']
+
+
+# Given a converter pool
+# When documents are converted one after another
+# Then no metadata or TOC state leaks from one document to the next
+def test_converter_pool_resets_state():
+    pool = mark.ConverterPool(maxsize=1)
+    with pool.converter() as md:
+        md.convert('Title: First\n\n[TOC]\n\n# Heading One\n')
+        first = md
+    with pool.converter() as md:
+        assert md is first  # reused
+        html = md.convert('[TOC]\n\n# Heading Two\n')
+        assert md.Meta == {}
+        assert 'Heading One' not in html
+
+
+# Given several threads
+# When they convert different documents at the same time
+# Then each gets its own metadata back
+def test_convert_threadsafe():
+    from concurrent.futures import ThreadPoolExecutor
+
+    def work(i):
+        text = 'Title: Doc %d\n\n# Heading %d\n' % (i, i)
+        (html, meta) = mark.convert(text)
+        return (i, meta['title'][0], html)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for (i, title, html) in executor.map(work, range(40)):
+            assert title == 'Doc %d' % i
+            assert 'Heading %d' % i in html
@@ -0,0 +1,120 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+from webquills.scribe.minify import HTMLMinifier, minify, minify_stream
+from webquills.scribe import page_to_html
+
+page = """<!doctype html>
+<html>
+  <head>
+    <!-- page head -->
+    <!--[if lt IE 9]><script src="shiv.js"></script><![endif]-->
+    <style>
+      body   { margin: 0 }
+    </style>
+  </head>
+  <body>
+    <h1 class="title">  Hello,   world  </h1>
+    <pre><code class="python">def f():
+    return  1
+</code></pre>
+    <p>Some <code>a  =  b</code> inline.</p>
+    <textarea name="t">  keep
+  this</textarea>
+    <script>
+      var  x = "</p>   <p>";
+    </script>
+  </body>
+</html>
+"""
+
+expected = """<!doctype html>
+<html>
+<head>
+<!--[if lt IE 9]><script src="shiv.js"></script><![endif]-->
+<style>
+      body   { margin: 0 }
+    </style>
+</head>
+<body>
+<h1 class="title"> Hello, world </h1>
+<pre><code class="python">def f():
+    return  1
+</code></pre>
+<p>Some <code>a  =  b</code> inline.</p>
+<textarea name="t">  keep
+  this</textarea>
+<script>
+      var  x = "</p>   <p>";
+    </script>
+</body>
+</html>
+"""
+
+
+# Given an indented page with preformatted blocks and comments
+# When it is minified
+# Then whitespace in text is collapsed, comments other than conditional
+# comments are dropped, and preformatted content is kept as it was
+def test_minify():
+    assert minify(page) == expected
+    assert '<!-- page head -->' in minify(page, remove_comments=False)
+
+
+# Given a page split into chunks at every possible place
+# When the chunks are minified as a stream
+# Then the output is the same as minifying the whole page
+def test_minify_stream_any_split():
+    for size in (1, 2, 3, 5, 7, 64):
+        chunks = [page[i:i + size] for i in range(0, len(page), size)]
+        assert ''.join(minify_stream(chunks)) == expected
+
+
+# Given a long pre element fed a few characters at a time
+# When its closing tag arrives, split across chunks
+# Then the output is unchanged, and the text is only tokenized once it ends
+def test_minify_stream_long_raw_element():
+    text = '<pre>' + 'x  <b>y</b>\n' * 500 + '</pre  >  <p>a  b</p>'
+    chunks = [text[i:i + 3] for i in range(0, len(text), 3)]
+    process = HTMLMinifier._process
+    with mock.patch.object(HTMLMinifier, '_process', autospec=True,
+                           side_effect=process) as spy:
+        assert ''.join(minify_stream(chunks)) == minify(text)
+    assert spy.call_count < 20  # of some 2000 chunks
+
+
+def test_minify_unterminated():
+    assert minify('<p>a  b</p>  <pre>  open') == '<p>a b</p> <pre>  open'
+    assert minify('text  <!-- never closed') == 'text <!-- never closed'
+
+
+# Given a site with minify_html set
+# When a page is rendered, whole or as a stream
+# Then the output is minified
+def test_page_to_html_minify():
+    archivist = mock.Mock(siteconfig={"minify_html": True})
+    template = mock.Mock()
+    template.render.return_value = page
+    template.generate.return_value = iter([page[:40], page[40:]])
+    assert page_to_html.render_text(archivist, template, {}) == expected
+    chunks = page_to_html.generate(archivist, template, {})
+    assert b''.join(chunks) == expected.encode('utf-8')
@@ -16,9 +16,14 @@
 #
 from __future__ import absolute_import, print_function, unicode_literals
 
+from io import open
 import mock
+import os
+import os.path as path
 from bluebucket.archivist import S3archivist
+from bluebucket.archivist.local import localarchivist
 from botocore.exceptions import ClientError
+from webquills.indexer import depends
 from webquills.scribe import page_to_html as scribe
 
 siteconfig = {
@@ -173,6 +178,7 @@ def test_json_on_save():
                             s3=mock.Mock())
     archivist.s3.get_object.side_effect = ClientError({"Error": {}},
                                                       "NoSuchKey")
+    archivist.s3.list_objects.return_value = {'IsTruncated': False}
     archivist.publish = mock.Mock()
     the_thingy = archivist.new_resource('test.json',
                                         data=archetype,
@@ -188,6 +194,30 @@ def test_json_on_save():
     assert archivist.publish.called_with(resource)
 
 
+# Given a site configured to stream renders
+# When I call scribe.on_save() with an archetype
+# Then the rendered template is saved through save_stream
+def test_json_on_save_stream():
+    archivist = S3archivist(bucket=testbucket,
+                            siteconfig=dict(siteconfig, stream_render=True),
+                            s3=mock.Mock())
+    archivist.s3.get_object.side_effect = ClientError({"Error": {}},
+                                                      "NoSuchKey")
+    archivist.s3.list_objects.return_value = {'IsTruncated': False}
+    archivist.save_stream = mock.Mock()
+    the_thingy = archivist.new_resource('test.json',
+                                        data=archetype,
+                                        contenttype='application/json',
+                                        resourcetype='archetype')
+    these = scribe.on_save(archivist, the_thingy)
+    assert len(these) == 1
+    (resource, chunks) = archivist.save_stream.call_args[0]
+    assert resource is these[0]
+    assert resource.acl == 'public-read'
+    assert resource.archetype_guid == archetype['Item']['guid']
+    assert b"<p>test</p>" in b''.join(chunks)
+
+
 def test_json_not_archetype_on_save():
     # JSON files that are not resourcetype "archetype" should be ignored, as
     # they are probably config files or something, not content
@@ -199,3 +229,107 @@ def test_json_not_archetype_on_save():
     these = scribe.on_save(archivist, json_asset)
     assert len(these) == 0
 
+
+# Given an artifact rendered from an archetype
+# When on_save() is called again and nothing it depends on has changed
+# Then the render and upload are skipped
+# And when a template it uses changes, it is rendered again
+def test_on_save_skips_unchanged(tmpdir_path):
+    os.makedirs(path.join(tmpdir_path, '_templates'))
+
+    def write_template(name, text):
+        with open(path.join(tmpdir_path, '_templates', name), 'w',
+                  encoding='utf-8') as f:
+            f.write(text)
+    write_template('base.html', '<html>{% block body %}{% endblock %}</html>')
+    write_template('page.html', '{% extends "base.html" %}'
+                   '{% block body %}{{ Item.title }}{% endblock %}')
+    archivist = localarchivist(tmpdir_path,
+                               siteconfig={"default_template": "page.html",
+                                           "version_cache_seconds": 0})
+    resource = archivist.new_resource('_A/test.json', data=archetype,
+                                      contenttype='application/json',
+                                      resourcetype='archetype')
+    [first] = scribe.on_save(archivist, resource)
+    assert archivist.get(first.key).text == '<html>Page Title</html>'
+    assert archivist.head(first.key).metadata['fingerprint']
+
+    assert scribe.on_save(archivist, resource) == []
+
+    write_template('base.html', '<body>{% block body %}{% endblock %}</body>')
+    [again] = scribe.on_save(archivist, resource)
+    assert archivist.get(again.key).text == '<body>Page Title</body>'
+
+
+# Given an archetype rendered with a template that extends another
+# When on_save() renders it
+# Then the templates it loaded, and the candidates tried before them, are
+# recorded as its dependencies
+def test_on_save_records_templates(tmpdir_path):
+    os.makedirs(path.join(tmpdir_path, '_templates'))
+    for (name, text) in [('base.html', '{% block body %}{% endblock %}'),
+                         ('page.html', '{% extends "base.html" %}')]:
+        with open(path.join(tmpdir_path, '_templates', name), 'w',
+                  encoding='utf-8') as f:
+            f.write(text)
+    archivist = localarchivist(tmpdir_path,
+                               siteconfig={"default_template": "page.html"})
+    resource = archivist.new_resource('_A/test.json', data=archetype,
+                                      contenttype='application/json',
+                                      resourcetype='archetype')
+    with scribe.loading_templates(archivist) as outer:
+        scribe.on_save(archivist, resource)
+    assert outer == set()  # nested collection is separate
+    for name in ['page.html', 'base.html']:
+        assert depends.template_dependents(archivist, name) == ['_A/test.json']
+    assert depends.template_dependents(archivist, 'other.html') == []
+
+
+# Given a site with fingerprinted assets and a template using asset_url
+# When a page is rendered, and again after the asset changes
+# Then it links the asset's current fingerprinted key
+def test_on_save_asset_url(tmpdir_path):
+    from bluebucket.assets import save_asset
+    os.makedirs(path.join(tmpdir_path, '_templates'))
+    with open(path.join(tmpdir_path, '_templates', 'page.html'), 'w',
+              encoding='utf-8') as f:
+        f.write('<link href="{{ asset_url("css/site.css") }}">')
+    archivist = localarchivist(tmpdir_path,
+                               siteconfig={"default_template": "page.html",
+                                           "fingerprint_assets": True,
+                                           "version_cache_seconds": 0})
+
+    def put_css(text):
+        return save_asset(archivist, archivist.new_resource(
+            'css/site.css', content=text, contenttype='text/css',
+            resourcetype='asset'))
+    resource = archivist.new_resource('_A/test.json', data=archetype,
+                                      contenttype='application/json',
+                                      resourcetype='archetype')
+    first_key = put_css(b'body {}')
+    [page] = scribe.on_save(archivist, resource)
+    assert archivist.get(page.key).text == '<link href="/%s">' % first_key
+
+    second_key = put_css(b'body { color: red }')
+    [page] = scribe.on_save(archivist, resource)
+    assert archivist.get(page.key).text == '<link href="/%s">' % second_key
+
+
+# Given a site with fingerprinted assets
+# When pages are prepared within version_cache_seconds of each other
+# Then the templates are listed and the manifest read only once
+def test_site_versions_cached(tmpdir_path):
+    archivist = localarchivist(tmpdir_path,
+                               siteconfig={"fingerprint_assets": True,
+                                           "version_cache_seconds": 60})
+    with mock.patch.object(scribe, 'template_versions',
+                           return_value={"page.html": "v1"}) as versions, \
+            mock.patch.object(scribe.assets, 'load_manifest',
+                              return_value={"a.css": "a.1.css"}) as manifest:
+        assert scribe.site_versions(archivist, now=1000) == \
+            ({"page.html": "v1"}, {"a.css": "a.1.css"})
+        scribe.site_versions(archivist, now=1059)
+        assert versions.call_count == 1
+        assert manifest.call_count == 1
+        scribe.site_versions(archivist, now=1060)
+        assert versions.call_count == 2
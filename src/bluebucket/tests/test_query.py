@@ -0,0 +1,123 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+from webquills.indexer import query
+from webquills.indexer import item
+
+catalog_query = {
+    "TableName": "webquills-item-by-class",
+    "KeyConditionExpression": "bucket_itemclass = :bic",
+    "ExpressionAttributeValues": {":bic": {"S": "test-bucket|Item/Page"}},
+    "ScanIndexForward": False,
+}
+
+
+def pages(*counts):
+    "A db whose query returns pages of the given sizes."
+    db = mock.Mock()
+    responses = []
+    n = 0
+    for (i, count) in enumerate(counts):
+        page = {"Items": [{"n": n + j} for j in range(count)],
+                "Count": count, "ScannedCount": count}
+        n += count
+        if i < len(counts) - 1:
+            page['LastEvaluatedKey'] = {"n": n - 1}
+        responses.append(page)
+    db.query.side_effect = responses
+    return db
+
+
+# Given a query whose results span several pages
+# When it is run with no Limit
+# Then every page is read
+def test_paginate_all():
+    db = pages(2, 2, 1)
+    result = query.paginate(db, catalog_query)
+    assert [i['n'] for i in result['Items']] == [0, 1, 2, 3, 4]
+    assert result['Count'] == 5
+    assert 'LastEvaluatedKey' not in result
+    assert db.query.call_args_list[1][1]['ExclusiveStartKey'] == {"n": 1}
+
+
+# Given a query with a Limit
+# When the first page has fewer items than the Limit
+# Then pages are read until the Limit is reached, and no further
+def test_paginate_limit():
+    db = pages(2, 2, 2)
+    result = query.paginate(db, dict(catalog_query, Limit=3))
+    assert result['Count'] == 4
+    assert result['LastEvaluatedKey'] == {"n": 3}
+    assert db.query.call_count == 2
+    assert db.query.call_args_list[1][1]['Limit'] == 1
+
+
+# Given a cached query
+# When the same query is run again within the ttl
+# Then the cached result is returned
+# And a change to a returned result does not change the cache
+def test_execute_query_cached():
+    cache = query.QueryCache(ttl=60)
+    db = pages(1)
+    first = query.execute_query(catalog_query, db=db, cache=cache)
+    first['Items'].append("changed")
+    second = query.execute_query(dict(catalog_query), db=db, cache=cache)
+    assert db.query.call_count == 1
+    assert second['Items'] == [{"n": 0}]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+# Given a cached result
+# When the ttl has passed
+# Then the result is no longer returned
+def test_query_cache_expires():
+    cache = query.QueryCache(ttl=10)
+    cache.put('q', {"Items": []}, now=100)
+    assert cache.get('q', now=105) == {"Items": []}
+    assert cache.get('q', now=110) is None
+
+
+# Given a query in flight when the cache is cleared
+# When its result is put
+# Then it is not cached, as it may predate the write
+def test_query_cache_generation():
+    cache = query.QueryCache(ttl=10)
+    generation = cache.generation
+    cache.clear()
+    cache.put('q', {"Items": []}, generation=generation)
+    assert cache.get('q') is None
+
+
+# Given a cached query
+# When an item is written to the index
+# Then the cache is cleared
+def test_index_write_clears_cache():
+    query.query_cache.put('q', {"Items": []})
+    db = mock.Mock()
+    db.Table.return_value.put_item.return_value = {}
+    archivist = mock.Mock(bucket='test-bucket')
+    resource = mock.Mock(key='_A/Item/Page/Article/x.json')
+    resource.data = {"Item": {"itemtype": "Item/Page/Article",
+                              "updated": "2016-07-04T12:00:00Z",
+                              "guid": "x", "category": {"name": "test"}}}
+    item.on_save(db, archivist, resource)
+    assert query.query_cache.get('q') is None
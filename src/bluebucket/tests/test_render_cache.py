@@ -0,0 +1,77 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+from bluebucket.archivist.local import localarchivist
+from webquills.scribe.cache import (ArchivistStore, DirectoryStore,
+                                    RenderCache, digest)
+import webquills.scribe.markdown as mark
+import pytest
+
+doc = """Title: Cached
+Itemtype: Item/Page/Article
+Guid: 7a1b0f86-5c4e-4d3e-9c55-3a0b0bb0a0a1
+Updated: 2016-07-04T12:00:00Z
+
+# A heading
+
+Some *body* text.
+"""
+
+
+def test_memory_cache_is_bounded():
+    cache = RenderCache(maxsize=2)
+    cache.put('a', 'A')
+    cache.put('b', 'B')
+    assert cache.get('a') == 'A'  # a is now most recently used
+    cache.put('c', 'C')
+    assert cache.get('b') is None
+    assert cache.get('a') == 'A'
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+@pytest.mark.parametrize("kind", ["directory", "archive"])
+def test_persistent_store(tmpdir_path, kind):
+    if kind == "directory":
+        store = DirectoryStore(tmpdir_path)
+    else:
+        store = ArchivistStore(localarchivist(tmpdir_path, siteconfig={}))
+    key = digest('body')
+    assert store.get(key) is None
+    RenderCache(store=store).put(key, '<p>café</p>')
+    # a new process, with an empty memory cache, finds it in the store
+    assert RenderCache(store=store).get(key) == '<p>café</p>'
+
+
+# Given a document that was rendered before
+# When only its metadata changes
+# Then the body is not rendered again
+def test_to_archetype_reuses_body(tmpdir_path):
+    archivist = localarchivist(tmpdir_path,
+                               siteconfig={"render_cache": tmpdir_path})
+    first = mark.to_archetype(archivist, doc)
+    mark.render_cache.clear()  # as in a fresh container
+    retitled = doc.replace('Title: Cached', 'Title: Retitled')
+    with mock.patch.object(mark, 'convert') as convert:
+        second = mark.to_archetype(archivist, retitled)
+    assert not convert.called
+    assert second['Item']['title'] == 'Retitled'
+    assert second['Item_Page_Article'] == first['Item_Page_Article']
@@ -22,10 +22,11 @@ try:
 except ImportError:
     import unittest.mock as mock
 
+from io import BytesIO
 import json
 from bluebucket.archivist import S3archivist, S3resource, S3event
 from bluebucket.archivist import parse_aws_event
-from bluebucket.util import gzip
+from bluebucket.util import gunzip, gzip
 import stubs
 import pytest
 
@@ -169,6 +170,37 @@ def test_save_with_metadata():
     )
 
 
+# Given a site with a cache_control policy
+# When save() is called for resources the rules match
+# Then archivist calls s3.put_object with the rule's caching headers
+def test_save_with_cache_policy():
+    policy = [{"resourcetype": "asset", "fingerprinted": True,
+               "cache_control": "public, max-age=31536000, immutable"},
+              {"contenttype": "text/html", "cache_control": "max-age=300"}]
+    arch = S3archivist(testbucket, s3=mock.Mock(),
+                       siteconfig={"cache_control": policy})
+    asset = arch.new_resource('site.0123456789ab.css', content='body {}',
+                              contenttype='text/css', resourcetype='asset',
+                              metadata={"asset_key": "site.css"})
+    arch.save(asset)
+    s3obj = arch.s3.put_object.call_args[1]
+    assert s3obj['CacheControl'] == 'public, max-age=31536000, immutable'
+    assert 'Expires' not in s3obj
+
+    page = arch.new_resource('page.html', content='<p>',
+                             contenttype='text/html; charset=utf-8',
+                             resourcetype='artifact', archetype_guid='x')
+    arch.save(page)
+    s3obj = arch.s3.put_object.call_args[1]
+    assert s3obj['CacheControl'] == 'max-age=300'
+    assert 'Expires' not in s3obj
+
+    plain = arch.new_resource('filename.txt', content='contents',
+                              contenttype=contenttype, resourcetype='asset')
+    arch.save(plain)
+    assert 'CacheControl' not in arch.s3.put_object.call_args[1]
+
+
 # Given a bucket
 # When save() is called with a deleted asset
 # Then archivist calls s3.delete_object with correct params
@@ -240,6 +272,69 @@ def test_save_artifact_no_guid():
     assert einfo
 
 
+# Given a bucket
+# When save_stream() is called with content smaller than one part
+# Then archivist sends it, compressed, with a single put_object
+def test_save_stream_small():
+    arch = S3archivist(testbucket, s3=mock.Mock(), siteconfig={})
+    asset = arch.new_resource('filename.txt', contenttype=contenttype,
+                              resourcetype='asset')
+    arch.save_stream(asset, iter([b'con', b'tents']))
+
+    arch.s3.put_object.assert_called_with(
+        Key='filename.txt',
+        Body=mock.ANY,
+        Metadata={"resourcetype": "asset"},
+        ContentType=contenttype,
+        ContentEncoding='gzip',
+        Bucket=testbucket,
+    )
+    body = arch.s3.put_object.call_args[1]['Body']
+    assert gunzip(body) == b'contents'
+    assert not arch.s3.create_multipart_upload.called
+
+
+# Given a bucket
+# When save_stream() is called with content larger than one part
+# Then archivist sends it as a multipart upload
+def test_save_stream_multipart():
+    arch = S3archivist(testbucket, s3=mock.Mock(), siteconfig={})
+    arch.s3.create_multipart_upload.return_value = {"UploadId": "up"}
+    arch.s3.upload_part.side_effect = lambda **kw: {
+        "ETag": "e%d" % kw['PartNumber']}
+    asset = arch.new_resource('filename.bin',
+                              contenttype='application/octet-stream')
+    with mock.patch('bluebucket.archivist.s3.part_size', 4):
+        arch.save_stream(asset, iter([b'abc', b'defgh', b'ij']))
+
+    arch.s3.create_multipart_upload.assert_called_with(
+        Bucket=testbucket, Key='filename.bin',
+        ContentType='application/octet-stream', Metadata={})
+    bodies = [c[1]['Body'] for c in arch.s3.upload_part.call_args_list]
+    assert bodies == [b'abcdefgh', b'ij']
+    arch.s3.complete_multipart_upload.assert_called_with(
+        Bucket=testbucket, Key='filename.bin', UploadId='up',
+        MultipartUpload={"Parts": [{"ETag": "e1", "PartNumber": 1},
+                                   {"ETag": "e2", "PartNumber": 2}]})
+    assert not arch.s3.put_object.called
+
+
+# Given a multipart upload in progress
+# When a part fails to upload
+# Then the upload is aborted and the error raised
+def test_save_stream_multipart_abort():
+    arch = S3archivist(testbucket, s3=mock.Mock(), siteconfig={})
+    arch.s3.create_multipart_upload.return_value = {"UploadId": "up"}
+    arch.s3.upload_part.side_effect = IOError("connection reset")
+    asset = arch.new_resource('filename.bin',
+                              contenttype='application/octet-stream')
+    with mock.patch('bluebucket.archivist.s3.part_size', 4):
+        with pytest.raises(IOError):
+            arch.save_stream(asset, iter([b'abcd', b'efgh']))
+    arch.s3.abort_multipart_upload.assert_called_with(
+        Bucket=testbucket, Key='filename.bin', UploadId='up')
+
+
 ###########################################################################
 # Archivist all_archetypes
 ###########################################################################
@@ -428,3 +523,135 @@ def test_parse_sns_event():
     assert len(result) == 1
     assert type(result[0]) == S3event
 
+
+###########################################################################
+# Archivist get_range and get_head_bytes
+###########################################################################
+def ranged_response(stored, encoding=None):
+    "Return a get_object side effect that honors the Range parameter."
+    def get_object(Bucket, Key, Range):
+        start, end = Range[len('bytes='):].split('-')
+        start = int(start)
+        end = int(end) if end else len(stored) - 1
+        resp = {
+            'Body': BytesIO(stored[start:end + 1]),
+            'ContentType': 'text/markdown; charset=utf-8',
+            'ContentRange': 'bytes %d-%d/%d' % (start, end, len(stored)),
+            'Metadata': {'resourcetype': 'asset'},
+        }
+        if encoding:
+            resp['ContentEncoding'] = encoding
+        return resp
+    return get_object
+
+
+# Given an object stored without compression
+# When get_range() is called
+# Then archivist requests the byte range and reports the total length
+def test_get_range():
+    arch = S3archivist(testbucket, s3=mock.Mock(), siteconfig={})
+    stored = stubs.text_content.encode('utf-8')
+    arch.s3.get_object.side_effect = ranged_response(stored)
+    reso = arch.get_range('filename.md', 0, 9)
+    assert reso.content == stored[:10]
+    assert reso.total_length == len(stored)
+    assert reso.key == 'filename.md'
+
+
+# Given an object stored gzip compressed
+# When get_head_bytes() is called
+# Then archivist returns the decompressed beginning of the object
+def test_get_head_bytes_gzip():
+    arch = S3archivist(testbucket, s3=mock.Mock(), siteconfig={})
+    original = ('title: Compressed\n\n' + 'All work and no play. ' * 500)\
+        .encode('utf-8')
+    stored = gzip(original)
+    arch.s3.get_object.side_effect = ranged_response(stored, 'gzip')
+    head, complete = arch.get_head_bytes('filename.md', 64)
+    assert not complete
+    assert original.startswith(head)
+    head, complete = arch.get_head_bytes('filename.md', len(stored) + 10)
+    assert complete
+    assert head == original
+
+
+def make_record(key, method="ObjectCreated:Put", sequencer=None):
+    record = stubs.generate_event(key=key, method=method)['Records'][0]
+    if sequencer is None:
+        del record['s3']['object']['sequencer']
+    else:
+        record['s3']['object']['sequencer'] = sequencer
+    return record
+
+
+# Given a batch with repeated saves of the same key
+# When parse_aws_event() is called with coalesce=True
+# Then only the newest event per key is returned, in order
+def test_parse_aws_event_coalesce():
+    message = {"Records": [
+        make_record('a.md', sequencer='0055AED6DCD90281E5'),
+        make_record('b.md', sequencer='0055AED6DCD90281E6'),
+        make_record('a.md', sequencer='0055AED6DCD90281E7'),
+        make_record('a.md', sequencer='0055AED6DCD90281E6'),  # late arrival
+    ]}
+    assert len(parse_aws_event(message)) == 4
+    result = parse_aws_event(message, coalesce=True)
+    assert [ev.key for ev in result] == ['b.md', 'a.md']
+    assert result[1].sequencer == '0055AED6DCD90281E7'
+
+
+# Given a save followed by a delete of the same key
+# When parse_aws_event() is called with coalesce=True
+# Then only the delete is returned
+def test_parse_aws_event_coalesce_save_then_delete():
+    message = {"Records": [
+        make_record('a.md', sequencer='0A'),
+        make_record('a.md', method='ObjectRemoved:Delete', sequencer='0B'),
+    ]}
+    result = parse_aws_event(message, coalesce=True)
+    assert len(result) == 1
+    assert not result[0].is_save_event
+
+
+# Given events without sequencers
+# When parse_aws_event() is called with coalesce=True
+# Then the last event in the batch wins
+def test_parse_aws_event_coalesce_no_sequencer():
+    message = {"Records": [
+        make_record('a.md', method='ObjectRemoved:Delete'),
+        make_record('a.md'),
+    ]}
+    result = parse_aws_event(message, coalesce=True)
+    assert len(result) == 1
+    assert result[0].is_save_event
+
+
+# Given an event for a key with spaces and non-ascii characters
+# When I construct S3event from it
+# Then the key is URL-decoded, and as_json() round-trips the record
+def test_s3event_decodes_key():
+    event = stubs.generate_event(key='my+folder/caf%C3%A9+menu.md')
+    record = event['Records'][0]
+    ev = S3event(json.loads(json.dumps(record)))
+    assert ev.key == 'my folder/café menu.md'
+    assert json.loads(ev.as_json()) == record
+
+    ev.key = 'other folder/naïve.md'
+    again = S3event(json.loads(ev.as_json()))
+    assert again.key == 'other folder/naïve.md'
+    assert again.event['s3']['object']['key'] == 'other+folder/na%C3%AFve.md'
+
+
+# Given an S3event
+# When its name or time is changed
+# Then the derived fields follow
+def test_s3event_derived_fields():
+    ev = S3event(stubs.generate_event()['Records'][0])
+    assert ev.is_save_event
+    assert ev.datetime.year == 1970
+    ev.name = 'ObjectRemoved:Delete'
+    ev.time = '2016-07-04T12:00:00.000Z'
+    assert not ev.is_save_event
+    assert ev.datetime.year == 2016
+    with pytest.raises(AttributeError):
+        ev.unexpected = True
@@ -0,0 +1,150 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from __future__ import absolute_import, print_function, unicode_literals
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+from botocore.exceptions import ClientError
+from io import BytesIO
+from jinja2 import ChoiceLoader
+from bluebucket.archivist import S3archivist
+from bluebucket.archivist.local import localarchivist
+from bluebucket.templates import BundleLoader, build_bundle, load_bundle
+from bluebucket.templates import template_versions, templates_used
+import hashlib
+import os
+
+testbucket = 'test-bucket'
+templates = {
+    '_templates/base.html': '<html>{% block body %}{% endblock %}</html>',
+    '_templates/Item/Page/Article':
+        '{% extends "base.html" %}{% block body %}{{ title }}{% endblock %}',
+}
+
+
+class FakeS3(object):
+    "Just enough of an S3 client to hold a few objects."
+    def __init__(self, objects):
+        self.objects = dict((k, v.encode('utf-8')) for (k, v) in
+                            objects.items())
+        self.get_object = mock.Mock(side_effect=self._get_object)
+        self.meta = mock.Mock(region_name='us-east-1')
+
+    def _get_object(self, Bucket, Key, **kwargs):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": BytesIO(self.objects[Key]),
+                "ContentType": "text/html; charset=utf-8"}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+        return {"ETag": '"x"'}
+
+    def list_objects(self, Bucket, Prefix, **kwargs):
+        return {"IsTruncated": False, "Contents": [
+            {"Key": k, "ETag": '"%s"' % hashlib.md5(v).hexdigest()}
+            for (k, v) in sorted(self.objects.items())
+            if k.startswith(Prefix)]}
+
+
+# Given a bucket with templates and a compiled bundle
+# When the archivist's jinja environment renders a template
+# Then it is served from the bundle without fetching its source
+def test_bundle_serves_templates():
+    s3 = FakeS3(templates)
+    siteconfig = {"use_template_bundle": True}
+    manifest = build_bundle(S3archivist(testbucket, s3=s3,
+                                        siteconfig=siteconfig))
+    assert sorted(manifest['templates']) == ['Item/Page/Article', 'base.html']
+
+    archivist = S3archivist(testbucket, s3=s3, siteconfig=siteconfig)
+    assert isinstance(archivist.jinja.loader, ChoiceLoader)
+    s3.get_object.reset_mock()
+    html = archivist.jinja.get_template('Item/Page/Article').render(title='Hi')
+    assert html == '<html>Hi</html>'
+    assert not s3.get_object.called
+
+
+# Given a bundle built before a template was edited
+# When the bundle is loaded
+# Then the edited template is not served from it
+def test_stale_templates_not_served(tmpdir_path):
+    s3 = FakeS3(templates)
+    archivist = S3archivist(testbucket, s3=s3, siteconfig={})
+    build_bundle(archivist)
+    s3.objects['_templates/base.html'] = b'<body>{% block body %}{% endblock %}'
+
+    loader = load_bundle(archivist, directory=tmpdir_path)
+    assert isinstance(loader, BundleLoader)
+    assert loader.stale == set(['base.html'])
+
+
+def test_no_bundle(tmpdir_path):
+    archivist = S3archivist(testbucket, s3=FakeS3(templates), siteconfig={})
+    assert load_bundle(archivist) is None
+    assert load_bundle(localarchivist(tmpdir_path, siteconfig={})) is None
+
+
+# Given the same templates in an S3 bucket and in a local one
+# When their versions are listed
+# Then both give the md5 of each template's source
+def test_template_versions(tmpdir_path):
+    for (key, source) in templates.items():
+        filename = os.path.join(tmpdir_path, *key.split('/'))
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(source.encode('utf-8'))
+    local = template_versions(localarchivist(tmpdir_path, siteconfig={}))
+    s3 = template_versions(S3archivist(testbucket, s3=FakeS3(templates),
+                                       siteconfig={}))
+    assert local == s3
+    assert s3['base.html'] == hashlib.md5(
+        templates['_templates/base.html'].encode('utf-8')).hexdigest()
+
+
+# Given a template that extends another
+# When templates_used() is called
+# Then both are reported, with their versions
+# And each version is parsed only once
+def test_templates_used():
+    s3 = FakeS3(templates)
+    archivist = S3archivist(testbucket, s3=s3, siteconfig={})
+    used = templates_used(archivist, 'Item/Page/Article')
+    assert sorted(used) == ['Item/Page/Article', 'base.html']
+    assert used['base.html'] == hashlib.md5(
+        s3.objects['_templates/base.html']).hexdigest()
+
+    s3.get_object.reset_mock()
+    s3.objects['_templates/base.html'] = b'<body>{% block body %}{% endblock %}'
+    changed = templates_used(archivist, 'Item/Page/Article')
+    assert changed['base.html'] != used['base.html']
+    assert changed['Item/Page/Article'] == used['Item/Page/Article']
+    assert s3.get_object.call_count == 1  # only the changed template
+
+
+# Given a template that includes one chosen at runtime
+# When templates_used() is called
+# Then every template is reported, since any could be used
+def test_templates_used_dynamic():
+    s3 = FakeS3(dict(templates, **{
+        '_templates/dynamic.html': '{% include page_template %}'}))
+    archivist = S3archivist(testbucket, s3=s3, siteconfig={})
+    used = templates_used(archivist, 'dynamic.html')
+    assert sorted(used) == ['Item/Page/Article', 'base.html', 'dynamic.html']
@@ -15,6 +15,17 @@
 #   limitations under the License.
 #
 from __future__ import absolute_import, print_function, unicode_literals
+try:
+    import mock
+except ImportError:
+    import unittest.mock as mock
+
+import datetime
+from dateutil.parser import parse as parse_date
+from dateutil.tz import tzutc
+import pytest
+import pytz
+import bluebucket.util as util
 from bluebucket.util import is_sequence, gzip, gunzip
 
 
@@ -36,3 +47,53 @@ def test_gzip_handling():
     text = 'This is my baño. There are many like it but this one is mine.'
     assert text == gunzip(gzip(text.encode('utf-8'))).decode('utf-8')
 
+
+# Given a stream of chunks
+# When compressed with gzip_stream
+# Then the result gunzips to the same bytes
+def test_gzip_stream():
+    chunks = [('<p>%d</p>' % n).encode('ascii') for n in range(1000)]
+    compressed = b''.join(util.gzip_stream(iter(chunks)))
+    assert gunzip(compressed) == b''.join(chunks)
+    assert gunzip(b''.join(util.gzip_stream([]))) == b''
+
+
+def test_rechunk():
+    chunks = list(util.rechunk([b'ab', b'cd', b'e', b'f', b'g'], 3))
+    assert chunks == [b'abcd', b'efg']
+    assert list(util.rechunk([], 3)) == []
+
+
+#############################################################################
+# Test date parsing
+#############################################################################
+def test_parse_datetime_iso_fast_path():
+    samples = ['2015-11-03', '2016-06-23T03:02:47.174Z',
+               '2016-06-23T03:02:47+00:00', '2016-06-23 03:02:47-0500',
+               '2016-06-23T03:02', '2016-06-23T03:02:47.123456789+05:30']
+    with mock.patch.object(util, 'parse_date') as slow:
+        parsed = [util.parse_datetime(text) for text in samples]
+    assert not slow.called
+    for (text, dt) in zip(samples, parsed):
+        expected = parse_date(text)
+        assert dt == expected
+        assert (dt.tzinfo is None) == (expected.tzinfo is None)
+    assert parsed[1].tzinfo == tzutc()
+    # On Python 2, a native (byte) str with a fraction parses the same
+    assert util.parse_datetime(str('2020-01-01T00:00:00.5Z')) ==\
+        datetime.datetime(2020, 1, 1, 0, 0, 0, 500000, tzutc())
+
+
+def test_parse_datetime_fallback():
+    assert util.parse_datetime('July 4, 2016 3:00 PM') ==\
+        datetime.datetime(2016, 7, 4, 15, 0)
+    with pytest.raises(ValueError):
+        util.parse_datetime('2016-13-01T00:00')
+
+
+def test_normalize_datetime():
+    eastern = pytz.timezone('America/New_York')
+    dt = util.normalize_datetime('2016-07-04', eastern)
+    assert dt.isoformat() == '2016-07-04T00:00:00-04:00'
+    dt = util.normalize_datetime('2016-07-04T16:00:00Z', eastern)
+    assert dt.isoformat() == '2016-07-04T12:00:00-04:00'
@@ -21,3 +21,4 @@ from __future__ import absolute_import, print_function, unicode_literals
 from .scribe.markdown import source_text_mardown_to_archetype  # noqa
 from .indexer.item import update_item_index  # noqa
 from .scribe.page_to_html import item_page_to_html  # noqa
+from .indexer.debounce import flush_pending_catalogs  # noqa
@@ -0,0 +1,381 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Bulk operations over many documents at once.
+
+`convert` turns a tree of markdown sources into archetypes without going
+through a Lambda invocation per document. The sources may be a local directory
+or a key prefix in the archive. Conversion is CPU bound, so it runs on a pool
+of processes; the archetypes are written through the archivist in batches by
+the calling process.
+
+`rebuild` renders the HTML of every archetype (or those matching filters)
+again, e.g. after a template change. Worker processes fetch and render the
+archetypes; the calling process uploads the results concurrently and records
+finished keys in an optional checkpoint file, so an interrupted rebuild can
+resume where it left off. Given template names, it renders only the pages
+recorded as using them (see `webquills.indexer.depends`); pages not rendered
+since dependency tracking began are not recorded, so rebuild everything once
+first.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from concurrent.futures import ProcessPoolExecutor
+from io import open
+import logging
+import multiprocessing
+import os
+import pytz
+import time
+from bluebucket.archivist import S3archivist, is_missing
+from bluebucket.archivist.local import localarchivist
+from bluebucket.util import normalize_datetime, parse_datetime
+from webquills.indexer.depends import forget_templates
+from webquills.indexer.depends import template_dependents
+from webquills.scribe import page_to_html
+from webquills.scribe.markdown import to_archetype
+
+logger = logging.getLogger(__name__)
+default_batch_size = 100
+
+
+class ConvertContext(object):
+    """
+    The parts of an archivist that `to_archetype` needs. Unlike an archivist,
+    it holds no connections and can be pickled to worker processes.
+    """
+    def __init__(self, bucket, siteconfig, pathstrategy):
+        self.bucket = bucket
+        self.siteconfig = siteconfig
+        self.pathstrategy = pathstrategy
+
+    @classmethod
+    def from_archivist(cls, archivist):
+        return cls(archivist.bucket, archivist.siteconfig,
+                   archivist.pathstrategy)
+
+
+class Report(object):
+    "Counts and timing for a batch operation."
+    def __init__(self):
+        self.succeeded = 0
+        self.skipped = 0
+        self.failures = []  # list of (name, error message)
+        self.started = time.time()
+        self.finished = None
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self):
+        "Documents processed per second."
+        total = self.succeeded + len(self.failures)
+        return total / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return ("%d succeeded, %d failed, %d skipped in %.1fs (%.1f docs/s)" %
+                (self.succeeded, len(self.failures), self.skipped,
+                 self.elapsed, self.rate))
+
+
+def local_sources(directory):
+    "Yield (name, text) for every markdown file under directory."
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.md'):
+                name = os.path.join(dirpath, filename)
+                with open(name, encoding='utf-8') as f:
+                    yield (name, f.read())
+
+
+def archive_sources(archivist, prefix):
+    "Yield (key, text) for every markdown source in the archive under prefix."
+    for key in archivist.list_keys(prefix):
+        if key.endswith('.md'):
+            yield (key, archivist.get(key).text)
+
+
+def _convert_one(context, name, text):
+    # Runs in a worker process. Errors are returned rather than raised, so
+    # one bad document does not cost us the rest of the chunk.
+    try:
+        return (name, to_archetype(context, text), None)
+    except Exception as e:
+        return (name, None, "%s: %s" % (type(e).__name__, e))
+
+
+def _convert_chunk(context, chunk):
+    return [_convert_one(context, name, text) for (name, text) in chunk]
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def convert(archivist, source, max_workers=None, batch_size=None):
+    """
+    Convert every markdown source under `source`, a local directory or a key
+    prefix in the archive, to an archetype saved through `archivist`. Uses
+    max_workers processes (default, one per CPU; 1 converts in this
+    process). Archetypes are persisted batch_size at a time. Returns a Report.
+    """
+    batch_size = batch_size or default_batch_size
+    if os.path.isdir(source):
+        sources = local_sources(source)
+    else:
+        sources = archive_sources(archivist, source)
+    context = ConvertContext.from_archivist(archivist)
+    report = Report()
+
+    def persist(results):
+        batch = []
+        for (name, archetype, error) in results:
+            if error:
+                logger.error("Failed converting %s: %s" % (name, error))
+                report.failures.append((name, error))
+                continue
+            resource = archivist.new_resource(
+                key=archetype['Item']['archetype']['key'],
+                data=archetype,
+                contenttype='application/json',
+                resourcetype='archetype',
+                acl='public-read')
+            batch.append(resource)
+        archivist.persist(batch)
+        report.succeeded += len(batch)
+        logger.info(str(report))
+
+    chunks = _chunks(sources, batch_size)
+    if max_workers == 1:
+        for chunk in chunks:
+            persist(_convert_chunk(context, chunk))
+    else:
+        workers = max_workers or multiprocessing.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Chunks are submitted as they are read, and persisted in order
+            # as they complete, so memory stays bounded by the pool's queue.
+            pending = []
+            for chunk in chunks:
+                pending.append(executor.submit(_convert_chunk, context, chunk))
+                while pending and (pending[0].done() or
+                                   len(pending) > 2 * workers):
+                    persist(pending.pop(0).result())
+            for future in pending:
+                persist(future.result())
+    report.finish()
+    return report
+
+
+#######################################################################
+# Rebuild
+#######################################################################
+class ArchivistSpec(object):
+    "How to create an archivist again in a worker process."
+    def __init__(self, kind, bucket, siteconfig):
+        self.kind = kind
+        self.bucket = bucket
+        self.siteconfig = siteconfig
+
+    @classmethod
+    def from_archivist(cls, archivist):
+        kind = 'local' if isinstance(archivist, localarchivist) else 's3'
+        return cls(kind, archivist.bucket, archivist.siteconfig)
+
+    def create(self):
+        if self.kind == 'local':
+            return localarchivist(self.bucket, siteconfig=self.siteconfig)
+        return S3archivist(self.bucket, siteconfig=self.siteconfig)
+
+
+def _aware(value, timezone):
+    "A date-time string or datetime as an aware datetime, see Filters."
+    if hasattr(value, 'tzinfo'):
+        if value.tzinfo is not None:
+            return value
+        value = value.isoformat()
+    return normalize_datetime(value, timezone)
+
+
+class Filters(object):
+    """
+    Which archetypes to rebuild. Unset filters match everything. Naive times,
+    in since or in an item's `updated`, are taken to be in the site's
+    timezone. Items without `updated` match any since: they cannot be shown
+    to be older, and rebuilding is the safe choice.
+    """
+    def __init__(self, itemtype=None, category=None, since=None,
+                 templates=None):
+        self.templates = templates or []
+        self.itemtype = itemtype.strip('/') if itemtype else None
+        self.category = category.strip('/') if category else None
+        if since and not hasattr(since, 'tzinfo'):
+            parse_datetime(since)  # ValueError now, not once per item
+        self.since = since
+
+    def prefix(self, archivist):
+        "The key prefix holding the archetypes that can match."
+        prefix = archivist.pathstrategy.archetype_prefix
+        return prefix + self.itemtype + '/' if self.itemtype else prefix
+
+    def keys(self, archivist):
+        "Return the keys of the archetypes that can match."
+        prefix = self.prefix(archivist)
+        if self.templates:
+            keys = set()
+            for template in self.templates:
+                keys.update(template_dependents(archivist, template))
+            keys = sorted(k for k in keys if k.startswith(prefix))
+        else:
+            keys = archivist.list_keys(prefix)
+        # Config (_A/_deps/, _A/_cache/ etc.) is kept under names beginning
+        # with an underscore.
+        root = archivist.pathstrategy.archetype_prefix
+        return [k for k in keys if k.endswith('.json') and
+                not k[len(root):].startswith('_') and
+                k != root + 'site.json']
+
+    def match(self, item, timezone=pytz.utc):
+        if self.category:
+            name = (item.get('category') or {}).get('name', '')
+            if not (name == self.category or
+                    name.startswith(self.category + '/')):
+                return False
+        if self.since and item.get('updated'):
+            if _aware(item['updated'], timezone) < \
+                    _aware(self.since, timezone):
+                return False
+        return True
+
+
+_archivists = {}  # per worker process, see _render_chunk
+
+
+def _render_one(archivist, filters, key):
+    try:
+        try:
+            resource = archivist.get(key)
+        except Exception as e:
+            if not is_missing(e):
+                raise
+            forget_templates(archivist, key)  # removed since recorded
+            return (key, None, None)
+        timezone = archivist.siteconfig.get('timezone', pytz.utc)
+        if resource.resourcetype != 'archetype' or \
+                not filters.match(resource.data['Item'], timezone):
+            return (key, None, None)
+        return (key, page_to_html.render(archivist, resource), None)
+    except Exception as e:
+        return (key, None, "%s: %s" % (type(e).__name__, e))
+
+
+def _render_chunk(spec, filters, keys):
+    # Runs in a worker process, which keeps one archivist (and its S3
+    # client) for all the chunks it is given.
+    ident = (spec.kind, spec.bucket)
+    if ident not in _archivists:
+        _archivists[ident] = spec.create()
+    archivist = _archivists[ident]
+    return [_render_one(archivist, filters, key) for key in keys]
+
+
+def read_checkpoint(filename):
+    "Return the set of keys recorded as done in a checkpoint file."
+    if not filename or not os.path.exists(filename):
+        return set()
+    with open(filename, encoding='utf-8') as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def rebuild(archivist, filters=None, max_workers=None, batch_size=None,
+            checkpoint=None, upload_workers=8):
+    """
+    Render the HTML for every archetype matching filters and publish it.
+    Archetypes are fetched and rendered by max_workers processes (default,
+    one per CPU; 1 renders in this process), and the results uploaded
+    upload_workers at a time. Keys finished are appended to the checkpoint
+    file, if given, and skipped when it is used again; keys that did not
+    match the filters are not recorded. Returns a Report.
+    """
+    filters = filters or Filters()
+    batch_size = batch_size or default_batch_size
+    done = read_checkpoint(checkpoint)
+    report = Report()
+    keys = []
+    for key in filters.keys(archivist):
+        if key in done:
+            report.skipped += 1
+        else:
+            keys.append(key)
+    log = open(checkpoint, 'a', encoding='utf-8') if checkpoint else None
+
+    def persist(results):
+        batch = []
+        finished = []
+        for (key, monograph, error) in results:
+            if error:
+                logger.error("Failed rendering %s: %s" % (key, error))
+                report.failures.append((key, error))
+                continue
+            if monograph is None:
+                report.skipped += 1
+                continue
+            monograph.acl = 'public-read'
+            batch.append(monograph)
+            finished.append(key)
+        archivist.persist(batch, max_workers=upload_workers)
+        report.succeeded += len(batch)
+        if log:
+            log.write(''.join('%s\n' % key for key in finished))
+            log.flush()
+        logger.info(str(report))
+
+    try:
+        chunks = _chunks(keys, batch_size)
+        if max_workers == 1:
+            for chunk in chunks:
+                persist([_render_one(archivist, filters, key)
+                         for key in chunk])
+        else:
+            spec = ArchivistSpec.from_archivist(archivist)
+            workers = max_workers or multiprocessing.cpu_count()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = []
+                for chunk in chunks:
+                    pending.append(executor.submit(_render_chunk, spec,
+                                                   filters, chunk))
+                    while pending and (pending[0].done() or
+                                       len(pending) > 2 * workers):
+                        persist(pending.pop(0).result())
+                for future in pending:
+                    persist(future.result())
+    finally:
+        if log:
+            log.close()
+    report.finish()
+    return report
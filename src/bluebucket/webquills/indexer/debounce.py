@@ -0,0 +1,213 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Coalesce catalog renders over a window of time.
+
+Publishing many items in a burst invalidates the same catalogs over and over.
+Rather than render a catalog once per item, invalidations are collected and
+each affected catalog is rendered once per window. The window, in seconds, is
+the siteconfig setting `catalog_render_window`. With the default of 0,
+catalogs are rendered as soon as the current batch of events is done.
+
+In Lambda there is no process that outlives a batch, so catalogs waiting on a
+window are marked pending in the archive, under `_A/_pending/catalogs/`, and
+`flush_pending_catalogs` renders the ones that are due. The stack that
+`init_bucket` creates runs it every minute from a CloudWatch Events rule with
+the constant input `{"bucket": "<bucket name>"}`.
+
+Locally, `CatalogDebouncer` holds the pending catalogs in memory and renders
+them from a timer thread when the window closes.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from collections import OrderedDict
+from dateutil.tz import tzutc
+import datetime
+import hashlib
+import logging
+import posixpath as path
+import threading
+from bluebucket.archivist import S3archivist, is_missing
+from bluebucket.util import parse_datetime
+from webquills.indexer.depends import render_catalogs
+
+logger = logging.getLogger(__name__)
+
+
+def render_window(archivist):
+    "The catalog render window for the archivist's site, in seconds."
+    return float(archivist.siteconfig.get('catalog_render_window', 0) or 0)
+
+
+#######################################################################
+# Pending markers, for Lambda
+#######################################################################
+def pending_prefix(archivist):
+    return archivist.pathstrategy.path_for(resourcetype='config',
+                                           key='_pending/catalogs/')
+
+
+def pending_key(archivist, catalog_key):
+    digest = hashlib.sha1(catalog_key.encode('utf-8')).hexdigest()
+    return path.join(pending_prefix(archivist), digest + '.json')
+
+
+def mark_pending(archivist, catalog_keys, now=None):
+    """
+    Mark catalogs to be rendered when the window closes. A catalog already
+    pending keeps its original due time, so a steady stream of invalidations
+    cannot postpone it forever. Returns the keys newly marked.
+    """
+    now = now or datetime.datetime.now(tzutc())
+    due = now + datetime.timedelta(seconds=render_window(archivist))
+    marked = []
+    for catalog_key in catalog_keys:
+        key = pending_key(archivist, catalog_key)
+        try:
+            archivist.get(key)
+            continue
+        except Exception as e:
+            if not is_missing(e):
+                raise
+        marker = archivist.new_resource(
+            key, data={"catalog": catalog_key, "due": due},
+            contenttype='application/json', resourcetype='config')
+        archivist.save(marker)
+        marked.append(catalog_key)
+    return marked
+
+
+def flush_due(archivist, render, now=None, failures=None):
+    """
+    Render the pending catalogs whose window has closed, and clear their
+    markers. A catalog that fails to render is marked pending again and the
+    rest are still rendered; if failures is a list, (catalog_key, exception)
+    is appended to it. Returns the keys of the catalogs rendered.
+    """
+    now = now or datetime.datetime.now(tzutc())
+    due = []
+    for key in archivist.list_keys(pending_prefix(archivist)):
+        try:
+            marker = archivist.get(key).data
+        except Exception as e:
+            if not is_missing(e):
+                raise
+            continue  # flushed by someone else
+        if parse_datetime(marker['due']) <= now:
+            due.append((key, marker['catalog']))
+    rendered = []
+    for (key, catalog_key) in due:
+        # Clear the marker first: an invalidation that arrives while we render
+        # must mark the catalog again rather than be lost.
+        archivist.delete(key)
+        try:
+            rendered.extend(render_catalogs(archivist, [catalog_key], render))
+        except Exception as e:
+            logger.exception("Failed rendering catalog %s" % catalog_key)
+            mark_pending(archivist, [catalog_key], now=now)
+            if failures is not None:
+                failures.append((catalog_key, e))
+    return rendered
+
+
+def schedule_catalogs(archivist, catalog_keys, render, now=None):
+    """
+    Render the catalogs now if the site has no render window, otherwise mark
+    them pending for `flush_due`. Returns the keys rendered now.
+    """
+    if render_window(archivist) <= 0:
+        return render_catalogs(archivist, catalog_keys, render)
+    mark_pending(archivist, catalog_keys, now=now)
+    return []
+
+
+# THIS IS THE LAMBDA HANDLER:
+def flush_pending_catalogs(message, context):
+    "On a schedule, render the catalogs whose render window has closed."
+    # imported here because page_to_html imports the indexer
+    from webquills.scribe import page_to_html
+    archivist = S3archivist(message['bucket'])
+    failures = []
+    rendered = flush_due(archivist, page_to_html.on_save, failures=failures)
+    logger.info("Rendered %d pending catalog(s)" % len(rendered))
+    if failures:
+        # Fail the invocation so it shows in the function's error metrics.
+        raise RuntimeError("%d catalog(s) failed: %s" % (
+            len(failures), "; ".join("%s: %s" % f for f in failures)))
+
+
+#######################################################################
+# In-process debouncing, for local use
+#######################################################################
+class CatalogDebouncer(object):
+    """
+    Collect catalog invalidations and render each catalog once when the
+    window closes. If window is None, the site's `catalog_render_window` is
+    used. Call `flush()` to render everything pending immediately. Failures
+    are collected in `failures`, and passed to
+    on_failure(archivist, catalog_key, exception) if given.
+    """
+    def __init__(self, render, window=None, on_failure=None):
+        self.render = render
+        self.window = window
+        self.on_failure = on_failure
+        self.failures = []  # list of (catalog_key, exception)
+        self._lock = threading.Lock()
+        self._render_lock = threading.Lock()
+        self._pending = OrderedDict()  # (bucket, key) -> archivist
+        self._timer = None
+
+    def add(self, archivist, catalog_keys):
+        with self._lock:
+            for key in catalog_keys:
+                self._pending[(archivist.bucket, key)] = archivist
+            if self._pending and self._timer is None:
+                window = self.window
+                if window is None:
+                    window = render_window(archivist)
+                self._timer = threading.Timer(window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        "Render every pending catalog now. Returns the keys rendered."
+        with self._lock:
+            (pending, self._pending) = (self._pending, OrderedDict())
+            (timer, self._timer) = (self._timer, None)
+        if timer is not None:
+            timer.cancel()
+        rendered = []
+        # Only one flush renders at a time, so a flush that returns has
+        # waited for any render already in progress.
+        with self._render_lock:
+            for ((bucket, key), archivist) in pending.items():
+                try:
+                    rendered.extend(
+                        render_catalogs(archivist, [key], self.render))
+                except Exception as e:
+                    logger.exception("Failed rendering catalog %s" % key)
+                    self.failures.append((key, e))
+                    if self.on_failure is not None:
+                        self.on_failure(archivist, key, e)
+        return rendered
+
+    def cancel(self):
+        "Forget pending catalogs without rendering them."
+        with self._lock:
+            self._pending.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
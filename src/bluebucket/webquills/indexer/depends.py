@@ -0,0 +1,331 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Reverse dependencies between pages and the things they are built from.
+
+When a catalog page is rendered, the partition of the item index its query
+reads (its `bucket_itemclass`) and the key conditions it applies are recorded
+against the catalog. When an item is saved to or removed from the index, only
+the catalogs whose recorded query could match the old or new version of the
+item need to be rendered again.
+
+When any page is rendered, the templates it loaded are recorded too, so that
+after a template edit only the pages that use it need rendering again.
+
+Each (dependency, dependent) pair is stored as a small JSON marker object,
+`_A/_deps/<namespace>/<dependency hash>/<dependent key>`, holding a detail
+dict describing how the dependent depends on it. The dependents of a
+dependency are found by listing its prefix. Renders run concurrently, and
+one object per pair means no record is ever read, changed and written back.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from bluebucket.archivist import is_missing
+import hashlib
+import logging
+import posixpath as path
+import re
+
+logger = logging.getLogger(__name__)
+item_table = 'webquills-item-by-class'
+partition_attr = 'bucket_itemclass'
+ANY = '*'  # dependency name for queries we cannot pin to a partition
+
+_comparison = re.compile(r'(#?\w+)\s*(=|<>|<=|>=|<|>)\s*(:\w+)')
+_begins_with = re.compile(r'begins_with\s*\(\s*(#?\w+)\s*,\s*(:\w+)\s*\)',
+                          re.IGNORECASE)
+_between = re.compile(r'(#?\w+)\s+between\s+(:\w+)\s+and\s+(:\w+)',
+                      re.IGNORECASE)
+
+
+class DependencyIndex(object):
+    """
+    Records of which dependents depend on which dependencies. Each pair is a
+    marker object of its own, `_A/_deps/<namespace>/<dependency hash>/
+    <dependent>`, holding the detail, so that processes recording
+    dependencies at the same time cannot overwrite one another's records.
+    """
+    def __init__(self, archivist, namespace):
+        self.archivist = archivist
+        self.namespace = namespace
+
+    def prefix_for(self, dependency):
+        "The key prefix of the markers for dependency."
+        # Dependency names may contain any characters, so the key is a hash.
+        digest = hashlib.sha1(dependency.encode('utf-8')).hexdigest()
+        return self.archivist.pathstrategy.path_for(
+            resourcetype='config',
+            key=path.join('_deps', self.namespace, digest, ''))
+
+    def names(self, dependency):
+        "Return the sorted dependents of the dependency."
+        prefix = self.prefix_for(dependency)
+        return sorted(key[len(prefix):]
+                      for key in self.archivist.list_keys(prefix))
+
+    def _detail(self, key):
+        try:
+            return self.archivist.get(key).data.get('detail', {})
+        except Exception as e:
+            if not is_missing(e):
+                raise
+            return None
+
+    def dependents(self, dependency):
+        "Return a dict of dependent -> detail for the dependency."
+        prefix = self.prefix_for(dependency)
+        dependents = {}
+        for dependent in self.names(dependency):
+            detail = self._detail(prefix + dependent)
+            if detail is not None:  # unless removed since listed
+                dependents[dependent] = detail
+        return dependents
+
+    def add(self, dependency, dependent, detail=None):
+        "Record that dependent depends on dependency. Writes only on change."
+        key = self.prefix_for(dependency) + dependent
+        detail = detail or {}
+        if self._detail(key) == detail:
+            return
+        resource = self.archivist.new_resource(
+            key, data={"dependency": dependency, "detail": detail},
+            contenttype='application/json', resourcetype='config')
+        self.archivist.save(resource)
+
+    def remove(self, dependency, dependent):
+        try:
+            self.archivist.delete(self.prefix_for(dependency) + dependent)
+        except Exception as e:
+            if not is_missing(e):
+                raise
+
+
+#######################################################################
+# Catalog queries
+#######################################################################
+def _scalar(typed):
+    # DynamoDB values are typed, e.g. {"S": "text"} or {"N": "5"}
+    (kind, value) = list(typed.items())[0]
+    return float(value) if kind == 'N' else value
+
+
+def query_dependency(query):
+    """
+    Describe what a catalog query reads from the item index. Returns a tuple
+    (dependency, detail): the partition value the query is pinned to (or ANY),
+    and a dict holding the other key conditions as (attribute, operator,
+    values) lists, plus whether a FilterExpression narrows it further.
+    Returns (None, None) if the query does not read the item index.
+    """
+    if query.get('TableName', item_table) != item_table:
+        return (None, None)
+    names = query.get('ExpressionAttributeNames', {})
+    values = query.get('ExpressionAttributeValues', {})
+    expression = query.get('KeyConditionExpression', '')
+
+    def name(token):
+        return names.get(token, token)
+
+    def value(token):
+        return _scalar(values[token])
+
+    conditions = []
+    for (attr, low, high) in _between.findall(expression):
+        conditions.append([name(attr), 'between', [value(low), value(high)]])
+    expression = _between.sub('', expression)
+    for (attr, token) in _begins_with.findall(expression):
+        conditions.append([name(attr), 'begins_with', [value(token)]])
+    expression = _begins_with.sub('', expression)
+    for (attr, op, token) in _comparison.findall(expression):
+        conditions.append([name(attr), op, [value(token)]])
+
+    dependency = ANY
+    for (attr, op, vals) in conditions:
+        if attr == partition_attr and op == '=':
+            dependency = vals[0]
+    detail = {
+        "conditions": [c for c in conditions if c[0] != partition_attr],
+        "filtered": 'FilterExpression' in query,
+    }
+    return (dependency, detail)
+
+
+def could_match(detail, record):
+    """
+    True if an index record could be among the results of a query with the
+    given detail. A FilterExpression is not evaluated, so this errs toward
+    True for filtered queries.
+    """
+    for (attr, op, vals) in detail.get('conditions', []):
+        actual = record.get(attr)
+        if actual is None:
+            return False  # the record is not in this index
+        if isinstance(vals[0], float):
+            actual = float(actual)
+        if op == '=':
+            ok = actual == vals[0]
+        elif op == '<>':
+            ok = actual != vals[0]
+        elif op == '<':
+            ok = actual < vals[0]
+        elif op == '<=':
+            ok = actual <= vals[0]
+        elif op == '>':
+            ok = actual > vals[0]
+        elif op == '>=':
+            ok = actual >= vals[0]
+        elif op == 'begins_with':
+            ok = actual.startswith(vals[0])
+        elif op == 'between':
+            ok = vals[0] <= actual <= vals[1]
+        else:
+            ok = True
+        if not ok:
+            return False
+    return True
+
+
+def catalog_index(archivist):
+    return DependencyIndex(archivist, 'catalog')
+
+
+def _catalog_reads(archivist):
+    # The reverse mapping, catalog key -> dependencies it is recorded under,
+    # so a catalog can be forgotten without knowing its query.
+    return DependencyIndex(archivist, 'catalog-reads')
+
+
+def record_catalog(archivist, catalog_key, query):
+    "Record which part of the item index the catalog at catalog_key reads."
+    (dependency, detail) = query_dependency(query)
+    if dependency is None:
+        logger.debug("Query for %s does not read the item index" % catalog_key)
+        return
+    index = catalog_index(archivist)
+    reads = _catalog_reads(archivist)
+    for previous in reads.names(catalog_key):
+        if previous != dependency:  # the query moved to another partition
+            index.remove(previous, catalog_key)
+            reads.remove(catalog_key, previous)
+    index.add(dependency, catalog_key, detail)
+    reads.add(catalog_key, dependency)
+
+
+def affected_catalogs(archivist, records):
+    """
+    Return the sorted keys of catalogs whose queries could include any of
+    the given index records (typically the old and new versions of an item).
+    """
+    index = catalog_index(archivist)
+    records = [r for r in records if isinstance(r, dict)]
+    partitions = set(r[partition_attr] for r in records if partition_attr in r)
+    catalogs = set()
+    for dependency in partitions | set([ANY]):
+        relevant = [r for r in records if dependency == ANY or
+                    r.get(partition_attr) == dependency]
+        for (catalog, detail) in index.dependents(dependency).items():
+            if any(could_match(detail, r) for r in relevant):
+                catalogs.add(catalog)
+    # A catalog is not invalidated by its own index record.
+    catalogs -= set(r.get('s3key') for r in records)
+    return sorted(catalogs)
+
+
+def invalidate_catalogs(archivist, records, render):
+    """
+    Call render(archivist, catalog_resource) for every catalog affected by
+    the index records. Catalogs that no longer exist are forgotten.
+    """
+    return render_catalogs(archivist, affected_catalogs(archivist, records),
+                           render)
+
+
+def render_catalogs(archivist, catalog_keys, render):
+    """
+    Call render(archivist, catalog_resource) once for each catalog key.
+    Catalogs that no longer exist are forgotten. Returns the rendered keys.
+    """
+    rendered = []
+    for catalog_key in catalog_keys:
+        try:
+            catalog = archivist.get(catalog_key)
+        except Exception as e:
+            if not is_missing(e):
+                raise
+            logger.info("Forgetting removed catalog %s" % catalog_key)
+            forget_catalog(archivist, catalog_key)
+            continue
+        render(archivist, catalog)
+        rendered.append(catalog_key)
+    return rendered
+
+
+def forget_catalog(archivist, catalog_key):
+    "Remove every recorded dependency of the catalog at catalog_key."
+    index = catalog_index(archivist)
+    reads = _catalog_reads(archivist)
+    for dependency in reads.names(catalog_key):
+        index.remove(dependency, catalog_key)
+        reads.remove(catalog_key, dependency)
+
+
+#######################################################################
+# Templates
+#######################################################################
+def _template_index(archivist):
+    return DependencyIndex(archivist, 'templates')
+
+
+def template_prefix(archivist, template):
+    "The key prefix of the markers for pages that use template."
+    return _template_index(archivist).prefix_for(template)
+
+
+def _template_uses(archivist):
+    # The reverse mapping, page key -> templates it uses, so that markers
+    # can be removed when a page stops using a template.
+    return DependencyIndex(archivist, 'template-uses')
+
+
+def record_templates(archivist, dependent, templates):
+    """
+    Record that the page built from the archetype at key dependent uses
+    exactly the named templates. Writes only what changed.
+    """
+    templates = set(templates)
+    index = _template_index(archivist)
+    uses = _template_uses(archivist)
+    previous = set(uses.names(dependent))
+    if templates == previous:
+        return
+    # Markers first, so that if writing one fails, the reverse record still
+    # says it is missing and it is tried again next time.
+    for template in sorted(templates - previous):
+        index.add(template, dependent)
+        uses.add(dependent, template)
+    for template in sorted(previous - templates):
+        index.remove(template, dependent)
+        uses.remove(dependent, template)
+
+
+def template_dependents(archivist, template):
+    "Return the sorted keys of the archetypes whose pages use template."
+    return _template_index(archivist).names(template)
+
+
+def forget_templates(archivist, dependent):
+    "Remove the recorded templates of the page built from dependent."
+    record_templates(archivist, dependent, [])
@@ -0,0 +1,515 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+The site's Atom feed and sitemaps, kept up to date as items are saved and
+removed.
+
+Building either from scratch reads every item in the site, so instead each
+item event updates some state kept in the archive, and only the XML it
+affects is written again. As with `webquills.indexer.depends`, the state is
+one small marker object per item, so that items saved at the same time
+never overwrite each other's state:
+
+* The feed is backed by markers for the most recently updated items, at most
+  twice the siteconfig `feed_size` (default 20), under `_A/_feeds/recent/`,
+  named by the time the item was updated. The spare entries fill the feed
+  back up when items in it are removed. Only items whose itemtype begins
+  with one of `feed_itemtypes` (default `["Item/Page/Article"]`) are
+  included.
+* Sitemap URLs are sharded by the hash of the item's archetype key. Each URL
+  is a marker under `_A/_sitemap/urls/<hash>/<lastmod>/<path>`, so a shard
+  is written from a listing, without reading its markers. A shard holds at
+  most `max_urls`, the protocol's limit of 50,000; one that grows past it is
+  split in 16 by the next hex digit of the hash. The shards are markers
+  under `_A/_sitemap/shards/`, and `sitemap.xml` is a sitemap index of the
+  shards, `sitemaps/sitemap-<prefix>.xml`.
+
+After writing its marker, an update lists the markers again once it has
+published the XML, and publishes again if they changed meanwhile. So of
+concurrent updates, the last to publish has seen every marker written
+before it. `rebuild` (`quill rebuild-feeds`) regenerates everything from the
+archive.
+
+URLs are made absolute with the siteconfig `base_url`.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from datetime import datetime
+from xml.sax.saxutils import escape, quoteattr
+import hashlib
+import logging
+import re
+from bluebucket.archivist import is_missing
+
+logger = logging.getLogger(__name__)
+atom_type = 'application/atom+xml'
+sitemap_type = 'application/xml'
+sitemap_ns = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+max_urls = 50000
+max_publish_attempts = 5
+default_feed_size = 20
+
+
+#######################################################################
+# Keys and URLs
+#######################################################################
+def _config_key(archivist, name):
+    return archivist.pathstrategy.path_for(resourcetype='config', key=name)
+
+
+def _artifact_key(archivist, contenttype, folder, name):
+    return archivist.pathstrategy.path_for(resourcetype='artifact',
+                                           contenttype=contenttype,
+                                           category={"name": folder},
+                                           slug=name)
+
+
+def feed_key(archivist):
+    return _artifact_key(archivist, atom_type, '', 'feed')
+
+
+def sitemap_key(archivist):
+    return _artifact_key(archivist, sitemap_type, '', 'sitemap')
+
+
+def _shard_name(prefix):
+    return prefix or 'all'
+
+
+def shard_key(archivist, prefix):
+    return _artifact_key(archivist, sitemap_type, 'sitemaps',
+                         'sitemap-' + _shard_name(prefix))
+
+
+def url_for(archivist, key):
+    "The absolute URL of a key in the bucket."
+    base = archivist.siteconfig.get('base_url') or ''
+    return base.rstrip('/') + '/' + key
+
+
+def item_path(archivist, item):
+    "The key of an item's page."
+    return archivist.pathstrategy.path_for(
+        **dict(item, resourcetype='artifact'))
+
+
+def item_url(archivist, item):
+    "The URL of an item's page."
+    return url_for(archivist, item_path(archivist, item))
+
+
+#######################################################################
+# State
+#######################################################################
+def _load(archivist, name, default=None):
+    try:
+        return archivist.get(_config_key(archivist, name)).data
+    except Exception as e:
+        if not is_missing(e):
+            raise
+        return default
+
+
+def _store(archivist, name, data=None):
+    resource = archivist.new_resource(_config_key(archivist, name),
+                                      contenttype='application/json',
+                                      resourcetype='config')
+    resource.data = data or {}
+    archivist.save(resource)
+
+
+def _discard(archivist, name):
+    try:
+        archivist.delete(_config_key(archivist, name))
+    except Exception as e:
+        if not is_missing(e):
+            raise
+
+
+def _list(archivist, prefix):
+    "The sorted names of the state objects under prefix."
+    start = len(_config_key(archivist, ''))
+    return [key[start:] for key in
+            archivist.list_keys(_config_key(archivist, prefix))]
+
+
+def _publish(archivist, key, contenttype, text, state):
+    # Artifacts are built from an archetype; these from their state.
+    resource = archivist.new_resource(
+        key, contenttype=contenttype, resourcetype='artifact',
+        archetype_guid=_config_key(archivist, state))
+    resource.text = text
+    archivist.publish(resource)
+
+
+def _publish_stable(archivist, prefix, publish):
+    """
+    Call publish(names) with the state names under prefix, then again for as
+    long as a listing taken after publishing shows they changed meanwhile.
+    """
+    names = _list(archivist, prefix)
+    for attempt in range(max_publish_attempts):
+        publish(names)
+        latest = _list(archivist, prefix)
+        if latest == names:
+            return
+        names = latest
+    logger.warn("Still changing after %d attempts: %s" %
+                (max_publish_attempts, prefix))
+
+
+def _hash(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _names(attribution):
+    return [a['name'] for a in attribution or []
+            if a.get('name') and a.get('role', 'author') == 'author']
+
+
+#######################################################################
+# Atom feed
+#######################################################################
+recent_prefix = '_feeds/recent/'
+
+
+def feed_size(archivist):
+    return int(archivist.siteconfig.get('feed_size', default_feed_size))
+
+
+def in_feed(archivist, item):
+    itemtypes = archivist.siteconfig.get('feed_itemtypes',
+                                         ['Item/Page/Article'])
+    return any(item.get('itemtype', '').startswith(t) for t in itemtypes)
+
+
+def entry_id(guid):
+    "The Atom id of an item: its guid, as a urn:uuid: URI unless a URI."
+    if re.match(r'^[A-Za-z][A-Za-z0-9+.-]*:', guid):
+        return guid
+    return 'urn:uuid:' + guid
+
+
+def feed_entry(archivist, key, item):
+    "The feed entry for an item, as stored in its marker."
+    return {
+        "key": key,
+        "id": entry_id(item['guid']),
+        "title": item['title'],
+        "updated": item['updated'],
+        "published": item.get('published'),
+        "link": item_url(archivist, item),
+        "summary": item.get('description'),
+        "authors": _names(item.get('attribution')),
+    }
+
+
+def _recent_name(key, updated):
+    # Named so that the newest sort last; the hash finds an item's marker.
+    return '%s%s_%s' % (recent_prefix, updated, _hash(key))
+
+
+def atom(archivist, entries, updated=None):
+    "Return the text of an Atom feed of entries, newest first."
+    site = archivist.siteconfig
+    feed_url = url_for(archivist, feed_key(archivist))
+    if entries:
+        updated = entries[0]['updated']
+    elif updated is None:
+        updated = datetime.utcnow().replace(microsecond=0).isoformat() + 'Z'
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<feed xmlns="http://www.w3.org/2005/Atom">',
+             '<id>%s</id>' % escape(site.get('feed_id') or feed_url),
+             '<title>%s</title>' % escape(site.get('title', '')),
+             '<updated>%s</updated>' % escape(updated),
+             '<link rel="self" type="%s" href=%s/>' % (atom_type,
+                                                       quoteattr(feed_url)),
+             '<link rel="alternate" href=%s/>' % quoteattr(
+                 url_for(archivist, ''))]
+    for name in _names(site.get('attribution')) or [site.get('title', '')]:
+        lines.append('<author><name>%s</name></author>' % escape(name))
+    for entry in entries:
+        lines.append('<entry>')
+        lines.append('<id>%s</id>' % escape(entry['id']))
+        lines.append('<title>%s</title>' % escape(entry['title']))
+        lines.append('<updated>%s</updated>' % escape(entry['updated']))
+        if entry.get('published'):
+            lines.append('<published>%s</published>' %
+                         escape(entry['published']))
+        lines.append('<link rel="alternate" href=%s/>' %
+                     quoteattr(entry['link']))
+        for name in entry.get('authors', []):
+            lines.append('<author><name>%s</name></author>' % escape(name))
+        if entry.get('summary'):
+            lines.append('<summary>%s</summary>' % escape(entry['summary']))
+        lines.append('</entry>')
+    lines.append('</feed>')
+    return '\n'.join(lines) + '\n'
+
+
+def publish_feed(archivist):
+    "Drop the markers beyond twice feed_size, and publish the feed."
+    size = feed_size(archivist)
+    for name in _list(archivist, recent_prefix)[:-2 * size]:
+        _discard(archivist, name)
+
+    def publish(names):
+        entries = [_load(archivist, name) for name in reversed(names)]
+        entries = [e for e in entries if e is not None][:size]
+        _publish(archivist, feed_key(archivist), atom_type,
+                 atom(archivist, entries), recent_prefix)
+    _publish_stable(archivist, recent_prefix, publish)
+
+
+def update_feed(archivist, key, item=None):
+    """
+    Update the feed for the item saved at key, or removed if item is None.
+    Returns True if the feed was written.
+    """
+    names = _list(archivist, recent_prefix)
+    old = [n for n in names if n.endswith('_' + _hash(key))]
+    new = None
+    if item is not None and in_feed(archivist, item):
+        new = _recent_name(key, item['updated'])
+        others = [n for n in names if n not in old]
+        keep = 2 * feed_size(archivist)
+        if len(others) >= keep and new < others[-keep]:
+            new = None  # older than every entry kept
+    if new is None and not old:
+        return False
+    if new is not None:
+        entry = feed_entry(archivist, key, item)
+        if old == [new] and _load(archivist, new) == entry:
+            return False
+        _store(archivist, new, entry)
+    for name in old:
+        if name != new:
+            _discard(archivist, name)
+    publish_feed(archivist)
+    return True
+
+
+#######################################################################
+# Sitemaps
+#######################################################################
+url_prefix = '_sitemap/urls/'
+shard_prefix = '_sitemap/shards/'
+
+
+def _url_name(archivist, key, item):
+    return '%s%s/%s/%s' % (url_prefix, _hash(key), item['updated'],
+                           item_path(archivist, item))
+
+
+def _parse_url(archivist, name):
+    "The (hash, URL entry) of a URL marker."
+    (digest, lastmod, key) = name[len(url_prefix):].split('/', 2)
+    return (digest, {"loc": url_for(archivist, key), "lastmod": lastmod})
+
+
+def _shard_marker(prefix, lastmod):
+    return '%s%s/%s' % (shard_prefix, _shard_name(prefix), lastmod or 'none')
+
+
+def _parse_shard(name):
+    "The (prefix, lastmod) of a shard marker."
+    (shard, lastmod) = name[len(shard_prefix):].split('/', 1)
+    return ('' if shard == 'all' else shard,
+            None if lastmod == 'none' else lastmod)
+
+
+def shard_prefixes(archivist):
+    "The prefixes of the sitemap shards."
+    return set(_parse_shard(name)[0]
+               for name in _list(archivist, shard_prefix)) or set([''])
+
+
+def shard_for(prefixes, digest):
+    "The prefix, among prefixes, of the shard holding the hash digest."
+    return max((p for p in prefixes if digest.startswith(p)), key=len)
+
+
+def split(urls, prefix=''):
+    """
+    Divide a dict of archetype key hash -> URL entry into shards of at most
+    max_urls. Returns a dict of shard prefix -> entries.
+    """
+    if len(urls) <= max_urls:
+        return {prefix: urls}
+    depth = len(prefix)
+    children = dict((prefix + c, {}) for c in '0123456789abcdef')
+    for (digest, entry) in urls.items():
+        children[prefix + digest[depth]][digest] = entry
+    shards = {}
+    for (child, entries) in children.items():
+        shards.update(split(entries, child))
+    return shards
+
+
+def urlset(entries):
+    "Return the text of a sitemap of URL entries."
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<urlset xmlns="%s">' % sitemap_ns]
+    for entry in sorted(entries, key=lambda e: e['loc']):
+        lines.append('<url><loc>%s</loc><lastmod>%s</lastmod></url>' %
+                     (escape(entry['loc']), escape(entry['lastmod'])))
+    lines.append('</urlset>')
+    return '\n'.join(lines) + '\n'
+
+
+def sitemapindex(archivist, shards):
+    "Return the text of a sitemap index of shards, a dict prefix -> lastmod."
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<sitemapindex xmlns="%s">' % sitemap_ns]
+    for prefix in sorted(shards):
+        loc = url_for(archivist, shard_key(archivist, prefix))
+        line = '<sitemap><loc>%s</loc>' % escape(loc)
+        if shards[prefix]:
+            line += '<lastmod>%s</lastmod>' % escape(shards[prefix])
+        lines.append(line + '</sitemap>')
+    lines.append('</sitemapindex>')
+    return '\n'.join(lines) + '\n'
+
+
+def _mark_shard(archivist, prefix, lastmod):
+    marker = _shard_marker(prefix, lastmod)
+    current = _list(archivist, shard_prefix + _shard_name(prefix) + '/')
+    if marker not in current:
+        _store(archivist, marker)
+    for name in current:
+        if name != marker:
+            _discard(archivist, name)
+
+
+def _remove_shard(archivist, prefix):
+    for name in _list(archivist, shard_prefix + _shard_name(prefix) + '/'):
+        _discard(archivist, name)
+    try:
+        archivist.delete(shard_key(archivist, prefix))
+    except Exception as e:
+        if not is_missing(e):
+            raise
+
+
+def _write_shard(archivist, prefix):
+    """
+    Write the sitemap of the shard at prefix from its URL markers, splitting
+    it if it has grown too big. Returns the prefixes of the shards written.
+    """
+    urls = dict(_parse_url(archivist, name)
+                for name in _list(archivist, url_prefix + prefix))
+    if len(urls) > max_urls:
+        logger.info("Splitting sitemap shard %s" % _shard_name(prefix))
+        written = []
+        for child in split(urls, prefix):
+            written.extend(_write_shard(archivist, child))
+        _remove_shard(archivist, prefix)
+        return written
+
+    def publish(names):
+        urls = dict(_parse_url(archivist, name) for name in names)
+        _publish(archivist, shard_key(archivist, prefix), sitemap_type,
+                 urlset(urls.values()), url_prefix + prefix)
+        lastmod = max([e['lastmod'] for e in urls.values()] or [None])
+        _mark_shard(archivist, prefix, lastmod)
+    _publish_stable(archivist, url_prefix + prefix, publish)
+    return [prefix]
+
+
+def _write_index(archivist):
+    def publish(names):
+        shards = {}
+        for name in names:
+            (prefix, lastmod) = _parse_shard(name)
+            shards.setdefault(prefix, None)
+            if lastmod and (shards[prefix] or '') < lastmod:
+                shards[prefix] = lastmod
+        _publish(archivist, sitemap_key(archivist), sitemap_type,
+                 sitemapindex(archivist, shards), shard_prefix)
+    _publish_stable(archivist, shard_prefix, publish)
+
+
+def update_sitemap(archivist, key, item=None):
+    """
+    Update the sitemap shard for the item saved at key, or removed if item
+    is None, and the sitemap index. Returns the prefixes of the shards
+    written.
+    """
+    digest = _hash(key)
+    old = _list(archivist, '%s%s/' % (url_prefix, digest))
+    new = None if item is None else _url_name(archivist, key, item)
+    if old == ([new] if new else []):
+        return []
+    if new is not None:
+        _store(archivist, new)
+    for name in old:
+        if name != new:
+            _discard(archivist, name)
+    prefix = shard_for(shard_prefixes(archivist), digest)
+    written = _write_shard(archivist, prefix)
+    _write_index(archivist)
+    return sorted(written)
+
+
+#######################################################################
+# Event handlers
+#######################################################################
+def on_save(archivist, resource):
+    "Add an item archetype resource to the feed and sitemap."
+    item = resource.data['Item']
+    update_feed(archivist, resource.key, item)
+    update_sitemap(archivist, resource.key, item)
+
+
+def on_remove(archivist, key):
+    "Remove the item archetype at key from the feed and sitemap."
+    update_feed(archivist, key)
+    update_sitemap(archivist, key)
+
+
+def _replace(archivist, prefix, markers):
+    "Make the state under prefix exactly markers, a dict of name -> data."
+    current = set(_list(archivist, prefix))
+    for name in sorted(current - set(markers)):
+        _discard(archivist, name)
+    for (name, data) in sorted(markers.items()):
+        if data is not None or name not in current:
+            _store(archivist, name, data)
+
+
+def rebuild(archivist):
+    "Regenerate the feed and sitemaps from every item in the archive."
+    prefix = archivist.pathstrategy.archetype_prefix + 'Item/'
+    recent = {}
+    urls = {}
+    for key in archivist.list_keys(prefix):
+        item = archivist.get(key).data['Item']
+        if in_feed(archivist, item):
+            recent[_recent_name(key, item['updated'])] = \
+                feed_entry(archivist, key, item)
+        urls[_url_name(archivist, key, item)] = None
+    keep = sorted(recent)[-2 * feed_size(archivist):]
+    _replace(archivist, recent_prefix, dict((n, recent[n]) for n in keep))
+    publish_feed(archivist)
+
+    _replace(archivist, url_prefix, urls)
+    old = shard_prefixes(archivist)
+    shards = split(dict(_parse_url(archivist, name) for name in urls))
+    for p in shards:
+        _write_shard(archivist, p)
+    for p in old - set(shards):
+        _remove_shard(archivist, p)
+    _write_index(archivist)
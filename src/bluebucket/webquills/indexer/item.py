@@ -106,25 +106,35 @@ as the primary key.
     },
 """
 
-from bluebucket.archivist import S3archivist, parse_aws_event
+from bluebucket.dispatch import handle_message
+from webquills.indexer.debounce import schedule_catalogs
+from webquills.indexer.depends import affected_catalogs
+from webquills.indexer import feeds
+from webquills.indexer import query
+from collections import OrderedDict
 import boto3
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 item_table = 'webquills-item-by-class'
+_local = threading.local()
 
 
 # After some manual poking, it seems passing strings for KeyConditionExpression
 # requires using the client, and not the service resource. Resources seem only
 # to deal well with Key and Attr resources, not strings, and I don't want to
 # parse that much right now. -VV 2016-07-04
-def execute_query(query, db=None):
-    if db is None:
-        db = boto3.client('dynamodb')
-    return db.query(**query)
+def execute_query(q, db=None):
+    "Run a catalog query. See webquills.indexer.query."
+    return query.execute_query(q, db=db)
 
 
 def on_save(db, archivist, resource):
+    """
+    Add the item to the index. Returns the index records touched: the new
+    record, and the one it replaced (if any), for catalog invalidation.
+    """
     # Extract the item metadata from the item
     meta = resource.data['Item']
 
@@ -140,32 +150,67 @@ def on_save(db, archivist, resource):
     meta['s3key'] = resource.key
 
     # Save to table
-    db.Table(item_table).put_item(Item=meta)
+    resp = db.Table(item_table).put_item(Item=meta, ReturnValues='ALL_OLD')
+    query.query_cache.clear()
+    return [meta, resp.get('Attributes')]
 
 
 def on_remove(db, archivist, key):
+    "Remove the item from the index. Returns the removed record, if any."
     # the itemclass is composed of components 1,2,3 of the path
     # TODO This path calculation should be done by the pathstrategy!
     class_comps = key.split('/', 4)[1:4]
     bucket_itemclass = archivist.bucket + '|' + '/'.join(class_comps[:3])
-    db.Table(item_table).delete_item(
-        Key={"bucket_itemclass": bucket_itemclass, "s3key": key}
+    resp = db.Table(item_table).delete_item(
+        Key={"bucket_itemclass": bucket_itemclass, "s3key": key},
+        ReturnValues='ALL_OLD'
     )
+    query.query_cache.clear()
+    return [resp.get('Attributes')]
+
+
+def dynamodb(region):
+    "A DynamoDB service resource for the current thread."
+    # Unlike clients, boto3 resources are not thread safe, so each worker
+    # thread gets its own session.
+    resources = getattr(_local, 'dynamodb', None)
+    if resources is None:
+        resources = _local.dynamodb = {}
+    if region not in resources:
+        session = boto3.session.Session()
+        resources[region] = session.resource('dynamodb', region_name=region)
+    return resources[region]
 
 
 # THIS IS THE LAMBDA HANDLER:
 def update_item_index(message, context):
-    "When the archive changes, update the index tables to match."
-    events = parse_aws_event(message)
-    if not events:
-        logger.warn("No events found in message!\n%s" % message)
-    for event in events:
+    "When the archive changes, update the index tables, feed and sitemap."
+    # imported here because page_to_html imports this module
+    from webquills.scribe import page_to_html
+
+    # Catalogs affected by any record in the batch are rendered once, after
+    # the whole batch is indexed.
+    archivists = {}
+    catalogs = {}
+    lock = threading.Lock()
+
+    def handle(archivist, event):
+        db = dynamodb(event.region)
         if event.is_save_event:
-            db = boto3.resource('dynamodb', region_name=event.region)
-            archivist = S3archivist(event.bucket)
             resource = archivist.get(event.key)
-            on_save(db, archivist, resource)
+            records = on_save(db, archivist, resource)
+            feeds.on_save(archivist, resource)
         else:
-            logger.warn("Not a save event!\n%s" % event)
-
-
+            records = on_remove(db, archivist, event.key)
+            feeds.on_remove(archivist, event.key)
+        affected = affected_catalogs(archivist, records)
+        with lock:
+            catalogs.setdefault(event.bucket, OrderedDict()).update(
+                (key, True) for key in affected)
+
+    try:
+        handle_message(message, handle, archivists=archivists)
+    finally:
+        for (bucket, keys) in catalogs.items():
+            schedule_catalogs(archivists[bucket], list(keys),
+                              render=page_to_html.on_save)
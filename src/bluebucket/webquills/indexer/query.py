@@ -0,0 +1,147 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Run catalog queries against DynamoDB.
+
+Catalog renders are the most DynamoDB-expensive thing we do, and a burst of
+publishing renders the same catalogs, with the same queries, many times. So:
+
+* Clients are created once per region and shared (boto3 clients are thread
+  safe, though creating them is not).
+* Queries follow `LastEvaluatedKey` until they have `Limit` items (or all of
+  them, with no Limit), rather than returning only the first page.
+* Results are cached for a short time, keyed by the normalized query. Writes
+  to the index through this process clear the cache; writes made elsewhere
+  (e.g. by the indexer Lambda) are seen once the entries expire.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from collections import OrderedDict
+import boto3
+import copy
+import json
+import threading
+import time
+
+default_ttl = 30  # seconds
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def client(region=None):
+    "A shared DynamoDB client for region (default, the configured region)."
+    with _clients_lock:
+        if region not in _clients:
+            _clients[region] = boto3.client('dynamodb', region_name=region)
+        return _clients[region]
+
+
+def normalize(query):
+    "A string that is the same for queries that are the same."
+    return json.dumps(query, sort_keys=True, separators=(',', ':'),
+                      default=str)
+
+
+def paginate(db, query):
+    """
+    Run query, following LastEvaluatedKey until Limit items have been read,
+    or every item if the query has no Limit. Returns a response shaped like
+    a single page, with all the items, and a LastEvaluatedKey only if more
+    items remain.
+    """
+    limit = query.get('Limit')
+    query = dict(query)
+    items = []
+    scanned = 0
+    while True:
+        response = db.query(**query)
+        items.extend(response.get('Items', []))
+        scanned += response.get('ScannedCount', 0)
+        last_key = response.get('LastEvaluatedKey')
+        if not last_key or (limit and len(items) >= limit):
+            break
+        query['ExclusiveStartKey'] = last_key
+        if limit:
+            query['Limit'] = limit - len(items)
+    result = {"Items": items, "Count": len(items), "ScannedCount": scanned}
+    if last_key:
+        result['LastEvaluatedKey'] = last_key
+    return result
+
+
+class QueryCache(object):
+    "A bounded, thread safe cache of query results that expire after ttl."
+    def __init__(self, ttl=default_ttl, maxsize=256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # incremented by clear()
+        self._entries = OrderedDict()  # key -> (expires, result)
+        self._lock = threading.Lock()
+
+    def get(self, key, now=None):
+        "Return a copy of the cached result for key, or None."
+        now = now or time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Copied so that a caller changing its result cannot change
+            # what later callers get.
+            return copy.deepcopy(entry[1])
+
+    def put(self, key, result, now=None, generation=None):
+        """
+        Cache result for key. If generation is given and the cache has been
+        cleared since, the result may predate a write, so is not cached.
+        """
+        now = now or time.time()
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, copy.deepcopy(result))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+query_cache = QueryCache()
+
+
+def execute_query(query, db=None, cache=query_cache):
+    """
+    Return the results of a DynamoDB query, all pages up to its Limit, from
+    the cache if the same query was run within the cache's ttl. Pass
+    cache=None to always query.
+    """
+    if cache is None or cache.ttl <= 0:
+        return paginate(db or client(), query)
+    key = normalize(query)
+    result = cache.get(key)
+    if result is None:
+        generation = cache.generation
+        result = paginate(db or client(), query)
+        cache.put(key, result, generation=generation)
+    return result
@@ -0,0 +1,209 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+An in-process stand-in for the S3 notification and SNS cascade.
+
+In AWS, saving a markdown source triggers the markdown scribe, whose archetype
+triggers the HTML scribe and the item indexer. With the localarchivist nothing
+triggers anything, so this bus listens to an archivist's saves and deletes,
+routes them by the same key prefixes that `init_bucket` configures, and runs
+the handlers on a worker pool. Usage:
+
+    bus = LocalEventBus()
+    bus.attach(archivist)
+    webquills.quill.publish(archivist, text)
+    failures = bus.drain()
+
+The item indexer needs a DynamoDB service resource. Pass one as `db` (for
+example pointed at DynamoDB Local) to include it; otherwise it is skipped.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import logging
+import threading
+import time
+from bluebucket.archivist.s3 import S3event
+import webquills.indexer.feeds
+import webquills.indexer.item
+from webquills.indexer.debounce import CatalogDebouncer
+from webquills.indexer.depends import affected_catalogs
+import webquills.scribe.markdown
+import webquills.scribe.page_to_html
+
+logger = logging.getLogger(__name__)
+
+# The same prefixes init_bucket subscribes to S3 notifications.
+source_markdown_prefix = '_A/Source/text/markdown/'
+item_prefixes = ['_A/Item/Page/Article/', '_A/Item/Page/Catalog/']
+
+
+def markdown_on_save(archivist, event):
+    webquills.scribe.markdown.on_save(archivist, archivist.get(event.key))
+
+
+def html_on_save(archivist, event):
+    webquills.scribe.page_to_html.on_save(archivist, archivist.get(event.key))
+
+
+def feeds_on_save(archivist, event):
+    webquills.indexer.feeds.on_save(archivist, archivist.get(event.key))
+
+
+def feeds_on_remove(archivist, event):
+    webquills.indexer.feeds.on_remove(archivist, event.key)
+
+
+def _render_page(archivist, resource):
+    webquills.scribe.page_to_html.on_save(archivist, resource)
+
+
+def default_routes(db=None, catalogs=None):
+    """
+    Return the list of (prefix, is_save_event, handler) routes that mirror the
+    AWS cascade. Handlers are called as handler(archivist, event). Catalogs
+    invalidated by the indexer are handed to `catalogs`, a CatalogDebouncer.
+    """
+    if catalogs is None:
+        catalogs = CatalogDebouncer(_render_page, window=0)
+    routes = [(source_markdown_prefix, True, markdown_on_save)]
+    for prefix in item_prefixes:
+        routes.append((prefix, True, html_on_save))
+        routes.append((prefix, True, feeds_on_save))
+        routes.append((prefix, False, feeds_on_remove))
+    if db is not None:
+        def index_on_save(archivist, event):
+            records = webquills.indexer.item.on_save(
+                db, archivist, archivist.get(event.key))
+            catalogs.add(archivist, affected_catalogs(archivist, records))
+
+        def index_on_remove(archivist, event):
+            records = webquills.indexer.item.on_remove(db, archivist,
+                                                       event.key)
+            catalogs.add(archivist, affected_catalogs(archivist, records))
+
+        for prefix in item_prefixes:
+            routes.append((prefix, True, index_on_save))
+            routes.append((prefix, False, index_on_remove))
+    return routes
+
+
+class LocalEventBus(object):
+    """
+    Catalogs invalidated by the indexer are rendered once per
+    `catalog_window` seconds (default: the site's `catalog_render_window`),
+    and whatever is still pending when the bus is drained. A catalog that
+    fails to render is reported among the failures as a save of its key.
+    """
+    def __init__(self, db=None, routes=None, max_workers=4,
+                 catalog_window=None):
+        self.catalogs = CatalogDebouncer(_render_page, window=catalog_window,
+                                         on_failure=self._catalog_failed)
+        if routes is None:
+            routes = default_routes(db, catalogs=self.catalogs)
+        self.routes = routes
+        self.failures = []  # list of (event, exception)
+        self._archivists = {}  # bucket -> archivist
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._queues = {}  # (bucket, key) -> deque of work for that key
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def attach(self, archivist):
+        "Start receiving events for the archivist's saves and deletes."
+        self._archivists[archivist.bucket] = archivist
+        archivist.listeners.append(self.emit)
+
+    def detach(self, archivist):
+        self._archivists.pop(archivist.bucket, None)
+        if self.emit in archivist.listeners:
+            archivist.listeners.remove(self.emit)
+
+    def emit(self, event):
+        "Queue the handlers whose routes match the event."
+        archivist = self._archivists.get(event.bucket)
+        if archivist is None:
+            logger.warn("No archivist attached for %s" % event.bucket)
+            return
+        for (prefix, on_save, handler) in self.routes:
+            if event.key.startswith(prefix) and event.is_save_event == on_save:
+                self._submit((handler, archivist, event))
+
+    def _submit(self, work):
+        # Work for one key runs in order on one worker at a time, like the
+        # Lambda handlers do within a batch.
+        event = work[2]
+        ident = (event.bucket, event.key)
+        with self._cond:
+            self._pending += 1
+            if ident in self._queues:
+                self._queues[ident].append(work)
+                return
+            self._queues[ident] = deque([work])
+        self._pool.submit(self._run, ident)
+
+    def _run(self, ident):
+        while True:
+            with self._cond:
+                queue = self._queues[ident]
+                if not queue:
+                    del self._queues[ident]
+                    return
+                (handler, archivist, event) = queue.popleft()
+            try:
+                handler(archivist, event)
+            except Exception as e:
+                logger.exception("Failed processing %s" % event.key)
+                with self._cond:
+                    self.failures.append((event, e))
+            finally:
+                with self._cond:
+                    self._pending -= 1
+                    self._cond.notify_all()
+
+    def _catalog_failed(self, archivist, catalog_key, error):
+        event = S3event(bucket=archivist.bucket, key=catalog_key,
+                        name='ObjectCreated:Put', region='local',
+                        source='aws:s3')
+        with self._cond:
+            self.failures.append((event, error))
+
+    def drain(self, timeout=None):
+        """
+        Wait until every queued event, including those emitted by handlers
+        while we wait, has been processed, then render pending catalogs.
+        Returns the list of failures collected so far. Returns early if
+        timeout (seconds) elapses.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return list(self.failures)
+                self._cond.wait(remaining)
+        self.catalogs.flush()
+        with self._cond:
+            return list(self.failures)
+
+    wait = drain
+
+    def shutdown(self):
+        "Drain the queue and stop the worker pool."
+        self.drain()
+        self._pool.shutdown(wait=True)
+        self.catalogs.cancel()
@@ -20,6 +20,11 @@ WebQuills command line interface.
 Usage:
     quill [options] new ITEMTYPE [TITLE]
     quill [options] publish ITEMFILE
+    quill -b BUCKET [-s CFG] [options] convert SOURCE
+    quill -b BUCKET [-s CFG] [options] rebuild
+    quill -b BUCKET [-s CFG] [options] rebuild-feeds
+    quill -b BUCKET [-s CFG] [options] put-assets DIR
+    quill -b BUCKET [-s CFG] compile-templates
     quill -b BUCKET -r REGION -a ACCOUNT -s CFG aws-install
     quill init-bucket -b BUCKET -r REGION -a ACCOUNT -s CFG
     quill -b BUCKET -s CFG local-init-bucket
@@ -30,6 +35,17 @@ Options:
     -a ACCOUNT, --account ACCOUNT  The AWS account ID.
     -s CFG, --siteconfig CFG  A JSON file containing site configuration for the
         bucket
+    -w N, --workers N  Number of worker processes, 0 for one per CPU
+        [default: 0].
+    --batch-size N  Number of resources to persist at a time [default: 100].
+    --local  Use a local directory as the bucket.
+    --itemtype T  Rebuild only items of this type, e.g. Item/Page/Article.
+    --category C  Rebuild only items in this category or its subcategories.
+    --since DATE  Rebuild only items updated at or after this date.
+    --template NAMES  Rebuild only items whose pages use these templates
+        (comma separated names, relative to the template directory).
+    --checkpoint FILE  Record finished items in FILE, and skip those already
+        recorded there.
 """
 from __future__ import absolute_import, print_function, unicode_literals
 from bluebucket.archivist import S3archivist
@@ -38,11 +54,13 @@ from docopt import docopt
 from io import open
 from os import path
 from bluebucket.util import slugify
-from webquills.scribe.markdown import to_archetype
+from webquills.scribe.markdown import parse_metadata
 
 import boto3
 import logging
 import json
+import mimetypes
+import os
 import pytz
 import sys
 import uuid
@@ -104,7 +122,7 @@ def new_markdown(item_type, title=None, **kwargs):
 # SAVE (PUT) the asset
 # TODO (After preview is implemented) Check for and delete any preview
 def publish(archivist, text):
-    contentmeta = to_archetype(archivist, text)['Item']
+    contentmeta = parse_metadata(archivist, text)['Item']
     assetmeta = {
         'contenttype': 'text/markdown; charset=utf-8',
         'resourcetype': 'asset',
@@ -119,11 +137,69 @@ def publish(archivist, text):
     archivist.publish(asset)
 
 
+# quill convert <source>
+# Convert every markdown file in the directory <source> (or under the key
+# prefix <source> in the bucket) to archetypes, using a pool of processes.
+def convert(archivist, source, workers=None, batch_size=None):
+    from webquills.batch import convert as batch_convert
+    report = batch_convert(archivist, source, max_workers=workers,
+                           batch_size=batch_size)
+    print(report)
+    for (name, error) in report.failures:
+        print("FAILED %s: %s" % (name, error))
+    return report
+
+
+# quill rebuild
+# Re-renders the HTML for every archetype in the bucket (or those matching the
+# filter options), e.g. after a template change.
+def rebuild(archivist, filters=None, workers=None, batch_size=None,
+            checkpoint=None):
+    from webquills.batch import rebuild as batch_rebuild
+    report = batch_rebuild(archivist, filters=filters, max_workers=workers,
+                           batch_size=batch_size, checkpoint=checkpoint)
+    print(report)
+    for (name, error) in report.failures:
+        print("FAILED %s: %s" % (name, error))
+    return report
+
+
+def make_archivist(param):
+    "Create the archivist described by the command line options."
+    siteconfig = None  # read from the bucket
+    if param['--siteconfig']:
+        with open(param['--siteconfig'], encoding='utf-8') as f:
+            siteconfig = json.load(f)
+    if param['--local']:
+        from bluebucket.archivist.local import localarchivist
+        return localarchivist(param['--bucket'], siteconfig=siteconfig)
+    return S3archivist(param['--bucket'], siteconfig=siteconfig)
+
+
 # TODO quill preview <bucket> <itemfile>
 # Same as publish, but PUT to Preview dir.
 # Generate and print a pre-signed URL to view the HTML.
 
 
+# quill put-assets <dir>
+# Publish every file under <dir> as an asset, keyed by its path relative to
+# <dir>. Sites that set fingerprint_assets get fingerprinted keys, recorded in
+# the asset manifest for templates' asset_url().
+def put_assets(archivist, directory):
+    from bluebucket.assets import save_asset
+    for (dirpath, dirnames, filenames) in os.walk(directory):
+        for filename in sorted(filenames):
+            filepath = path.join(dirpath, filename)
+            key = path.relpath(filepath, directory).replace(os.sep, '/')
+            contenttype = mimetypes.guess_type(filename)[0] or \
+                'application/octet-stream'
+            with open(filepath, 'rb') as f:
+                asset = archivist.new_resource(key, content=f.read(),
+                                               contenttype=contenttype,
+                                               resourcetype='asset')
+            print("%s -> %s" % (key, save_asset(archivist, asset)))
+
+
 # quill aws-install
 # Install the required roles, SNS Topics, and Lambda functions for basic
 # publishing functionality.
@@ -156,6 +232,44 @@ def main():
             text = f.read()
         publish(archivist, text)
 
+    elif param['convert']:
+        workers = int(param['--workers']) or None
+        report = convert(make_archivist(param), param['SOURCE'],
+                         workers=workers,
+                         batch_size=int(param['--batch-size']))
+        if report.failures:
+            sys.exit(1)
+
+    elif param['rebuild']:
+        from webquills.batch import Filters
+        filters = Filters(itemtype=param['--itemtype'],
+                          category=param['--category'],
+                          since=param['--since'],
+                          templates=[t.strip() for t in
+                                     (param['--template'] or '').split(',')
+                                     if t.strip()])
+        workers = int(param['--workers']) or None
+        report = rebuild(make_archivist(param), filters=filters,
+                         workers=workers,
+                         batch_size=int(param['--batch-size']),
+                         checkpoint=param['--checkpoint'])
+        if report.failures:
+            sys.exit(1)
+
+    elif param['rebuild-feeds']:
+        from webquills.indexer.feeds import rebuild as rebuild_feeds
+        rebuild_feeds(make_archivist(param))
+
+    elif param['put-assets']:
+        put_assets(make_archivist(param), param['DIR'])
+
+    elif param['compile-templates']:
+        from bluebucket.templates import build_bundle
+        from webquills.scribe.fragments import FragmentCacheExtension
+        manifest = build_bundle(make_archivist(param),
+                                extensions=[FragmentCacheExtension])
+        print("Compiled %d templates" % len(manifest['templates']))
+
     elif param['aws-install']:
         aws_update(param['--region'], param['--account'])
 
@@ -0,0 +1,165 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Caches for rendered output, keyed by a hash of the input.
+
+Most saves of a markdown source change only its metadata, so the body renders
+to the same HTML as last time. `RenderCache` remembers rendered text in memory
+and, optionally, in a persistent store so that warm Lambda containers and
+later runs can reuse it. Two stores are provided:
+
+* `DirectoryStore` keeps entries as files in a local directory.
+* `ArchivistStore` keeps entries in the archive, under `_A/_cache/<name>/`.
+
+A store is any object with `get(key)` (returning None when missing) and
+`put(key, text)` methods.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from collections import OrderedDict
+from io import open
+import hashlib
+import logging
+import os
+import posixpath
+import tempfile
+import threading
+from bluebucket.archivist import is_missing
+
+logger = logging.getLogger(__name__)
+
+
+def digest(*parts):
+    "Return a hex digest of the parts, which may be text or bytes."
+    h = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = part.encode('utf-8')
+        h.update(part)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class DirectoryStore(object):
+    "Keep cache entries as files under a local directory."
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self.path_for(key), encoding='utf-8') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def put(self, key, text):
+        filename = self.path_for(key)
+        folder = os.path.dirname(filename)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass  # created by another process meanwhile
+        # Write then rename, so readers never see a partial entry.
+        (fd, tmp) = tempfile.mkstemp(dir=folder)
+        with open(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.rename(tmp, filename)
+
+
+class ArchivistStore(object):
+    "Keep cache entries in the archive, under _A/_cache/<name>/."
+    def __init__(self, archivist, name='render'):
+        self.archivist = archivist
+        self.prefix = archivist.pathstrategy.path_for(
+            resourcetype='config', key=posixpath.join('_cache', name, ''))
+
+    def get(self, key):
+        try:
+            return self.archivist.get(self.prefix + key).text
+        except Exception as e:
+            if not is_missing(e):
+                raise
+            return None
+
+    def put(self, key, text):
+        resource = self.archivist.new_resource(
+            self.prefix + key, text=text,
+            contenttype='text/html; charset=utf-8', resourcetype='config')
+        self.archivist.save(resource)
+
+
+class RenderCache(object):
+    """
+    A bounded, thread safe, in memory cache, in front of an optional
+    persistent store. The store may also be given per call, since it usually
+    depends on the site being rendered.
+    """
+    def __init__(self, store=None, maxsize=256):
+        self.store = store
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key, text):
+        with self._lock:
+            self._entries[key] = text
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get(self, key, store=None):
+        "Return the cached text for key, or None."
+        with self._lock:
+            text = self._entries.pop(key, None)
+            if text is not None:
+                self._entries[key] = text  # most recently used
+                self.hits += 1
+                return text
+        store = store or self.store
+        if store is not None:
+            try:
+                text = store.get(key)
+            except Exception:
+                logger.exception("Render cache store failed reading %s" % key)
+                text = None
+            if text is not None:
+                self._remember(key, text)
+                with self._lock:
+                    self.hits += 1
+                return text
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, text, store=None):
+        self._remember(key, text)
+        store = store or self.store
+        if store is not None:
+            try:
+                store.put(key, text)
+            except Exception:
+                # A cache that cannot be written is slower, not broken.
+                logger.exception("Render cache store failed writing %s" % key)
+
+    def clear(self):
+        "Forget the in memory entries. Persistent stores are kept."
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,84 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Cached template fragments, for page chrome shared by every page.
+
+The site header, navigation and footer usually depend only on the siteconfig,
+yet are rendered again for every page. Wrap them in a `cache` block:
+
+    {% cache "header" %}
+      <header>{{ _site.title }} ...</header>
+    {% endcache %}
+
+and the block is rendered once and then reused. Further arguments become part
+of the key, for fragments that vary, e.g.
+`{% cache "nav", Item.category.name %}`.
+
+A fragment's key is made of its arguments, its own source, the siteconfig
+(`_site`) and the versions of the site's templates and assets
+(`_template_version`, set by `page_to_html`), so editing any of these renders
+it again. Without a template version, fragments are rendered every time,
+since templates they include may have changed unseen.
+
+Fragments are kept in memory, and in the site's `render_cache` store when one
+is configured (see `webquills.scribe.markdown.render_cache_store`).
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from jinja2 import nodes
+from jinja2.ext import Extension
+from jinja2.runtime import Undefined
+import json
+from webquills.scribe.cache import RenderCache, digest
+
+
+class FragmentCacheExtension(Extension):
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=RenderCache(maxsize=512),
+                           fragment_store=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        # The node tree stands in for the block's source, so that editing
+        # the block changes its key.
+        source = digest(parser.name or '', repr(body))
+        call = self.call_method('_cache', [
+            nodes.List(args), nodes.Const(source),
+            nodes.Name('_site', 'load'),
+            nodes.Name('_template_version', 'load')])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _cache(self, args, source, site, template_version, caller):
+        if not template_version or isinstance(template_version, Undefined):
+            return caller()
+        if isinstance(site, Undefined):
+            site = None
+        key = digest(source, template_version,
+                     json.dumps(args, sort_keys=True, default=str),
+                     json.dumps(site, sort_keys=True, default=str))
+        env = self.environment
+        text = env.fragment_cache.get(key, env.fragment_store)
+        if text is None:
+            text = caller()
+            env.fragment_cache.put(key, text, env.fragment_store)
+        return text
@@ -0,0 +1,214 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Cached syntax highlighting for the codehilite and fenced_code extensions.
+
+Pygments is the most expensive part of rendering a code-heavy document. Each
+highlighted block is cached by a hash of its language, options and source, so
+a block is highlighted once no matter how many documents or renders include
+it. Lexers are also created once per language and options and then reused.
+
+`CachedCodeHiliteExtension` and `CachedFencedCodeExtension` are those
+extensions with processors that highlight through `CachedCodeHilite`;
+`cached_extensions` puts them in place of the extensions as named. Other
+Markdown converters in the process are not affected. A persistent store for
+the cache can be given for the duration of a conversion with `using_store`.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+from contextlib import contextmanager
+import markdown
+from markdown.extensions import Extension, codehilite, fenced_code
+import threading
+from webquills.scribe.cache import RenderCache, digest
+try:
+    import pygments
+    from pygments.formatters import get_formatter_by_name
+    from pygments.lexers import get_lexer_by_name
+    pygments_version = pygments.__version__
+except ImportError:
+    get_lexer_by_name = None
+    pygments_version = None
+
+highlight_cache = RenderCache(maxsize=1024)
+versions = repr((getattr(markdown, '__version_info__', None) or
+                 markdown.version_info, pygments_version))
+_local = threading.local()
+_lexers = {}
+_lexers_lock = threading.Lock()
+
+
+@contextmanager
+def using_store(store):
+    "Use store as the persistent highlight cache in this thread."
+    previous = getattr(_local, 'store', None)
+    _local.store = store
+    try:
+        yield
+    finally:
+        _local.store = previous
+
+
+def cached_get_lexer_by_name(alias, **options):
+    "Like pygments' get_lexer_by_name, but returns a shared instance."
+    key = (alias, repr(sorted(options.items())))  # values may be lists
+    with _lexers_lock:
+        lexer = _lexers.get(key)
+    if lexer is None:
+        lexer = get_lexer_by_name(alias, **options)  # ValueError if unknown
+        with _lexers_lock:
+            lexer = _lexers.setdefault(key, lexer)
+    return lexer
+
+
+class CachedCodeHilite(codehilite.CodeHilite):
+    def cache_key(self):
+        # The output depends only on the attributes (source, language and
+        # options), and on the versions doing the work.
+        return digest(versions, repr(sorted(vars(self).items())))
+
+    def hilite(self):
+        key = self.cache_key()
+        store = getattr(_local, 'store', None)
+        html = highlight_cache.get(key, store)
+        if html is None:
+            html = self._hilite()
+            highlight_cache.put(key, html, store)
+        return html
+
+    def _hilite(self):
+        "Highlight as CodeHilite does, with a shared lexer when one is named."
+        if get_lexer_by_name is None or not self.use_pygments:
+            return super(CachedCodeHilite, self).hilite()
+        self.src = self.src.strip('\n')
+        if self.lang is None:
+            self._parseHeader()
+        try:
+            lexer = cached_get_lexer_by_name(self.lang or '')
+        except ValueError:
+            # Let CodeHilite guess the language, or fall back to text
+            return super(CachedCodeHilite, self).hilite()
+        formatter = get_formatter_by_name('html', linenos=self.linenums,
+                                          cssclass=self.css_class,
+                                          style=self.style,
+                                          noclasses=self.noclasses,
+                                          hl_lines=self.hl_lines)
+        return pygments.highlight(self.src, lexer, formatter)
+
+
+# The processors below are those of codehilite and fenced_code, creating a
+# CachedCodeHilite for each block.
+class CachedHiliteTreeprocessor(codehilite.HiliteTreeprocessor):
+    def run(self, root):
+        for block in root.iter('pre'):
+            if len(block) == 1 and block[0].tag == 'code':
+                code = CachedCodeHilite(
+                    self.code_unescape(block[0].text),
+                    linenums=self.config['linenums'],
+                    guess_lang=self.config['guess_lang'],
+                    css_class=self.config['css_class'],
+                    style=self.config['pygments_style'],
+                    noclasses=self.config['noclasses'],
+                    tab_length=self.md.tab_length,
+                    use_pygments=self.config['use_pygments'])
+                placeholder = self.md.htmlStash.store(code.hilite())
+                # The block becomes a paragraph, replaced by the stashed html
+                block.clear()
+                block.tag = 'p'
+                block.text = placeholder
+
+
+class CachedFencedBlockPreprocessor(fenced_code.FencedBlockPreprocessor):
+    def run(self, lines):
+        if not self.checked_for_codehilite:
+            for ext in self.md.registeredExtensions:
+                if isinstance(ext, codehilite.CodeHiliteExtension):
+                    self.codehilite_conf = ext.config
+                    break
+            self.checked_for_codehilite = True
+
+        text = "\n".join(lines)
+        while True:
+            m = self.FENCED_BLOCK_RE.search(text)
+            if m is None:
+                break
+            if self.codehilite_conf:
+                conf = dict((k, v[0]) for (k, v)
+                            in self.codehilite_conf.items())
+                code = CachedCodeHilite(
+                    m.group('code'),
+                    linenums=conf['linenums'],
+                    guess_lang=conf['guess_lang'],
+                    css_class=conf['css_class'],
+                    style=conf['pygments_style'],
+                    use_pygments=conf['use_pygments'],
+                    lang=(m.group('lang') or None),
+                    noclasses=conf['noclasses'],
+                    hl_lines=codehilite.parse_hl_lines(m.group('hl_lines'))
+                ).hilite()
+            else:
+                lang = ''
+                if m.group('lang'):
+                    lang = self.LANG_TAG % m.group('lang')
+                code = self.CODE_WRAP % (lang, self._escape(m.group('code')))
+            placeholder = self.md.htmlStash.store(code)
+            text = '%s\n%s\n%s' % (text[:m.start()], placeholder,
+                                   text[m.end():])
+        return text.split("\n")
+
+
+class CachedCodeHiliteExtension(codehilite.CodeHiliteExtension):
+    "codehilite, highlighting through the caches."
+    def extendMarkdown(self, md, md_globals=None):
+        hiliter = CachedHiliteTreeprocessor(md)
+        hiliter.config = self.getConfigs()
+        md.treeprocessors.register(hiliter, 'hilite', 30)
+        md.registerExtension(self)
+
+
+class CachedFencedCodeExtension(fenced_code.FencedCodeExtension):
+    "fenced_code, highlighting through the caches."
+    def extendMarkdown(self, md, md_globals=None):
+        md.registerExtension(self)
+        # Under fenced_code's own name, so it replaces the one extra loads.
+        md.preprocessors.register(CachedFencedBlockPreprocessor(md),
+                                  'fenced_code_block', 25)
+
+
+cached_versions = {
+    'codehilite': CachedCodeHiliteExtension,
+    'fenced_code': CachedFencedCodeExtension,
+}
+
+
+def cached_extensions(extensions, extension_configs=None):
+    """
+    Return extensions, and their configs, with codehilite and fenced_code
+    (including the fenced_code that extra loads) replaced by the cached
+    versions.
+    """
+    configs = dict(extension_configs or {})
+    # Extensions given as instances are left alone
+    names = [None if isinstance(ext, Extension) else ext.rsplit('.', 1)[-1]
+             for ext in extensions]
+    result = []
+    for (name, ext) in zip(names, extensions):
+        if name in cached_versions:
+            ext = cached_versions[name](**configs.pop(ext, {}))
+        result.append(ext)
+    if 'extra' in names and 'fenced_code' not in names:
+        result.append(CachedFencedCodeExtension())
+    return (result, configs)
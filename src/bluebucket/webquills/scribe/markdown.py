@@ -22,32 +22,224 @@ Of special note:
 
 * the `toc` extension is configured with `permalink=True`
 
+Sites can define other sets of extensions, called render profiles, in the
+siteconfig. A document uses the profile named by its `render-profile` meta
+key, or the profile for the longest matching prefix of its itemtype, or the
+"default" profile (which a site may also override):
+
+    "render_profiles": {
+        "plain": {
+            "extensions": ["markdown.extensions.extra",
+                           "markdown.extensions.sane_lists"],
+            "extension_configs": {}
+        }
+    },
+    "render_profile_by_itemtype": {"Item/Page/Catalog": "plain"}
+
+The `meta` extension is always added, as it separates metadata from the body.
 """
 from __future__ import absolute_import, print_function
 
-from dateutil.parser import parse as parse_date
+from contextlib import contextmanager
 import logging
 import json
 import markdown
-from markdown.extensions.toc import TocExtension
+import os
+from markdown.extensions.meta import META_RE, META_MORE_RE, BEGIN_RE, END_RE
 import pytz
 import string
+import threading
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
 
-from bluebucket.archivist import parse_aws_event, S3archivist
-from bluebucket.util import slugify
+from bluebucket.archivist.base import Archivist
+from bluebucket.dispatch import handle_message
+from bluebucket.util import normalize_datetime, slugify
+from webquills.scribe import highlight
+from webquills.scribe.cache import (ArchivistStore, DirectoryStore,
+                                    RenderCache, digest)
+try:
+    import pygments
+    pygments_version = pygments.__version__
+except ImportError:
+    pygments_version = None
 
 
 logger = logging.getLogger(__name__)
+# Extensions are named rather than instantiated, so that every converter
+# gets its own extension objects (they hold per-document state).
 extensions = [
     'markdown.extensions.extra',
     'markdown.extensions.admonition',
     'markdown.extensions.codehilite',
     'markdown.extensions.meta',
     'markdown.extensions.sane_lists',
-    TocExtension(permalink=True),  # replaces headerId
+    'markdown.extensions.toc',  # replaces headerId
 ]
-md = markdown.Markdown(extensions=extensions, lazy_ol=False,
-                       output_format='html5')
+extension_configs = {
+    'markdown.extensions.toc': {'permalink': True},
+}
+
+
+def new_converter(extensions=extensions, extension_configs=extension_configs):
+    """
+    Return a new Markdown converter with the given extensions, highlighting
+    code through the caches in `webquills.scribe.highlight`.
+    """
+    (extensions, extension_configs) = highlight.cached_extensions(
+        extensions, extension_configs)
+    return markdown.Markdown(extensions=extensions,
+                             extension_configs=extension_configs,
+                             lazy_ol=False, output_format='html5')
+
+
+class ConverterPool(object):
+    """
+    A pool of Markdown converters. A Markdown instance keeps per-document
+    state (`Meta`, `toc`, footnotes...) and is not thread safe, so each
+    conversion borrows an instance, reset, for its exclusive use. Instances
+    are created on demand and kept for reuse, up to maxsize idle ones.
+    """
+    def __init__(self, factory=new_converter, maxsize=16):
+        self.factory = factory
+        self._idle = Queue(maxsize)
+
+    def acquire(self):
+        "Return a reset converter for the caller's exclusive use."
+        try:
+            md = self._idle.get_nowait()
+        except Empty:
+            return self.factory()
+        md.reset()
+        return md
+
+    def release(self, md):
+        "Return a converter to the pool. Extra converters are dropped."
+        try:
+            self._idle.put_nowait(md)
+        except Full:
+            pass
+
+    @contextmanager
+    def converter(self):
+        md = self.acquire()
+        try:
+            yield md
+        finally:
+            self.release(md)
+
+
+versions = repr((getattr(markdown, '__version_info__', None) or
+                 markdown.version_info, pygments_version))
+
+
+def _profile_config(extensions, extension_configs):
+    # Returns the normalized configuration of a profile and its digest, which
+    # covers everything that affects the output, for cache keys.
+    extensions = list(extensions)
+    if 'markdown.extensions.meta' not in extensions:
+        extensions.append('markdown.extensions.meta')
+    extension_configs = extension_configs or {}
+    config_digest = digest(json.dumps([extensions, extension_configs],
+                                      sort_keys=True), versions)
+    return (extensions, extension_configs, config_digest)
+
+
+class RenderProfile(object):
+    "A set of extensions and their configuration, with a pool of converters."
+    def __init__(self, name, extensions, extension_configs=None):
+        self.name = name
+        (self.extensions, self.extension_configs, self.digest) = \
+            _profile_config(extensions, extension_configs)
+        self.pool = ConverterPool(factory=self.new_converter)
+
+    def new_converter(self):
+        return new_converter(self.extensions, self.extension_configs)
+
+    def convert(self, text):
+        "Convert markdown text. Returns a tuple (html, metadata)."
+        with self.pool.converter() as md:
+            html = md.convert(text)
+            return (html, getattr(md, 'Meta', {}))
+
+
+default_profile = RenderProfile('default', extensions, extension_configs)
+pool = default_profile.pool
+_profiles = {default_profile.digest: default_profile}
+_profiles_lock = threading.Lock()
+
+
+def get_profile(name, spec):
+    """
+    Return the RenderProfile for a profile spec from the siteconfig. Profiles
+    (and their converters) are built once and shared by every site that
+    uses the same configuration.
+    """
+    (exts, configs, config_digest) = _profile_config(
+        spec.get('extensions', extensions), spec.get('extension_configs'))
+    with _profiles_lock:
+        profile = _profiles.get(config_digest)
+        if profile is None:
+            profile = _profiles[config_digest] = RenderProfile(name, exts,
+                                                               configs)
+        return profile
+
+
+def select_profile(archivist, metadata):
+    "Return the RenderProfile for a document, given its parsed metadata."
+    siteconfig = archivist.siteconfig
+    profiles = siteconfig.get('render_profiles') or {}
+    name = (metadata.get('render-profile') or [None])[0]
+    if not name:
+        itemtype = string.capwords(
+            (metadata.get('itemtype') or ['Item/Page/Article'])[0], '/')
+        by_itemtype = siteconfig.get('render_profile_by_itemtype') or {}
+        matches = [t for t in by_itemtype
+                   if itemtype == t or itemtype.startswith(t + '/')]
+        if matches:
+            name = by_itemtype[max(matches, key=len)]
+    if name and name in profiles:
+        return get_profile(name, profiles[name])
+    if name and name != 'default':
+        logger.warn("Unknown render profile %s, using default" % name)
+    if 'default' in profiles:
+        return get_profile('default', profiles['default'])
+    return default_profile
+
+
+def convert(text, profile=None):
+    "Convert markdown text. Returns a tuple (html, metadata)."
+    return (profile or default_profile).convert(text)
+
+
+#######################################################################
+# Render cache
+#######################################################################
+# Rendered bodies are cached by a hash of the body text and everything else
+# that affects the output: extensions, their configuration, and versions.
+render_cache = RenderCache()
+
+
+def body_cache_key(body, profile=None):
+    return digest((profile or default_profile).digest, body)
+
+
+def render_cache_store(archivist, name='render'):
+    """
+    Return the named persistent cache store for the site, if any. The
+    siteconfig setting `render_cache` is either the path of a local directory
+    or "archive" to keep the cache in the bucket.
+    """
+    setting = archivist.siteconfig.get('render_cache')
+    if not setting:
+        return None
+    if setting == 'archive':
+        if isinstance(archivist, Archivist):
+            return ArchivistStore(archivist, name)
+        return None  # e.g. a batch ConvertContext, which cannot store
+    return DirectoryStore(os.path.join(setting, name))
 
 
 # markdown normalizes all meta keys to lower case, but keys for AWS are
@@ -90,12 +282,121 @@ def fixup_query(query):
     return new_query
 
 
+def find_meta_end(text, complete=True):
+    """
+    Return the offset in text where the metadata block ends (and the body
+    begins), following the same rules as the markdown `meta` extension. If
+    text is only the beginning of a document (complete=False) and the block
+    has not ended yet, returns None.
+    """
+    offset = 0
+    key = None
+    first = True
+    for line in text.splitlines(True):
+        if not line.endswith('\n') and not complete:
+            return None  # partial line, cannot tell yet
+        stripped = line.rstrip('\r\n')
+        if first and BEGIN_RE.match(stripped):
+            first = False
+            offset += len(line)
+            continue
+        first = False
+        if stripped.strip() == '' or END_RE.match(stripped):
+            return offset + len(line)  # terminator belongs to the meta block
+        m1 = META_RE.match(stripped)
+        if m1:
+            key = m1.group('key')
+        elif not (key and META_MORE_RE.match(stripped)):
+            return offset  # this line belongs to the body
+        offset += len(line)
+    return offset if complete else None
+
+
+def read_front_matter(archivist, key, chunk_size=4096):
+    """
+    Return the metadata block of the markdown source stored at key, fetching
+    only the leading bytes of the object. The range is doubled until the end
+    of the block is found.
+    """
+    size = chunk_size
+    while True:
+        head, complete = archivist.get_head_bytes(key, size)
+        if not complete:
+            # only decode whole lines, so we never split a multibyte char
+            head = head[:head.rfind(b'\n') + 1]
+        text = head.decode('utf-8')
+        end = find_meta_end(text, complete)
+        if end is not None:
+            return text[:end]
+        size *= 2
+
+
+def read_source_metadata(archivist, key, chunk_size=4096):
+    "Return the Item metadata of the markdown source stored at key."
+    header = read_front_matter(archivist, key, chunk_size)
+    return parse_metadata(archivist, header)['Item']
+
+
+def read_meta(text):
+    """
+    Parse the metadata block at the start of text the way the markdown `meta`
+    extension does, without converting anything. Returns a dict of lower case
+    keys to lists of values, like `Markdown.Meta`.
+    """
+    # The same whitespace normalization markdown applies before `meta` runs
+    text = text.replace('\r\n', '\n').replace('\r', '\n').expandtabs(4)
+    meta = {}
+    key = None
+    lines = text.split('\n')
+    if lines and BEGIN_RE.match(lines[0]):
+        lines.pop(0)
+    for line in lines:
+        if line.strip() == '' or END_RE.match(line):
+            break
+        m1 = META_RE.match(line)
+        if m1:
+            key = m1.group('key').lower().strip()
+            meta.setdefault(key, []).append(m1.group('value').strip())
+            continue
+        m2 = META_MORE_RE.match(line)
+        if not (m2 and key):
+            break
+        meta[key].append(m2.group('value').strip())
+    return meta
+
+
+def parse_metadata(archivist, text):
+    """
+    Return the archetype for markdown text without its body: the same
+    normalized metadata `to_archetype` produces, without rendering anything.
+    Use it when only the metadata is needed, e.g. to calculate paths.
+    """
+    return build_archetype(archivist, read_meta(text))
+
+
 def to_archetype(archivist, text):
     "Given text in markdown format, returns a dict of metadata and body text."
-    timezone = archivist.siteconfig.get('timezone', pytz.utc)
-    html = md.convert(text)
+    metadata = read_meta(text)
+    profile = select_profile(archivist, metadata)
+    # Only the body is rendered, so if it has not changed since the last
+    # time we saw it, reuse the HTML and just parse the metadata.
+    key = body_cache_key(text[find_meta_end(text):], profile)
+    store = render_cache_store(archivist)
+    html = render_cache.get(key, store)
+    if html is not None:
+        return build_archetype(archivist, metadata, html)
+    with highlight.using_store(render_cache_store(archivist, 'highlight')):
+        (html, metadata) = convert(text, profile)
+    render_cache.put(key, html, store)
+    return build_archetype(archivist, metadata, html)
 
-    metadata = md.Meta
+
+def build_archetype(archivist, metadata, html=None):
+    """
+    Build an archetype from markdown metadata (as parsed by the `meta`
+    extension) and the rendered body. If html is None the body is omitted.
+    """
+    timezone = archivist.siteconfig.get('timezone', pytz.utc)
     itemmeta = {}
     catalogmeta = {}
     # Here we implement some special case transforms for data that may need
@@ -103,11 +404,7 @@ def to_archetype(archivist, text):
     for key, value in metadata.items():
         if key in ['created', 'date', 'published', 'updated']:
             # because humans are sloppy, we parse and normalize date values
-            dt = parse_date(value[0])
-            if dt.tzinfo:
-                dt = dt.astimezone(timezone)
-            else:
-                dt = timezone.localize(dt)
+            dt = normalize_datetime(value[0], timezone)
             if key == 'date':  # Legacy DC.date, convert to specific
                 key == 'published'
             itemmeta[key] = dt.isoformat()
@@ -166,7 +463,9 @@ def to_archetype(archivist, text):
     if "attribution" not in itemmeta:
         itemmeta["attribution"] = archivist.siteconfig.get("attribution")
 
-    archetype = {"Item": itemmeta, "Item_Page_Article": {"body": html}}
+    archetype = {"Item": itemmeta}
+    if html is not None:
+        archetype["Item_Page_Article"] = {"body": html}
     if itemmeta['itemtype'].startswith('Item/Page/Catalog'):
         catalogmeta['query'] = fixup_query(catalogmeta['query'])
         archetype['Item_Page_Catalog'] = catalogmeta
@@ -184,14 +483,10 @@ def on_save(archivist, resource):
 
 
 def source_text_mardown_to_archetype(message, context):
-    events = parse_aws_event(message)
-    if not events:
-        logger.warn("No events found in message!\n%s" % message)
-    for event in events:
+    def handle(archivist, event):
         if event.is_save_event:
-            archivist = S3archivist(event.bucket)
-            resource = archivist.get(event.key)
-            on_save(archivist, resource)
+            on_save(archivist, archivist.get(event.key))
         else:
             logger.warn("Not a save event!\n%s" % event)
 
+    handle_message(message, handle)
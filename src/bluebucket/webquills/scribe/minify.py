@@ -0,0 +1,164 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+A conservative HTML minifier that works on a stream of text.
+
+Jinja output carries all of the templates' indentation. `HTMLMinifier`
+collapses each run of whitespace between and within text to a single space
+(or newline, if the run had one), and drops comments other than conditional
+comments. Tags are passed through untouched, as is everything inside `pre`,
+`textarea`, `code`, `script` and `style` elements, where whitespace matters.
+
+Text is fed in chunks of any size; whatever might continue in the next chunk
+is held back until it arrives, so the output is the same however the input
+is split. Sites enable it with the siteconfig setting `minify_html`.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import re
+
+raw_elements = ('pre', 'textarea', 'code', 'script', 'style')
+_raw_open = re.compile(r'<(?:%s)(?=[\s/>])' % '|'.join(raw_elements), re.I)
+# One token per match: a comment, a raw element whole, a tag, or text. An
+# incomplete comment or raw element matches as a tag, or not at all.
+_token = re.compile(r'<!--.*?-->'
+                    r'|<(%s)(?=[\s/>])[^>]*>.*?</\1\s*>'
+                    r'|<[^>]*>'
+                    r'|[^<]+' % '|'.join(raw_elements), re.I | re.S)
+# How the element held back at the start of the buffer ends.
+_closing = dict((name, re.compile(r'</%s\s*>' % name, re.I))
+                for name in raw_elements)
+_closing['!--'] = re.compile(r'-->')
+_newline_run = re.compile(r'\s*\n\s*')
+_space_run = re.compile(r'[^\S\n]+')
+
+
+class HTMLMinifier(object):
+    def __init__(self, remove_comments=True):
+        self.remove_comments = remove_comments
+        self._buffer = ''
+        self._last = ''  # the last character output
+        self._dropped = False  # a comment was dropped after whitespace
+        self._open = None  # raw element or comment the buffer starts with
+        self._scanned = 0  # how far the buffer was searched for its end
+
+    def feed(self, text):
+        "Add text and return as much minified output as is certain."
+        self._buffer += text
+        if self._open is not None and not self._ended():
+            return ''
+        (out, self._buffer) = self._process(self._buffer, final=False)
+        return out
+
+    def close(self):
+        "Return the rest of the output."
+        (out, self._buffer) = self._process(self._buffer, final=True)
+        self._open = None
+        return out
+
+    def _ended(self):
+        """
+        True if the element held back has ended. Otherwise, note how far the
+        buffer has been searched, so the next chunk's search starts there
+        rather than rescanning a long `pre` or `script` from the start.
+        """
+        buf = self._buffer
+        if _closing[self._open].search(buf, self._scanned):
+            self._open = None
+            return True
+        if self._open == '!--':
+            self._scanned = max(self._scanned, len(buf) - 2)
+            return False
+        # Only the last "<" can begin a closing tag yet to be completed.
+        last = buf.rfind('<', self._scanned)
+        head = '</' + self._open
+        tail = buf[last:]
+        if last >= 0 and head.startswith(tail[:len(head)].lower()) and \
+                not tail[len(head):].strip():
+            self._scanned = last
+        else:
+            self._scanned = len(buf)
+        return False
+
+    def _process(self, html, final):
+        out = []
+        pos = 0
+        end = len(html)
+        for match in _token.finditer(html):
+            token = match.group(0)
+            if match.start() != pos:
+                if html.startswith('<!--', pos):
+                    self._hold('!--', 4)
+                break  # a "<" with no ">" after it
+            if token[0] != '<':
+                # Text. Its trailing whitespace may continue in the next
+                # chunk, so unless this is the end it waits for a tag.
+                if match.end() == end and not final:
+                    break
+                token = _space_run.sub(' ', _newline_run.sub('\n', token))
+                if self._dropped:
+                    # The whitespace either side of a dropped comment is
+                    # one run.
+                    token = token.lstrip()
+            elif token.startswith('<!--'):
+                if not token.endswith('-->'):
+                    self._hold('!--', max(4, len(token) - 2))
+                    break  # incomplete, matched as a tag
+                if self.remove_comments and not token.startswith('<!--['):
+                    last = out[-1][-1:] if out else self._last
+                    if last.isspace():
+                        self._dropped = True
+                    pos = match.end()
+                    continue
+            elif match.group(1) is None and _raw_open.match(token):
+                self._hold(_raw_open.match(token).group(0)[1:].lower(),
+                           len(token))
+                break  # a raw element's opening tag, its end yet to come
+            elif end - pos < 4 and not final:
+                break  # could yet be the start of a comment
+            if token:
+                out.append(token)
+                self._dropped = False
+            pos = match.end()
+        if final and pos < end:
+            out.append(html[pos:])  # unterminated markup, as it was
+            pos = end
+        if out:
+            self._last = out[-1][-1:]
+        return (''.join(out), html[pos:])
+
+    def _hold(self, element, scanned):
+        "Note the held back text starts with element, its end not in scanned."
+        self._open = element
+        self._scanned = scanned
+
+
+def minify(html, remove_comments=True):
+    "Return html minified."
+    minifier = HTMLMinifier(remove_comments)
+    return minifier.feed(html) + minifier.close()
+
+
+def minify_stream(chunks, remove_comments=True):
+    "Minify an iterable of text chunks, yielding minified chunks."
+    minifier = HTMLMinifier(remove_comments)
+    for chunk in chunks:
+        out = minifier.feed(chunk)
+        if out:
+            yield out
+    out = minifier.close()
+    if out:
+        yield out
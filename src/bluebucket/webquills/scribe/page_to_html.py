@@ -18,14 +18,34 @@
 Transforms a JSON archetype to a monograph using a Jinja2 template.
 """
 from __future__ import absolute_import, print_function, unicode_literals
-from bluebucket.util import is_sequence
-from bluebucket.archivist import parse_aws_event, S3archivist
-from jinja2 import Template
+from bluebucket import assets
+from bluebucket.templates import template_prefix, template_versions
+from bluebucket.templates import templates_used
+from bluebucket.util import is_sequence, rechunk
+from bluebucket.archivist import is_missing
+from bluebucket.dispatch import handle_message
+from contextlib import contextmanager
+from jinja2 import Template, contextfunction
+import json
 import logging
 import posixpath as path
+import threading
+import time
 import webquills.indexer.item
+from webquills.indexer.depends import record_catalog
+from webquills.indexer.depends import record_templates
+from webquills.scribe.cache import digest
+from webquills.scribe.fragments import FragmentCacheExtension
+from webquills.scribe.markdown import render_cache_store
+from webquills.scribe.minify import minify, minify_stream
 
 logger = logging.getLogger(__name__)
+stream_chunk_size = 64 * 1024  # bytes of template output per compress call
+_loading = threading.local()
+_track_lock = threading.Lock()
+default_version_cache_seconds = 60
+_versions = {}  # (bucket, template dir) -> (time, versions, manifest)
+_versions_lock = threading.Lock()
 fallback_template = """
 <doctype html><html><head>
   <title>{{ Item.title }}</title>
@@ -34,6 +54,82 @@ fallback_template = """
 """
 
 
+def _note(names):
+    loaded = getattr(_loading, 'names', None)
+    if loaded is not None:
+        loaded.update(names)
+
+
+@contextfunction
+def asset_url(context, key):
+    """
+    Template function: `{{ asset_url("css/site.css") }}` gives the URL of an
+    asset, fingerprinted when the site sets `fingerprint_assets` (see
+    bluebucket.assets).
+    """
+    return assets.asset_url(context.get('_assets') or {}, key)
+
+
+def _configure(archivist, env):
+    "Prepare an archivist's Jinja environment for rendering pages."
+    env.add_extension(FragmentCacheExtension)
+    env.globals['asset_url'] = asset_url
+    env.fragment_store = render_cache_store(archivist, 'fragments')
+    _track(env)
+
+
+def _track(env):
+    # Jinja loads extended, included and imported templates at render time
+    # through these two methods, so wrapping them sees every template used.
+    get_template = env.get_template
+    select_template = env.select_template
+
+    def tracked_get_template(name, *args, **kwargs):
+        template = get_template(name, *args, **kwargs)
+        if isinstance(name, Template):
+            return template
+        _note([template.name])
+        return template
+
+    def tracked_select_template(names, *args, **kwargs):
+        template = select_template(names, *args, **kwargs)
+        # Record the candidates tried as well as the one found: adding one
+        # of them would change the page.
+        tried = []
+        for name in names:
+            if isinstance(name, Template):
+                break
+            tried.append(name)
+            if name == template.name:
+                break
+        _note(tried)
+        return template
+
+    env.get_template = tracked_get_template
+    env.select_template = tracked_select_template
+    env.webquills_tracked = True
+
+
+@contextmanager
+def loading_templates(archivist):
+    """
+    Collect the names of the templates loaded in this thread into a set:
+    those extended and included as well, and the more specific candidates
+    that were not found. Renders record them in the dependency index, so
+    `quill rebuild --template` renders again only pages using a template.
+    """
+    env = archivist.jinja
+    with _track_lock:
+        if not getattr(env, 'webquills_tracked', False):
+            _configure(archivist, env)
+    previous = getattr(_loading, 'names', None)
+    _loading.names = names = set()
+    try:
+        yield names
+    finally:
+        _loading.names = previous
+
+
 def get_template(archivist, context):
     """Return the correct Jinja2 Template object for this archetype."""
     templates = []
@@ -69,22 +165,109 @@ def get_template(archivist, context):
     return archivist.jinja.select_template(templates)
 
 
-def on_save(archivist, resource):
+def fingerprint(archivist, resource, template, context, versions):
+    """
+    Return a digest of everything rendering resource with template depends
+    on: the archetype, the templates used, the siteconfig, the query result
+    for catalogs and the asset manifest. None if it cannot be worked out.
+    versions are the site's template versions, from `template_versions`.
+    """
+    try:
+        if template.name is None:
+            used = fallback_template
+        elif versions is None:
+            return None
+        else:
+            used = json.dumps(templates_used(archivist, template.name,
+                                             versions),
+                              sort_keys=True)
+        return digest(resource.content, used,
+                      json.dumps(archivist.siteconfig, sort_keys=True,
+                                 default=str),
+                      json.dumps(context.get('query_result'), sort_keys=True,
+                                 default=str),
+                      json.dumps(context.get('_assets'), sort_keys=True))
+    except Exception as e:
+        logger.warn("No fingerprint for %s: %s" % (resource.key, e))
+        return None
+
+
+def site_versions(archivist, now=None):
+    """
+    Return (template versions, asset manifest) for the archivist's site.
+    The versions are None if the templates cannot be listed, and the manifest
+    None unless the site sets `fingerprint_assets`.
+
+    Both are remembered per bucket for the siteconfig `version_cache_seconds`
+    (default 60), so an edited template or asset is noticed after at most
+    that long. Set it to 0 to check on every render.
+    """
+    ttl = float(archivist.siteconfig.get('version_cache_seconds',
+                                         default_version_cache_seconds))
+    now = time.time() if now is None else now
+    ident = (archivist.bucket, template_prefix(archivist))
+    with _versions_lock:
+        cached = _versions.get(ident)
+    if cached is not None and now - cached[0] < ttl:
+        return cached[1:]
+    try:
+        versions = template_versions(archivist)
+    except Exception as e:
+        logger.warn("Cannot list templates: %s" % e)
+        versions = None
+    manifest = None
+    if archivist.siteconfig.get('fingerprint_assets'):
+        manifest = assets.load_manifest(archivist)
+    if versions is not None:
+        with _versions_lock:
+            _versions[ident] = (now, versions, manifest)
+    return (versions, manifest)
+
+
+def is_current(archivist, artifact):
+    "True if the stored artifact was rendered from the same inputs."
+    expected = artifact.metadata.get('fingerprint')
+    if not expected:
+        return False
+    try:
+        stored = archivist.head(artifact.key)
+    except Exception as e:
+        if not is_missing(e):
+            raise
+        return False
+    return stored.metadata.get('fingerprint') == expected
+
+
+def prepare(archivist, resource):
+    """
+    Return (template, context, artifact) for rendering an archetype resource,
+    where artifact is the resource to be saved, without its content. Returns
+    None if the resource is not an archetype.
+    """
     if not resource.resourcetype == 'archetype':
-        return []
+        return None
 
     # Construct a template context
     context = resource.data
     context['_site'] = archivist.siteconfig
+    (versions, manifest) = site_versions(archivist)
+    if manifest is not None:
+        context['_assets'] = manifest
     if 'Item_Page_Catalog' in context:
         if "query" in context['Item_Page_Catalog']:
             # execute the query and store the results in the context
             q = context['Item_Page_Catalog']['query']
             context["query_result"] = webquills.indexer.item.execute_query(q)
+            # remember what this catalog reads, so changes to matching items
+            # can cause it to be rendered again
+            record_catalog(archivist, resource.key, q)
 
-    # Render the appropriate template for this resource
+    # Find the appropriate template for this resource
     template = get_template(archivist, context)
-    content = template.render(context)
+    # cached fragments are keyed on this, see webquills.scribe.fragments
+    context['_template_version'] = versions and digest(
+        json.dumps(versions, sort_keys=True),
+        json.dumps(context.get('_assets'), sort_keys=True))
 
     # create the artifact resource
     resmeta = {
@@ -94,22 +277,79 @@ def on_save(archivist, resource):
     }
     key = archivist.pathstrategy.path_for(**dict(resource.data["Item"],
                                                  **resmeta))
-    monograph = archivist.new_resource(key=key,
-                                       content=content,
-                                       **resmeta)
-    archivist.publish(monograph)
+    artifact = archivist.new_resource(key=key, **resmeta)
+    fp = fingerprint(archivist, resource, template, context, versions)
+    if fp:
+        artifact.metadata['fingerprint'] = fp
+    return (template, context, artifact)
+
+
+def render(archivist, resource):
+    """
+    Render an archetype resource to its HTML artifact. Returns the artifact
+    resource, not yet saved, or None if the resource is not an archetype.
+    """
+    with loading_templates(archivist) as templates:
+        prepared = prepare(archivist, resource)
+        if prepared is None:
+            return None
+        (template, context, artifact) = prepared
+        artifact.text = render_text(archivist, template, context)
+    record_templates(archivist, resource.key, templates)
+    return artifact
+
+
+def render_text(archivist, template, context):
+    "Render template to text, minified if the site sets `minify_html`."
+    text = template.render(context)
+    if archivist.siteconfig.get('minify_html'):
+        text = minify(text)
+    return text
+
+
+def generate(archivist, template, context, encoding='utf-8'):
+    """
+    Render template as an iterator of encoded chunks, minified if the site
+    sets `minify_html`.
+    """
+    chunks = template.generate(context)
+    if archivist.siteconfig.get('minify_html'):
+        chunks = minify_stream(chunks)
+    encoded = (text.encode(encoding) for text in chunks)
+    return rechunk(encoded, stream_chunk_size)
+
+
+def on_save(archivist, resource):
+    """
+    Render and publish the artifact of a saved archetype, unless the stored
+    artifact has the same fingerprint. With the siteconfig `stream_render`,
+    the page is uploaded as it is rendered, never held in memory whole.
+    """
+    with loading_templates(archivist) as templates:
+        prepared = prepare(archivist, resource)
+        if prepared is None:
+            return []
+        (template, context, monograph) = prepared
+        if is_current(archivist, monograph):
+            logger.info("%s is up to date" % monograph.key)
+            return []
+        if archivist.siteconfig.get('stream_render'):
+            monograph.acl = 'public-read'
+            archivist.save_stream(monograph,
+                                  generate(archivist, template, context,
+                                           monograph.encoding))
+        else:
+            monograph.text = render_text(archivist, template, context)
+            archivist.publish(monograph)
+    record_templates(archivist, resource.key, templates)
     return [monograph]
 
 
 def item_page_to_html(message, context):
-    events = parse_aws_event(message)
-    if not events:
-        logger.warn("No events found in message!\n%s" % message)
-    for event in events:
+    def handle(archivist, event):
         if event.is_save_event:
-            archivist = S3archivist(event.bucket)
-            resource = archivist.get(event.key)
-            on_save(archivist, resource)
+            on_save(archivist, archivist.get(event.key))
         else:
             logger.warn("Not a save event!\n%s" % event)
 
+    handle_message(message, handle)